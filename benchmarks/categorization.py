@@ -0,0 +1,92 @@
+"""
+Categorizations learned from the Firefly history: how long building the index out of a ledger mirror takes,
+what a lookup costs, and how many rows of a synthetic statement come out uncategorized without and with it.
+The history holds categorized transactions of the merchants the rules don't know, along with many others.
+
+    python -m benchmarks.categorization [--history 50000] [--merchants 5000] [--rows 5000]
+"""
+import argparse
+import os
+import random
+import string
+import tempfile
+import time
+from datetime import date, timedelta
+from pathlib import Path
+
+os.environ.setdefault('FIREFLY_III_HOST', 'http://localhost')
+os.environ.setdefault('FIREFLY_III_ACCESS_TOKEN', 'benchmark')
+
+from benchmarks.statements import UNKNOWN_MERCHANTS, build_card_payment, generate_bt_statement  # noqa: E402
+from firefly_iii_automation.categorization import get_merchant_token, load_categorization_index  # noqa: E402
+from firefly_iii_automation.ledger_mirror import LedgerMirror  # noqa: E402
+from firefly_iii_automation.transactions_parsers import bt  # noqa: E402
+
+
+def generate_history(rng: random.Random, count: int, merchants: int):
+    """
+    Categorized withdrawals shaped like Firefly returns them, a tenth of them at the merchants the rules don't know
+    """
+    # letters only, merchant tokens leave digits out
+    names = [' '.join(''.join(rng.choices(string.ascii_uppercase, k=7)) for _ in range(2)) for _ in range(merchants)]
+    categories = {name: f'Category {rng.randrange(20)}' for name in names + UNKNOWN_MERCHANTS}
+    start = date(2022, 1, 1)
+    for index in range(count):
+        merchant = rng.choice(UNKNOWN_MERCHANTS) if rng.random() < 0.1 else rng.choice(names)
+        day = start + timedelta(days=index * 365 // count)
+        yield {
+            'id': str(index),
+            'attributes': {'transactions': [{
+                'type': 'withdrawal',
+                'date': f'{day}T00:00:00+02:00',
+                'amount': '10.00',
+                'description': f'{merchant.title()} cumparaturi',
+                'source_name': 'BT RON',
+                'destination_name': merchant.title(),
+                'category_name': categories[merchant],
+                'external_id': f'HISTORY{index:08d}',
+                'notes': build_card_payment(rng, day, merchant),
+            }]},
+        }
+
+
+def count_uncategorized(content: str, index=None) -> tuple[int, int]:
+    transactions = list(bt.iter_bt_transaction_report(content, categorization_index=index))
+    return sum(1 for transaction in transactions if not transaction.category_name), len(transactions)
+
+
+def run(history: int, merchants: int, rows: int):
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as directory:
+        mirror = LedgerMirror(Path(directory) / 'ledger.sqlite3')
+        mirror.replace_transactions(None, generate_history(rng, history, merchants), date.today())
+        content = generate_bt_statement(Path(directory) / 'statement.csv', rows).read_text()
+
+        uncategorized_before, total = count_uncategorized(content)
+
+        started_at = time.perf_counter()
+        index = load_categorization_index(mirror)
+        load_seconds = time.perf_counter() - started_at
+        uncategorized_after, _ = count_uncategorized(content, index)
+
+    tokens = [get_merchant_token(build_card_payment(rng, date.today(), name)) for name in UNKNOWN_MERCHANTS]
+    lookups = tokens * (100000 // len(tokens))
+    started_at = time.perf_counter()
+    for token in lookups:
+        index.suggest(token)
+    lookup_seconds = (time.perf_counter() - started_at) / len(lookups)
+
+    print(f"history of {history} transactions, {len(index)} merchants learned")
+    print(f"  build:  {load_seconds * 1000:8.1f} ms")
+    print(f"  lookup: {lookup_seconds * 1e9:8.0f} ns")
+    print(f"  uncategorized rows out of {total}: {uncategorized_before} without, {uncategorized_after} with it")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--history', type=int, default=50000)
+    parser.add_argument('--merchants', type=int, default=5000)
+    parser.add_argument('--rows', type=int, default=5000)
+    args = parser.parse_args()
+
+    run(args.history, args.merchants, args.rows)
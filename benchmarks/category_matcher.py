@@ -0,0 +1,188 @@
+"""
+Compare the compiled category matcher with the loop-over-every-string implementation it replaced.
+
+    python -m benchmarks.category_matcher [--rows 20000] [--extra-merchants 300]
+"""
+import argparse
+import os
+import random
+import re
+import string
+import timeit
+
+os.environ.setdefault('FIREFLY_III_HOST', 'http://localhost')
+os.environ.setdefault('FIREFLY_III_ACCESS_TOKEN', 'benchmark')
+
+from firefly_iii_automation.transactions_parsers import bt  # noqa: E402
+from firefly_iii_automation.transactions_parsers.rules import CategoryMatcher, CategoryRule  # noqa: E402
+
+
+def legacy_get_description_category_destination(bt_description, debit, credit, categories_strings_maps):
+    """
+    The implementation before the rules were compiled, verbatim except for taking the strings map as argument and
+    naming its loop variable so it doesn't shadow the string module
+    """
+    category = None
+    found_string = None
+    description = ''
+    destination = "Unknown"
+
+    destination_match = re.search(r'TID:?[\d\w]+ (.+)\s{2}', bt_description)
+    if destination_match:
+        destination = destination_match.group(1)
+
+    for key, strings in categories_strings_maps.items():
+        for candidate in strings:
+            if candidate in bt_description:
+                category = key
+                found_string = candidate
+                destination = found_string.lower().capitalize()
+                break
+
+    if category == 'Food':
+        if debit > 150 and 'tazz' in found_string.lower() or 'glovo' in found_string.lower():
+            category = 'Groceries'
+        else:
+            description = 'Mancare comandata'
+
+        if 'tazz' in found_string.lower():
+            destination = 'Tazz'
+
+    if category == 'Groceries':
+        description = f'{destination} cumparaturi'
+
+    if category == "Transport":
+        description = destination
+
+        if "bolt" in found_string.lower():
+            destination = 'Bolt'
+
+            if debit < 13:
+                description = 'Bolt scooter'
+
+        if "uber" in found_string.lower():
+            destination = 'Uber'
+
+        if description.lower() == 'Epinterregional.ro'.lower():
+            description = 'Bilet tren'
+
+        if 'LIMRIDE' == found_string:
+            description = destination = 'Lime'
+
+        if 'ROMPETROL' == found_string:
+            description = 'Carburant'
+            destination = 'Rompetrol'
+
+    if category == "Going out":
+        description = "Iesire"
+
+        if 'ADA GIKU CAFE SRL'.lower() in destination.lower():
+            description = 'Cafea Meron'
+            destination = 'Meron'
+
+        if 'PANEMAR' == found_string:
+            description = destination = 'Panemar'
+
+        if 'KFC KIOSK' == found_string:
+            description = destination = 'KFC'
+
+    if category == "Cheltuieli":
+        if 'ALLIANZ-TIRIAC ASIG.' == found_string:
+            currency = 'EUR' if re.search(r'\d+EUR RRN', bt_description) else 'RON'
+            description = f'Allianz-Tiriac Asigurare Investitie {currency}'
+            destination = 'Allianz-Tiriac'
+
+        if 'RCS AND RDS' == found_string:
+            description = destination = 'Digi'
+
+        if 'WWW.ORANGE.RO' == found_string:
+            description = 'Factura Orange'
+            destination = 'Orange'
+
+        if "WWW.EON.RO/MYLINE" == found_string:
+            description = 'Factura EON'
+            destination = 'EON'
+
+    if not category:
+        if 'Transfer din card' in bt_description:
+            sender = re.search(r'Transfer din card \d+ (.+) catre', bt_description).group(1)
+
+            sender = sender.lower().title()
+            description = f'Transfer {sender}'
+            destination = sender
+
+    if not description and destination != 'Unknown':
+        description = f'Plata {destination}'
+
+    return description, category, destination
+
+
+def generate_rows(count: int, merchants: list[str]):
+    rows = []
+    for index in range(count):
+        kind = random.random()
+        if kind < 0.7:
+            merchant = random.choice(merchants)
+            suffix = '10EUR RRN' if random.random() < 0.5 else '10RON RRN'
+            text = f'Plata la POS non-BT cu card VISA;POS 02/01/2023 TID:T{index} {merchant} BUCURESTI  {suffix}:123'
+        elif kind < 0.85:
+            text = f'Plata la POS;POS 03/01/2023 TID:T{index} UNKNOWN SHOP {index} SRL  RRN:123456'
+        else:
+            text = f'Incasare;Transfer din card 4321 ION POPESCU catre RO49BTRL REF {index}'
+        rows.append((text, round(random.uniform(1, 300), 2), 0))
+    return rows
+
+
+def random_merchant(known: list[str]):
+    """
+    A made up merchant which doesn't overlap a known one, where the old and new priority rules would disagree
+    """
+    while True:
+        merchant = ''.join(random.choice(string.ascii_uppercase) for _ in range(random.randint(6, 14)))
+        if not any(merchant in other or other in merchant for other in known):
+            return merchant
+
+
+def run(rows_count: int, extra_merchants: int):
+    random.seed(0)
+    rules = list(bt.CATEGORY_RULES)
+    for _ in range(extra_merchants):
+        rules.append(CategoryRule(match=random_merchant([rule.match for rule in rules]), category='Synthetic'))
+    categories_strings_maps = {
+        **bt.CATEGORIES_STRINGS_MAPS,
+        'Synthetic': [rule.match for rule in rules if rule.category == 'Synthetic'],
+    }
+    rows = generate_rows(rows_count, [string for strings in categories_strings_maps.values() for string in strings])
+
+    # the compiled matcher swapped in for the benchmark only, nothing learned from the local history either
+    original_matcher = bt.CATEGORY_MATCHER
+    bt.CATEGORY_MATCHER = CategoryMatcher(rules)
+    try:
+        compiled = [bt.get_description_category_destination(*row) for row in rows]
+        compiled_seconds = timeit.timeit(
+            lambda: [bt.get_description_category_destination(*row) for row in rows], number=3
+        ) / 3
+    finally:
+        bt.CATEGORY_MATCHER = original_matcher
+
+    legacy = [legacy_get_description_category_destination(*row, categories_strings_maps) for row in rows]
+    legacy_seconds = timeit.timeit(
+        lambda: [legacy_get_description_category_destination(*row, categories_strings_maps) for row in rows], number=3
+    ) / 3
+
+    match_strings = sum(len(strings) for strings in categories_strings_maps.values())
+    differences = sum(1 for old, new in zip(legacy, compiled) if old != new)
+    print(f"{rows_count} rows, {match_strings} match strings")
+    print(f"  legacy:   {legacy_seconds / rows_count * 1e6:8.2f} us/row")
+    print(f"  compiled: {compiled_seconds / rows_count * 1e6:8.2f} us/row ({legacy_seconds / compiled_seconds:.1f}x)")
+    print(f"  rows resolved differently: {differences}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--extra-merchants', type=int, default=300)
+    args = parser.parse_args()
+
+    run(args.rows, 0)
+    run(args.rows, args.extra_merchants)
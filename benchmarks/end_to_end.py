@@ -0,0 +1,217 @@
+"""
+End-to-end throughput of automated_scripts.parse_bt_report and of the Wave review pipeline, on a synthetic
+statement imported into a local Firefly stub. Reports rows/sec and p50/p99 per-row latency of every stage and
+saves the results as JSON, so runs can be compared.
+
+    python -m benchmarks.end_to_end [--rows 1000] [--latency-ms 5] [--output results.json]
+
+Stages working on the whole statement at once (dedup, and parsing in the Wave pipeline) report their
+amortized per-row latency, so their p50 and p99 are the same.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+from functools import wraps
+from pathlib import Path
+from unittest import mock
+
+from benchmarks.firefly_stub import FireflyStub
+
+IBAN = 'RO49BTRLRONCRT0000000001'
+ASSET_ACCOUNTS = {IBAN: 'BT RON'}
+STAGES = ('sync', 'parse', 'dedup', 'resolve', 'insert')
+
+
+class StageTimer:
+    def __init__(self):
+        # stage -> (seconds, rows) of every timed call
+        self.samples: dict[str, list[tuple[float, int]]] = defaultdict(list)
+
+    def wrap(self, stage: str, function, count_rows=lambda args, result: 1):
+        """
+        :param count_rows: how many rows a call handled, out of its arguments and result
+        """
+        if asyncio.iscoroutinefunction(function):
+            @wraps(function)
+            async def timed(*args, **kwargs):
+                started_at = time.perf_counter()
+                result = await function(*args, **kwargs)
+                self.samples[stage].append((time.perf_counter() - started_at, count_rows(args, result)))
+                return result
+        else:
+            @wraps(function)
+            def timed(*args, **kwargs):
+                started_at = time.perf_counter()
+                result = function(*args, **kwargs)
+                self.samples[stage].append((time.perf_counter() - started_at, count_rows(args, result)))
+                return result
+        return timed
+
+    def wrap_generator(self, stage: str, function):
+        """
+        Time an async generator row by row, as the wait before each row it yields
+        """
+        @wraps(function)
+        async def timed(*args, **kwargs):
+            started_at = time.perf_counter()
+            async for row in function(*args, **kwargs):
+                self.samples[stage].append((time.perf_counter() - started_at, 1))
+                yield row
+                started_at = time.perf_counter()
+        return timed
+
+    def summary(self) -> dict:
+        stages = {}
+        for stage in STAGES:
+            samples = self.samples.get(stage, [])
+            seconds = sum(sample_seconds for sample_seconds, _ in samples)
+            rows = sum(sample_rows for _, sample_rows in samples)
+            latencies = sorted(
+                latency
+                for sample_seconds, sample_rows in samples if sample_rows
+                for latency in [sample_seconds / sample_rows] * sample_rows
+            )
+            stages[stage] = {
+                'rows': rows,
+                'seconds': seconds,
+                'rows_per_second': rows / seconds if rows and seconds else None,
+                'p50_ms': percentile(latencies, 0.50) * 1000 if latencies else None,
+                'p99_ms': percentile(latencies, 0.99) * 1000 if latencies else None,
+            }
+        return stages
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """
+    Nearest-rank percentile of already sorted values
+    """
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run_parse_bt_report(path: Path) -> StageTimer:
+    from firefly_iii_automation import automated_scripts
+
+    timer = StageTimer()
+    with mock.patch.multiple(
+            automated_scripts,
+            sync_ledger_mirror=timer.wrap('sync', automated_scripts.sync_ledger_mirror, lambda args, result: 0),
+            parse_bt_transaction_report=timer.wrap_generator('parse', automated_scripts.parse_bt_transaction_report),
+            build_external_ids_index=timer.wrap(
+                'dedup', automated_scripts.build_external_ids_index, lambda args, result: len(args[0])
+            ),
+            resolve_asset_account=timer.wrap('resolve', automated_scripts.resolve_asset_account),
+            create_new_transaction=timer.wrap('insert', automated_scripts.create_new_transaction),
+    ):
+        automated_scripts.parse_bt_report(path)
+    return timer
+
+
+def run_wave_pipeline(path: Path) -> StageTimer:
+    from firefly_iii_automation import wave_app
+    from firefly_iii_automation.firefly import _async
+
+    timer = StageTimer()
+
+    async def review_everything():
+        await wave_app.sync_ledger_mirror()
+        pipeline = wave_app.ReviewPipeline([str(path)])
+        try:
+            # what submitting the review form does, for every transaction
+            async for transaction in pipeline:
+                await wave_app.create_new_transaction(transaction)
+                await wave_app.record_reference_data_usage(transaction)
+        finally:
+            await pipeline.aclose()
+            await _async.close_api_client()
+
+    with mock.patch.multiple(
+            wave_app,
+            sync_ledger_mirror=timer.wrap('sync', wave_app.sync_ledger_mirror, lambda args, result: 0),
+            parse_bt_reports_async=timer.wrap(
+                'parse', wave_app.parse_bt_reports_async, lambda args, result: len(result)
+            ),
+            build_external_ids_index=timer.wrap(
+                'dedup', wave_app.build_external_ids_index, lambda args, result: len(args[0])
+            ),
+            resolve_review_asset_account=timer.wrap('resolve', wave_app.resolve_review_asset_account),
+            create_new_transaction=timer.wrap('insert', wave_app.create_new_transaction),
+    ):
+        asyncio.run(review_everything())
+    return timer
+
+
+SCENARIOS = {
+    'parse_bt_report': ('SYNC', run_parse_bt_report),
+    'wave_pipeline': ('WAVE', run_wave_pipeline),
+}
+
+
+def run(rows: int, latency: float, work_dir: Path) -> dict:
+    results = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'rows': rows,
+        'latency_ms': latency * 1000,
+        'scenarios': {},
+    }
+
+    with FireflyStub(ASSET_ACCOUNTS, latency=latency) as stub:
+        # the project reads its configuration once, when first imported
+        os.environ['FIREFLY_III_HOST'] = stub.url
+        os.environ['FIREFLY_III_ACCESS_TOKEN'] = 'benchmark'
+        os.environ['FIREFLY_III_MIRROR_PATH'] = str(work_dir / 'ledger.sqlite3')
+        from benchmarks.statements import generate_bt_statement
+
+        for name, (reference_prefix, run_scenario) in SCENARIOS.items():
+            # every scenario imports its own transactions, nothing of it is in the stub yet
+            path = generate_bt_statement(work_dir / f'{name}.csv', rows, IBAN, reference_prefix=reference_prefix)
+            started_at = time.perf_counter()
+            timer = run_scenario(path)
+            wall_seconds = time.perf_counter() - started_at
+            results['scenarios'][name] = {
+                'wall_seconds': wall_seconds,
+                'rows_per_second': rows / wall_seconds,
+                'stages': timer.summary(),
+            }
+
+    return results
+
+
+def print_results(results: dict):
+    def format_number(value, digits):
+        return f'{value:.{digits}f}' if value is not None else '-'
+
+    print(f"{results['rows']} rows, {results['latency_ms']:g} ms Firefly latency")
+    for name, scenario in results['scenarios'].items():
+        print(f"{name}: {scenario['wall_seconds']:.2f}s, {scenario['rows_per_second']:.0f} rows/s")
+        print(f"  {'stage':8} {'rows/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'seconds':>9}")
+        for stage, timings in scenario['stages'].items():
+            print(
+                f"  {stage:8} {format_number(timings['rows_per_second'], 0):>10} "
+                f"{format_number(timings['p50_ms'], 3):>9} {format_number(timings['p99_ms'], 3):>9} "
+                f"{timings['seconds']:9.3f}"
+            )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--latency-ms', type=float, default=5)
+    parser.add_argument('--output', type=Path, default=Path(f'end_to_end-{datetime.now():%Y%m%d-%H%M%S}.json'))
+    args = parser.parse_args()
+
+    # the per-transaction logging would drown the results
+    logging.disable(logging.INFO)
+    with tempfile.TemporaryDirectory() as work_dir:
+        results = run(args.rows, args.latency_ms / 1000, Path(work_dir))
+
+    print_results(results)
+    args.output.write_text(json.dumps(results, indent=2))
+    print(f"Saved to {args.output}")
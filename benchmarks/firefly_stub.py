@@ -0,0 +1,211 @@
+"""
+In-process stand-in for the Firefly III endpoints this project calls. It serves HTTP on localhost from a
+background thread, so both the generated client and the httpx based one can be pointed at it, and delays
+every response by a configurable latency.
+"""
+import itertools
+import json
+import threading
+import time
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+ACCOUNT_TYPES = {
+    'asset': 'Asset account',
+    'expense': 'Expense account',
+    'revenue': 'Revenue account',
+}
+
+
+class FireflyStub:
+    """
+    Keeps accounts, categories and transactions in memory; transactions posted to it create the accounts and
+    categories they name, like Firefly does
+    """
+
+    def __init__(self, asset_accounts: dict[str, str], latency: float = 0.0, per_page: int = 50):
+        """
+        :param asset_accounts: IBAN to name of the asset accounts that exist from the start
+        :param latency: seconds every response is delayed by
+        """
+        self.latency = latency
+        self.per_page = per_page
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.accounts: dict[tuple[str, str], dict] = {}
+        self.categories: dict[str, dict] = {}
+        self.transactions: list[dict] = []
+        self.requests = 0
+        for iban, name in asset_accounts.items():
+            self.get_account(name, 'asset', iban)
+
+        self.server: Optional[ThreadingHTTPServer] = None
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> str:
+        handler = type('Handler', (StubRequestHandler,), {'stub': self})
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def get_account(self, name: str, account_type: str, iban: Optional[str] = None) -> dict:
+        account = self.accounts.get((name, account_type))
+        if account is None:
+            account = self.accounts[(name, account_type)] = {
+                'type': 'accounts',
+                'id': str(next(self.ids)),
+                'attributes': {'name': name, 'type': account_type, 'iban': iban},
+            }
+        return account
+
+    def find_asset_account(self, name: str) -> Optional[dict]:
+        return self.accounts.get((name, 'asset'))
+
+    def get_category(self, name: str) -> dict:
+        category = self.categories.get(name)
+        if category is None:
+            category = self.categories[name] = {
+                'type': 'categories', 'id': str(next(self.ids)), 'attributes': {'name': name},
+            }
+        return category
+
+    def page(self, items: list, page: int, per_page: Optional[int] = None) -> dict:
+        per_page = per_page or self.per_page
+        total_pages = max(1, -(-len(items) // per_page))
+        return {
+            'data': items[(page - 1) * per_page:page * per_page],
+            'meta': {'pagination': {
+                'total': len(items), 'count': per_page, 'per_page': per_page,
+                'current_page': page, 'total_pages': total_pages,
+            }},
+            'links': {'self': self.url, 'first': self.url, 'last': self.url},
+        }
+
+    def store_transaction(self, body: dict) -> dict:
+        splits = []
+        for split in body['transactions']:
+            split = dict(split)
+            source_type, destination_type = {
+                'withdrawal': ('asset', 'expense'),
+                'deposit': ('revenue', 'asset'),
+                'transfer': ('asset', 'asset'),
+            }[split['type']]
+            for prefix, account_type in (('source', source_type), ('destination', destination_type)):
+                name = split[f'{prefix}_name']
+                account = self.find_asset_account(name) or self.get_account(name, account_type)
+                split[f'{prefix}_id'] = account['id']
+                split[f'{prefix}_type'] = ACCOUNT_TYPES[account['attributes']['type']]
+                split[f'{prefix}_iban'] = account['attributes']['iban']
+            if split.get('category_name'):
+                split['category_id'] = self.get_category(split['category_name'])['id']
+            splits.append(split)
+
+        transaction_id = str(next(self.ids))
+        transaction = {
+            'type': 'transactions',
+            'id': transaction_id,
+            'attributes': {'transactions': splits},
+            'links': {'0': {'rel': 'self', 'uri': f'/transactions/{transaction_id}'}, 'self': self.url},
+        }
+        self.transactions.append(transaction)
+        return transaction
+
+    def handle(self, method: str, path: str, query: dict, body: Optional[dict]) -> tuple[int, object]:
+        page = int(query.get('page', 1))
+        with self.lock:
+            self.requests += 1
+
+            if method == 'GET' and path == '/api/v1/accounts':
+                accounts = [
+                    account for account in self.accounts.values()
+                    if 'type' not in query or account['attributes']['type'] == query['type']
+                ]
+                return 200, self.page(accounts, page)
+
+            if method == 'GET' and path == '/api/v1/categories':
+                return 200, self.page(list(self.categories.values()), page)
+
+            if method == 'GET' and path == '/api/v1/transactions':
+                transactions = self.transactions
+                if 'start' in query or 'end' in query:
+                    transactions = [
+                        transaction for transaction in transactions
+                        if query.get('start', '') <= transaction['attributes']['transactions'][0]['date'][:10]
+                        <= query.get('end', '9999-12-31')
+                    ]
+                return 200, self.page(transactions, page, int(query.get('limit', 0)))
+
+            if method == 'POST' and path == '/api/v1/transactions':
+                return 200, {'data': self.store_transaction(body)}
+
+            if method == 'GET' and path == '/api/v1/search/transactions':
+                external_id = query.get('query', '').split(':', 1)[-1]
+                return 200, {'data': [
+                    transaction for transaction in self.transactions
+                    if transaction['attributes']['transactions'][0].get('external_id') == external_id
+                ], 'meta': {}, 'links': {}}
+
+            if method == 'GET' and path == '/api/v1/autocomplete/transactions':
+                descriptions = dict.fromkeys(
+                    split['description']
+                    for transaction in self.transactions for split in transaction['attributes']['transactions']
+                )
+                return 200, [
+                    {'id': str(index), 'name': description, 'description': description}
+                    for index, description in enumerate(descriptions)
+                ]
+
+        return 404, {'message': f'{method} {path} is not stubbed'}
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, with Nagle's algorithm every response would wait for a delayed ACK
+    disable_nagle_algorithm = True
+    stub: FireflyStub
+
+    def do_GET(self):
+        self.respond()
+
+    def do_POST(self):
+        self.respond()
+
+    def respond(self):
+        url = urlparse(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+
+        if self.stub.latency:
+            time.sleep(self.stub.latency)
+        status, payload = self.stub.handle(self.command, url.path, query, body)
+
+        content = json.dumps(payload, default=date.isoformat).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,90 @@
+"""
+Resuming an import that died: the import of a synthetic statement stops at row --crash-at (an insert raising
+the way a killed process stops), then the statement gets imported again. Reports the requests and seconds
+of both imports, then what confirming a row costs with the outcomes written to disk after every row against
+every 100 rows.
+
+    python -m benchmarks.import_jobs [--rows 2000] [--crash-at 1400] [--latency-ms 5]
+"""
+import argparse
+import os
+import tempfile
+import time
+from pathlib import Path
+from unittest import mock
+
+from benchmarks.firefly_stub import FireflyStub
+
+IBAN = 'RO49BTRLRONCRT0000000001'
+
+
+class Crash(BaseException):
+    pass
+
+
+def crash_after(function, calls: int):
+    count = 0
+
+    def create_new_transaction(transaction):
+        nonlocal count
+        count += 1
+        if count > calls:
+            raise Crash()
+        return function(transaction)
+    return create_new_transaction
+
+
+def measure_checkpoints(work_dir: Path, rows: int):
+    from firefly_iii_automation.jobs import ImportJob
+    from firefly_iii_automation.ledger_mirror import LedgerMirror
+
+    mirror = LedgerMirror(work_dir / 'jobs.sqlite3')
+    for checkpoint_rows in (1, 100):
+        job = ImportJob(mirror, f'benchmark-{checkpoint_rows}', [], rows, checkpoint_rows)
+        started_at = time.perf_counter()
+        for index in range(rows):
+            job.confirm(f'BENCH{index:08d}', 'inserted', str(index))
+        job.finish()
+        seconds = time.perf_counter() - started_at
+        print(f"  checkpoint every {checkpoint_rows:3} rows: {seconds / rows * 1e6:8.1f} us/row")
+
+
+def run(rows: int, crash_at: int, latency: float):
+    with tempfile.TemporaryDirectory() as directory, FireflyStub({IBAN: 'BT RON'}, latency=latency) as stub:
+        work_dir = Path(directory)
+        os.environ['FIREFLY_III_HOST'] = stub.url
+        os.environ['FIREFLY_III_ACCESS_TOKEN'] = 'benchmark'
+        os.environ['FIREFLY_III_MIRROR_PATH'] = str(work_dir / 'ledger.sqlite3')
+
+        from benchmarks.statements import generate_bt_statement
+        from firefly_iii_automation import automated_scripts
+
+        path = generate_bt_statement(work_dir / 'statement.csv', rows, IBAN)
+
+        started_at = time.perf_counter()
+        with mock.patch.object(automated_scripts, 'create_new_transaction',
+                               crash_after(automated_scripts.create_new_transaction, crash_at)):
+            try:
+                automated_scripts.parse_bt_report(path)
+            except Crash:
+                pass
+        print(f"{rows} rows, the first import dies at row {crash_at + 1}")
+        print(f"  first import:   {stub.requests:5} requests, {time.perf_counter() - started_at:6.2f}s")
+
+        requests = stub.requests
+        started_at = time.perf_counter()
+        automated_scripts.parse_bt_report(path)
+        print(f"  resumed import: {stub.requests - requests:5} requests, {time.perf_counter() - started_at:6.2f}s, "
+              f"{len(stub.transactions)} transactions stored")
+
+        measure_checkpoints(work_dir, rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--crash-at', type=int, default=1400)
+    parser.add_argument('--latency-ms', type=float, default=5)
+    args = parser.parse_args()
+
+    run(args.rows, args.crash_at, args.latency_ms / 1000)
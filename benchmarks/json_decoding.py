@@ -0,0 +1,111 @@
+"""
+CPU the sync client spends on large account and description listings, with the generated models (the
+response validated and turned into model objects) and with the raw JSON fast path (decoded into plain dicts,
+with the standard library and with orjson when it's installed). Only the CPU time of the calling thread is
+counted, the Firefly stub answers from threads of its own.
+
+    python -m benchmarks.json_decoding [--accounts 5000] [--descriptions 20000] [--repeat 3]
+"""
+import argparse
+import logging
+import os
+import time
+from contextlib import nullcontext
+from unittest import mock
+
+from benchmarks.firefly_stub import FireflyStub
+
+IBAN = 'RO49BTRLRONCRT0000000001'
+
+
+def fill_stub(stub: FireflyStub, accounts: int, descriptions: int):
+    for index in range(accounts):
+        stub.get_account(f'Merchant {index:06d}', 'expense')
+    for index in range(descriptions):
+        stub.store_transaction({'transactions': [{
+            'type': 'withdrawal',
+            'date': '2023-01-01T00:00:00+02:00',
+            'amount': '1.00',
+            'description': f'Card payment {index:06d}',
+            'source_name': 'BT RON',
+            'destination_name': f'Merchant {index % max(accounts, 1):06d}',
+            'external_id': f'JSON{index:08d}',
+        }]})
+
+
+def list_accounts(raw: bool) -> int:
+    from firefly_iii_client.api.accounts_api import AccountsApi
+    from firefly_iii_automation.firefly.sync import call, create_api_client
+
+    accounts_api = AccountsApi(create_api_client())
+    count, page, total_pages = 0, 1, 1
+    while page <= total_pages:
+        response = call(accounts_api.list_account, page=page, raw=raw)
+        count += len(response['data'])
+        total_pages = response['meta']['pagination']['total_pages']
+        page += 1
+    return count
+
+
+def list_descriptions(raw: bool) -> int:
+    from firefly_iii_client.api.autocomplete_api import AutocompleteApi
+    from firefly_iii_automation.firefly.sync import call, create_api_client
+
+    response = call(AutocompleteApi(create_api_client()).get_transactions_ac, limit=99999, raw=raw)
+    return len(response if raw else response.value)
+
+
+def measure(function, raw: bool, repeat: int) -> tuple[float, float, int]:
+    """
+    :return: the least CPU and wall seconds of repeat runs, entries fetched
+    """
+    cpu_seconds, wall_seconds = [], []
+    for _ in range(repeat):
+        started_at, cpu_started_at = time.perf_counter(), time.thread_time()
+        count = function(raw)
+        cpu_seconds.append(time.thread_time() - cpu_started_at)
+        wall_seconds.append(time.perf_counter() - started_at)
+    return min(cpu_seconds), min(wall_seconds), count
+
+
+def run(accounts: int, descriptions: int, per_page: int, repeat: int) -> dict:
+    with FireflyStub({IBAN: 'BT RON'}, per_page=per_page) as stub:
+        fill_stub(stub, accounts, descriptions)
+        # the project reads its configuration once, when first imported
+        os.environ['FIREFLY_III_HOST'] = stub.url
+        os.environ['FIREFLY_III_ACCESS_TOKEN'] = 'benchmark'
+        from firefly_iii_automation.utils import json as json_utils
+
+        modes = {
+            'models': (False, nullcontext()),
+            'raw json': (True, mock.patch.object(json_utils, 'orjson', None)),
+        }
+        if json_utils.orjson is not None:
+            modes['raw orjson'] = (True, nullcontext())
+
+        results = {}
+        for listing, function in (('accounts', list_accounts), ('descriptions', list_descriptions)):
+            for mode, (raw, patch) in modes.items():
+                with patch:
+                    results[(listing, mode)] = measure(function, raw, repeat)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--accounts', type=int, default=5000)
+    parser.add_argument('--descriptions', type=int, default=20000)
+    parser.add_argument('--per-page', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    results = run(args.accounts, args.descriptions, args.per_page, args.repeat)
+
+    print(f"{'listing':13} {'mode':11} {'entries':>8} {'cpu ms':>9} {'wall ms':>9} {'cpu saved':>10}")
+    for (listing, mode), (cpu_seconds, wall_seconds, count) in results.items():
+        baseline = results[(listing, 'models')][0]
+        print(
+            f"{listing:13} {mode:11} {count:8} {cpu_seconds * 1000:9.1f} {wall_seconds * 1000:9.1f} "
+            f"{1 - cpu_seconds / baseline:10.0%}"
+        )
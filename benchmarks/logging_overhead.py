@@ -0,0 +1,90 @@
+"""
+Time the calling thread (the event loop, during an import) spends logging the rows of an import: a line
+per row outcome, formatted with f-strings and written by the caller as the imports used to, against row
+summaries through the queue handler, formatted and written by its background thread. Lines go to /dev/null.
+
+    python -m benchmarks.logging_overhead [--rows 10000] [--every 1000]
+"""
+import argparse
+import logging
+import os
+import queue
+import time
+from logging.handlers import QueueListener
+
+os.environ.setdefault('FIREFLY_III_HOST', 'http://localhost')
+os.environ.setdefault('FIREFLY_III_ACCESS_TOKEN', 'benchmark')
+
+from firefly_iii_automation.log import TEXT_FORMAT, JsonFormatter, LocalQueueHandler, RowLog  # noqa: E402
+from firefly_iii_automation.utils.json import dumps  # noqa: E402
+
+RESPONSE = {
+    'type': 'transactions', 'id': '1',
+    'attributes': {'transactions': [{
+        'type': 'withdrawal', 'date': '2023-01-01T00:00:00+02:00', 'amount': '12.00', 'description': 'Plata',
+        'source_name': 'BT RON', 'destination_name': 'Merchant', 'external_id': 'BENCH00000000',
+        'notes': 'Plata la POS non-BT cu card VISA;POS 01/01/2023 TID:ABC123 MERCHANT  RRN:000000000000',
+    }]},
+}
+
+
+def log_rows_synchronously(logger: logging.Logger, rows: int):
+    for index in range(rows):
+        external_id = f'BENCH{index:08d}'
+        logger.info(f"Transaction with external id {external_id} doesn't exist")
+        logger.info(f"Inserting transaction with external id:\t{external_id}")
+        logger.info(f"Insertion response for external id {dumps(RESPONSE)}")
+        logger.info(f"Transaction with external id {external_id} successfully inserted")
+
+
+def log_rows_summarized(logger: logging.Logger, rows: int, every: int):
+    row_log = RowLog(logger, 'Import of benchmark.csv', every)
+    for index in range(rows):
+        external_id = f'BENCH{index:08d}'
+        logger.debug("Inserting transaction with external id %s", external_id)
+        row_log.add('inserted', "Transaction with external id %s successfully inserted", external_id)
+    row_log.close()
+
+
+def measure(function, *args) -> float:
+    """
+    :return: CPU seconds of the calling thread
+    """
+    started_at = time.thread_time()
+    function(*args)
+    return time.thread_time() - started_at
+
+
+def run(rows: int, every: int):
+    results = {}
+    with open(os.devnull, 'w') as devnull:
+        logger = logging.getLogger('benchmark')
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+
+        for name, formatter in (('text', logging.Formatter(TEXT_FORMAT)), ('json', JsonFormatter())):
+            handler = logging.StreamHandler(devnull)
+            handler.setFormatter(formatter)
+
+            logger.handlers = [handler]
+            results[f'synchronous {name}'] = measure(log_rows_synchronously, logger, rows)
+
+            records = queue.SimpleQueue()
+            listener = QueueListener(records, handler)
+            logger.handlers = [LocalQueueHandler(records)]
+            listener.start()
+            results[f'queued summaries {name}'] = measure(log_rows_summarized, logger, rows, every)
+            listener.stop()
+
+    print(f"{rows} rows, a summary every {every}")
+    for name, seconds in results.items():
+        print(f"  {name:24} {seconds * 1000:8.1f} ms ({seconds / rows * 1e6:.2f} us/row)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--every', type=int, default=1000)
+    args = parser.parse_args()
+
+    run(args.rows, args.every)
@@ -0,0 +1,111 @@
+"""
+Memory and conversion cost of FireflyTransaction against the plain dataclass it replaced.
+
+    python -m benchmarks.models [--count 100000]
+"""
+import argparse
+import enum
+import os
+import time
+import tracemalloc
+from copy import deepcopy
+from dataclasses import dataclass, field, asdict
+from datetime import datetime, timedelta
+from typing import Optional
+
+import maya
+
+os.environ.setdefault('FIREFLY_III_HOST', 'http://localhost')
+os.environ.setdefault('FIREFLY_III_ACCESS_TOKEN', 'benchmark')
+
+from firefly_iii_automation.models import FireflyTransaction, FireflyTransactionTypes  # noqa: E402
+
+
+@dataclass()
+class LegacyFireflyTransaction:
+    """
+    The model before slots and copy-free conversions, verbatim minus to_transaction_store
+    """
+    external_id: str
+    description: str
+    date: datetime
+    source_account: str
+    destination_account: str
+    amount: float
+    type: enum.Enum
+    tags: list[str] = field(default_factory=lambda: ['python-script'])
+    category_name: Optional[str] = None
+    currency_code: Optional[str] = None
+    foreign_amount: Optional[str] = None
+    foreign_currency_code: Optional[str] = None
+    notes: Optional[str] = None
+
+    def to_dict(self):
+        clone = deepcopy(self)
+        clone.type = clone.type.value
+        return asdict(clone)
+
+    @classmethod
+    def from_dict(cls, dict):
+        dict_clone = deepcopy(dict)
+        dict_clone['type'] = FireflyTransactionTypes[dict_clone['type'].upper()]
+
+        instance = cls(**dict_clone)
+        if isinstance(instance.date, str):
+            instance.date = maya.parse(instance.date).datetime()
+        return instance
+
+
+def build(cls, count: int):
+    start = datetime(2020, 1, 1)
+    return [
+        cls(
+            external_id=f'REF{index:08d}',
+            description='Megaimage cumparaturi',
+            date=start + timedelta(days=index % 1000),
+            source_account='BT RON',
+            destination_account='Megaimage',
+            amount=12.5,
+            type=FireflyTransactionTypes.WITHDRAWAL,
+            category_name='Groceries',
+            currency_code='RON',
+            notes=f'Plata la POS;POS 02/01/2023 TID:X1 MEGAIMAGE {index}  RRN',
+        )
+        for index in range(count)
+    ]
+
+
+def measure(cls, count: int):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    transactions = build(cls, count)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    # includes the per-row strings and datetimes, which are the same for both models
+    bytes_per_object = (after - before) / count
+
+    started_at = time.perf_counter()
+    dicts = [transaction.to_dict() for transaction in transactions]
+    to_dict_seconds = time.perf_counter() - started_at
+
+    for transaction_dict in dicts:
+        transaction_dict['date'] = transaction_dict['date'].isoformat()
+    started_at = time.perf_counter()
+    for transaction_dict in dicts:
+        cls.from_dict(transaction_dict)
+    from_dict_seconds = time.perf_counter() - started_at
+
+    return bytes_per_object, to_dict_seconds / count * 1e6, from_dict_seconds / count * 1e6
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=100000)
+    args = parser.parse_args()
+
+    print(f"{args.count} transactions")
+    print(f"  {'':8} {'bytes/object':>14} {'to_dict us':>12} {'from_dict us':>14}")
+    for name, cls in (('legacy', LegacyFireflyTransaction), ('current', FireflyTransaction)):
+        bytes_per_object, to_dict_us, from_dict_us = measure(cls, args.count)
+        print(f"  {name:8} {bytes_per_object:14.0f} {to_dict_us:12.2f} {from_dict_us:14.2f}")
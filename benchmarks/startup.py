@@ -0,0 +1,87 @@
+"""
+Cold start of the Wave app: how long importing firefly_iii_automation.wave_app takes in a fresh interpreter,
+and the modules costing the most of it. Exits with status 1 when the import takes longer than the budget, or
+when a module that's meant to load on first use (the generated Firefly client, maya, numpy) got imported,
+so it can guard against startup regressions.
+
+    python -m benchmarks.startup [--runs 5] [--budget-ms 350] [--top 15]
+"""
+import argparse
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+MODULE = 'firefly_iii_automation.wave_app'
+# loaded on first use, importing the app must not load them
+LAZY_MODULES = ('firefly_iii_client', 'maya', 'numpy')
+
+PROBE = f'''
+import sys, time
+started_at = time.perf_counter()
+import {MODULE}
+print(time.perf_counter() - started_at)
+print(','.join(module for module in {LAZY_MODULES!r} if module in sys.modules))
+'''
+
+
+def get_environment() -> dict:
+    environment = dict(os.environ)
+    environment.setdefault('FIREFLY_III_HOST', 'http://localhost')
+    environment.setdefault('FIREFLY_III_ACCESS_TOKEN', 'benchmark')
+    return environment
+
+
+def measure_import() -> tuple[float, list[str]]:
+    """
+    :return: seconds the import took in a fresh interpreter, lazy modules it loaded anyway
+    """
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE], env=get_environment(), cwd=Path(__file__).parent.parent,
+        capture_output=True, text=True, check=True,
+    ).stdout.splitlines()
+    return float(output[-2]), [module for module in output[-1].split(',') if module]
+
+
+def profile_import(top: int) -> list[tuple[int, str]]:
+    """
+    :return: the top modules by cumulative import time (microseconds), from python -X importtime
+    """
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {MODULE}'], env=get_environment(),
+        cwd=Path(__file__).parent.parent, capture_output=True, text=True, check=True,
+    ).stderr
+
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        modules.append((int(cumulative), name.rstrip()))
+    return sorted(modules, reverse=True)[:top]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=350)
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+
+    # the fastest run is the least disturbed by whatever else the machine is doing
+    runs = [measure_import() for _ in range(args.runs)]
+    seconds = min(run_seconds for run_seconds, _ in runs)
+    loaded = sorted({module for _, modules in runs for module in modules})
+
+    print(f"import {MODULE}: {seconds * 1000:.0f} ms (best of {args.runs}), budget {args.budget_ms:g} ms")
+    for cumulative, name in profile_import(args.top):
+        print(f"  {cumulative / 1000:8.1f} ms {name}")
+
+    failed = False
+    if seconds * 1000 > args.budget_ms:
+        print(f"Cold start is over the budget by {seconds * 1000 - args.budget_ms:.0f} ms")
+        failed = True
+    if loaded:
+        print(f"Modules meant to load on first use got imported: {', '.join(loaded)}")
+        failed = True
+    sys.exit(1 if failed else 0)
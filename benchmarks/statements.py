@@ -0,0 +1,105 @@
+"""
+Synthetic BT statements in the format parse_bt_transaction_report expects, with a merchant mix taken
+from the categorization rules.
+
+    python -m benchmarks.statements statement.csv [--rows 1000] [--iban RO49BTRL...] [--currency RON]
+"""
+import argparse
+import os
+import random
+from datetime import date, timedelta
+from pathlib import Path
+
+os.environ.setdefault('FIREFLY_III_HOST', 'http://localhost')
+os.environ.setdefault('FIREFLY_III_ACCESS_TOKEN', 'benchmark')
+
+from firefly_iii_automation.transactions_parsers.bt import (  # noqa: E402
+    CATEGORIES_STRINGS_MAPS, HEADER_LINES, TRANSFER_MARKER
+)
+
+COLUMNS = 'Data tranzactie,Data valuta,Descriere,Referinta tranzactiei,Debit,Credit,Sold contabil'
+UNKNOWN_MERCHANTS = ['LA DOI PASI', 'FLORARIA ROZA', 'CAFENEAUA VERDE', 'PARCARE CENTRU', 'SPALATORIE AUTO']
+SENDERS = ['ION POPESCU', 'MARIA IONESCU', 'ANDREI POPA']
+
+# share of the rows of each kind, the rest are card payments to merchants the rules know
+UNKNOWN_MERCHANT_SHARE = 0.10
+INCOMING_TRANSFER_SHARE = 0.08
+INTERNAL_TRANSFER_SHARE = 0.05
+
+
+def build_header(iban: str, currency_code: str) -> list[str]:
+    lines = ['Banca Transilvania', 'Extras de cont', '', 'Client,BENCHMARK', '',
+             f'Numar cont,{iban} {currency_code}']
+    return lines + [''] * (HEADER_LINES - len(lines))
+
+
+def build_card_payment(rng: random.Random, day: date, merchant: str) -> str:
+    return (
+        f'Plata la POS non-BT cu card VISA;POS {day:%d/%m/%Y} TID:{rng.randrange(16 ** 6):06X} '
+        f'{merchant}  RRN:{rng.randrange(10 ** 12):012d}'
+    )
+
+
+def generate_rows(rng: random.Random, rows: int, start: date, days: int, reference_prefix: str):
+    merchants = [string for strings in CATEGORIES_STRINGS_MAPS.values() for string in strings]
+    balance = 10000.0
+
+    for index in range(rows):
+        day = start + timedelta(days=index * days // max(rows, 1))
+        kind = rng.random()
+        debit, credit = '', ''
+
+        if kind < INCOMING_TRANSFER_SHARE:
+            description = (
+                f'Incasare OP;Transfer din card {rng.randrange(10 ** 4):04d} {rng.choice(SENDERS)} '
+                f'catre cont {rng.randrange(10 ** 6)}'
+            )
+            amount = rng.uniform(50, 3000)
+            credit = f'{amount:.2f}'
+            balance += amount
+        else:
+            if kind < INCOMING_TRANSFER_SHARE + INTERNAL_TRANSFER_SHARE:
+                description = f'{TRANSFER_MARKER};economii {rng.randrange(10 ** 6)}'
+            elif kind < INCOMING_TRANSFER_SHARE + INTERNAL_TRANSFER_SHARE + UNKNOWN_MERCHANT_SHARE:
+                description = build_card_payment(rng, day, rng.choice(UNKNOWN_MERCHANTS))
+            else:
+                description = build_card_payment(rng, day, rng.choice(merchants))
+            # spread wide enough to hit both sides of the rules' debit thresholds
+            amount = rng.lognormvariate(3.5, 1.0)
+            debit = f'-{amount:.2f}'
+            balance -= amount
+
+        description = description.replace('"', '')
+        yield f'{day},{day},"{description}",{reference_prefix}{index:08d},{debit},{credit},{balance:.2f}'
+
+
+def generate_bt_statement(path: Path, rows: int, iban: str = 'RO49BTRLRONCRT0000000001', currency_code: str = 'RON',
+                          start: date = date(2023, 1, 1), days: int = 30, reference_prefix: str = 'BENCH',
+                          seed: int = 0) -> Path:
+    """
+    Write a statement of rows transactions spread over days days from start
+    :param reference_prefix: start of every row's reference (the Firefly external id), keep it unique per statement
+    """
+    rng = random.Random(seed)
+    path = Path(path)
+    with path.open('w', newline='') as f:
+        f.write('\n'.join(build_header(iban, currency_code)) + '\n')
+        f.write(COLUMNS + '\n')
+        for row in generate_rows(rng, rows, start, days, reference_prefix):
+            f.write(row + '\n')
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', type=Path)
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--iban', default='RO49BTRLRONCRT0000000001')
+    parser.add_argument('--currency', default='RON')
+    parser.add_argument('--reference-prefix', default='BENCH')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    generate_bt_statement(args.path, args.rows, args.iban, args.currency, reference_prefix=args.reference_prefix,
+                          seed=args.seed)
+    print(f"Wrote {args.rows} transactions to {args.path}")
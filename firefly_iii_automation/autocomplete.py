@@ -0,0 +1,169 @@
+import bisect
+import heapq
+import math
+from dataclasses import dataclass
+from datetime import date
+from typing import Iterable, Iterator, Optional
+
+# days after which a use counts half as much towards an entry's rank
+RECENCY_HALF_LIFE_DAYS = 90
+# keys per block of a SortedKeys, what an insert moves at most
+KEYS_BLOCK_SIZE = 512
+
+
+@dataclass(slots=True)
+class AutocompleteEntry:
+    name: str
+    uses: int = 0
+    last_used: Optional[date] = None
+
+    def rank(self) -> float:
+        """
+        log2 of the uses, each counting half as much every RECENCY_HALF_LIFE_DAYS before the last one. Every
+        entry's weight decays by the same factor as days go by, so entries only change places when they get used.
+        """
+        if not self.uses:
+            return -math.inf
+        last_used = self.last_used or date.today()
+        return math.log2(self.uses) + last_used.toordinal() / RECENCY_HALF_LIFE_DAYS
+
+
+class SortedKeys:
+    """
+    Sorted list kept in blocks of at most KEYS_BLOCK_SIZE keys: an insert is a bisection of the blocks' last keys,
+    then of a single block, whose keys it moves, instead of moving the keys of the whole list
+    """
+
+    def __init__(self, keys: Iterable = ()):
+        keys = sorted(keys)
+        # half full, so inserts don't split every block right away
+        size = KEYS_BLOCK_SIZE // 2
+        self.blocks = [keys[start:start + size] for start in range(0, len(keys), size)]
+        self.maxes = [block[-1] for block in self.blocks]
+
+    def add(self, key):
+        if not self.blocks:
+            self.blocks.append([key])
+            self.maxes.append(key)
+            return
+
+        index = min(bisect.bisect_left(self.maxes, key), len(self.blocks) - 1)
+        block = self.blocks[index]
+        bisect.insort(block, key)
+        self.maxes[index] = block[-1]
+        if len(block) > KEYS_BLOCK_SIZE:
+            half = len(block) // 2
+            self.blocks[index:index + 1] = [block[:half], block[half:]]
+            self.maxes[index:index + 1] = [block[half - 1], block[-1]]
+
+    def iter_from(self, key) -> Iterator:
+        """
+        The keys from key onwards, in order
+        """
+        index = bisect.bisect_left(self.maxes, key)
+        if index == len(self.blocks):
+            return
+        block = self.blocks[index]
+        for position in range(bisect.bisect_left(block, key), len(block)):
+            yield block[position]
+        for index in range(index + 1, len(self.blocks)):
+            yield from self.blocks[index]
+
+
+class AutocompleteIndex:
+    """
+    Names (descriptions, accounts or categories) kept sorted case-insensitively for prefix lookups,
+    ranked by how often and how recently they got used.
+    The best ranked names of every prefix looked up (and of all names, the '' prefix) are kept once found, and
+    add moves a name up the ones it's in, so a suggestion costs nothing after the first one of its prefix.
+    Updated in place after inserts, so only use it from the event loop.
+    """
+
+    def __init__(self, names: Iterable[str] = (), usages: Optional[dict[str, tuple[int, str]]] = None):
+        self.entries: dict[str, AutocompleteEntry] = {}
+        for name in names:
+            self.entries[name] = AutocompleteEntry(name)
+        for name, (uses, last_used) in (usages or {}).items():
+            self.entries[name] = AutocompleteEntry(name, uses, date.fromisoformat(last_used))
+
+        self.keys = SortedKeys((name.casefold(), name) for name in self.entries)
+        # casefolded prefix -> how many entries it was ranked for, its best ranked entries
+        self.rankings: dict[str, tuple[int, list[AutocompleteEntry]]] = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name: str):
+        return name in self.entries
+
+    def add(self, name: str, used_on: Optional[date] = None):
+        """
+        Record a use of name, adding it to the index if it's new
+        """
+        if not name:
+            return
+
+        entry = self.entries.get(name)
+        if entry is None:
+            entry = self.entries[name] = AutocompleteEntry(name)
+            self.keys.add((name.casefold(), name))
+
+        used_on = used_on or date.today()
+        entry.uses += 1
+        entry.last_used = max(entry.last_used, used_on) if entry.last_used else used_on
+
+        key = name.casefold()
+        for length in range(len(key) + 1):
+            if key[:length] in self.rankings:
+                self.promote(key[:length], entry)
+
+    def promote(self, prefix: str, entry: AutocompleteEntry):
+        """
+        Move an entry whose rank just grew to its place among the best ranked ones of prefix
+        """
+        limit, ranking = self.rankings[prefix]
+        rank = entry.rank()
+        index = next((index for index, ranked in enumerate(ranking) if ranked is entry), None)
+        if index is not None:
+            del ranking[index]
+        elif len(ranking) >= limit and rank <= ranking[-1].rank():
+            return
+
+        position = next((index for index, ranked in enumerate(ranking) if ranked.rank() < rank), len(ranking))
+        ranking.insert(position, entry)
+        del ranking[limit:]
+
+    def prefixed(self, prefix: str) -> Iterator[AutocompleteEntry]:
+        prefix = prefix.casefold()
+        for key, name in self.keys.iter_from((prefix,)):
+            if not key.startswith(prefix):
+                break
+            yield self.entries[name]
+
+    def ranked(self, prefix: str, limit: int) -> list[AutocompleteEntry]:
+        """
+        The best ranked limit entries starting with prefix. The first lookup of a prefix ranks every entry
+        starting with it, the next ones reuse that ranking.
+        """
+        prefix = prefix.casefold()
+        cached = self.rankings.get(prefix)
+        if cached is None or cached[0] < limit:
+            entries = self.prefixed(prefix) if prefix else self.entries.values()
+            cached = self.rankings[prefix] = (limit, heapq.nlargest(limit, entries, key=AutocompleteEntry.rank))
+        return cached[1][:limit]
+
+    def popular(self, limit: int) -> list[str]:
+        return [entry.name for entry in self.ranked('', limit)]
+
+    def suggest(self, value: Optional[str], limit: int) -> list[str]:
+        """
+        At most limit names for a form field currently holding value: value itself, then the best ranked
+        names sharing its first word, then the best ranked names overall
+        """
+        suggestions = [value] if value else []
+
+        if value and value.split():
+            suggestions += [entry.name for entry in self.ranked(value.split()[0], limit)]
+
+        suggestions += self.popular(limit)
+        return list(dict.fromkeys(suggestions))[:limit]
@@ -1,40 +1,289 @@
+import asyncio
 import logging
+import time
+from collections import defaultdict
+from dataclasses import asdict, dataclass, field
 from pathlib import Path
+from typing import Optional
 
+import anyio
+
+from firefly_iii_automation.categorization import CategorizationIndex, get_categorization_index
+from firefly_iii_automation.dedup import (
+    SkipRanges, advance_watermarks, build_duplicate_index, build_external_ids_index,
+    get_asset_account_key, get_statement_rows, get_statement_window, get_watermark_skip_ranges, needs_review
+)
+from firefly_iii_automation.env import FIREFLY_III_MAX_IN_FLIGHT
 from firefly_iii_automation.exceptions import NoMatchingAccount
-from firefly_iii_automation.firefly import get_all_asset_accounts, find_transaction_by_external_id, \
-    create_new_transaction
+from firefly_iii_automation.firefly import _async
+from firefly_iii_automation.firefly.sync import (
+    create_new_transaction, refresh_accounts, refresh_transactions, sync_ledger_mirror
+)
+from firefly_iii_automation.jobs import ImportJob
+from firefly_iii_automation.log import RowLog
+from firefly_iii_automation.models import FireflyTransactionTypes, FireflyTransaction
 from firefly_iii_automation.transactions_parsers import parse_bt_transaction_report
+from firefly_iii_automation.transactions_parsers.parallel import parse_bt_reports_async
 
 logger = logging.getLogger(__name__)
 
 
-def parse_bt_report(path: Path):
-    accounts = {
+@dataclass()
+class ImportReport:
+    inserted: int = 0
+    skipped_existing: int = 0
+    # matched to a transaction in Firefly or of another statement by amount, date and accounts
+    skipped_duplicates: int = 0
+    # done by the interrupted import of the same reports, which this one resumed
+    resumed: int = 0
+    failed: int = 0
+    failed_external_ids: list[str] = field(default_factory=list)
+    # transfers matched to one in Firefly on amount and date only, neither inserted nor skipped (see needs_review)
+    review_external_ids: list[str] = field(default_factory=list)
+    # wall-clock seconds per stage
+    timings: dict[str, float] = field(default_factory=dict)
+
+
+async def read_bt_report(path: Path, columnar: bool = False, skip_ranges: Optional[SkipRanges] = None,
+                         categorization_index: Optional[CategorizationIndex] = None):
+    """
+    :param columnar: parse with the NumPy based columnar parser, for very large reports
+    :param skip_ranges: IBAN -> first and last date of the rows to leave out (already imported)
+    :param categorization_index: what got learned from the Firefly history, see get_categorization_index
+    """
+    async with await anyio.open_file(path) as f:
+        if columnar:
+            # numpy is optional, only needed for this mode
+            from firefly_iii_automation.transactions_parsers.bt_columnar import parse_bt_transaction_report_columnar
+            return list(parse_bt_transaction_report_columnar(await f.read(), skip_ranges, categorization_index))
+
+        return [
+            transaction async for transaction in parse_bt_transaction_report(f, skip_ranges, categorization_index)
+        ]
+
+
+def resolve_asset_account(transaction: FireflyTransaction, accounts: dict):
+    """
+    Replace the statement's IBAN on the transaction with the name of the matching Firefly asset account
+    """
+    account = accounts.get(get_asset_account_key(transaction))
+
+    if not account:
+        raise NoMatchingAccount(
+            f"No matching account '{get_asset_account_key(transaction)}' exists in Firefly for transaction "
+            f"external id {transaction.external_id}"
+        )
+    elif transaction.type is FireflyTransactionTypes.DEPOSIT:
+        transaction.destination_account = account['attributes']['name']
+    else:
+        transaction.source_account = account['attributes']['name']
+
+
+def get_asset_accounts_by_iban(mirror):
+    return {
         account['attributes'].get('iban') or account['attributes'].get('name'): account
-        for account in get_all_asset_accounts()
+        for account in mirror.get_asset_accounts()
     }
 
-    with path.open() as f:
-        transactions = parse_bt_transaction_report(f)
 
+def has_missing_accounts(statement_rows: dict, accounts: dict) -> bool:
+    """
+    Whether a statement's account isn't among the mirrored ones, which are only re-read every
+    FIREFLY_III_MIRROR_MAX_AGE: it may have been created in Firefly since
+    """
+    return bool(statement_rows.keys() - accounts.keys())
+
+
+def parse_bt_report(path: Path, columnar: bool = False):
+    mirror = sync_ledger_mirror()
+
+    # rows older than the accounts' watermarks were imported before, they're left out right away
+    transactions = asyncio.run(
+        read_bt_report(path, columnar, get_watermark_skip_ranges(mirror), get_categorization_index())
+    )
+    statement_rows = get_statement_rows(transactions)
+    accounts = get_asset_accounts_by_iban(mirror)
+    if has_missing_accounts(statement_rows, accounts):
+        accounts = get_asset_accounts_by_iban(refresh_accounts())
+    if transactions:
+        # transactions created in Firefly since the last sync may be dated before it
+        refresh_transactions(*get_statement_window(transactions))
+    existing_external_ids = build_external_ids_index(transactions, mirror)
+    duplicates = build_duplicate_index(transactions, mirror)
+    rows = RowLog(logger, f"Import of {path}")
+    job = ImportJob.open(mirror, [path], len(transactions))
+    review_external_ids = set()
+
+    try:
+        for transaction in transactions:
+            statement_account = get_asset_account_key(transaction)
+            resolve_asset_account(transaction, accounts)
+
+            if job.is_confirmed(transaction.external_id):
+                job.resume(transaction, statement_account, duplicates)
+                rows.add('resumed', "Transaction with external id %s was done before", transaction.external_id)
+            elif transaction.external_id in existing_external_ids:
+                job.confirm(transaction.external_id, 'existing')
+                rows.add('existing', "Transaction with external id %s already exists", transaction.external_id)
+            elif duplicate := duplicates.find(transaction, statement_account):
+                if needs_review(transaction, duplicate):
+                    review_external_ids.add(transaction.external_id)
+                    rows.add('review', "Transaction with external id %s may duplicate %s, left for review",
+                             transaction.external_id, duplicate.describe())
+                else:
+                    job.confirm(transaction.external_id, 'duplicate')
+                    rows.add('duplicate', "Transaction with external id %s duplicates %s", transaction.external_id,
+                             duplicate.describe())
+            else:
+                stored = create_new_transaction(transaction)
+                job.confirm(transaction.external_id, 'inserted', stored['id'])
+                existing_external_ids.add(transaction.external_id)
+                duplicates.add(transaction, statement_account)
+                rows.add('inserted', "Transaction with external id %s successfully inserted", transaction.external_id)
+    finally:
+        job.checkpoint()
+
+    # rows left for review aren't confirmed, importing the report again picks them up
+    if not review_external_ids:
+        job.finish()
+    rows.close()
+    advance_watermarks(mirror, statement_rows, review_external_ids)
+
+
+def batch_import_bt_report(path: Path, max_in_flight: int = FIREFLY_III_MAX_IN_FLIGHT,
+                           columnar: bool = False) -> ImportReport:
+    """
+    Headless import of a BT report with up to max_in_flight concurrent inserts.
+    Failed rows are counted in the report instead of stopping the import.
+    """
+    return batch_import_bt_reports([path], max_in_flight, columnar)
+
+
+def batch_import_bt_reports(paths: list[Path], max_in_flight: int = FIREFLY_III_MAX_IN_FLIGHT,
+                            columnar: bool = False) -> ImportReport:
+    """
+    Headless import of several BT reports at once (e.g. the RON and EUR accounts' statements of a month),
+    parsed in parallel processes and merged on external id
+    """
+    return asyncio.run(_batch_import_bt_reports(paths, max_in_flight, columnar))
+
+
+async def _batch_import_bt_reports(paths: list[Path], max_in_flight: int, columnar: bool) -> ImportReport:
+    try:
+        return await import_bt_reports(paths, max_in_flight, columnar)
+    finally:
+        await _async.close_api_client()
+
+
+async def import_bt_reports(paths: list[Path], max_in_flight: int = FIREFLY_III_MAX_IN_FLIGHT,
+                            columnar: bool = False) -> ImportReport:
+    """
+    The batch import, from within a running event loop. The process' Firefly client is left open for the
+    next imports, closing it is up to the caller.
+    """
+    report = ImportReport()
+    rows = RowLog(logger, f"Import of {', '.join(map(str, paths))}")
+    started_at = time.perf_counter()
+
+    stage_started_at = time.perf_counter()
+    mirror = await _async.sync_ledger_mirror()
+    report.timings['sync'] = time.perf_counter() - stage_started_at
+
+    stage_started_at = time.perf_counter()
+    categorization_index = await anyio.to_thread.run_sync(get_categorization_index)
+    transactions = await parse_bt_reports_async(
+        paths, columnar, get_watermark_skip_ranges(mirror), categorization_index
+    )
+    statement_rows = get_statement_rows(transactions)
+    report.timings['parse'] = time.perf_counter() - stage_started_at
+
+    job = await anyio.to_thread.run_sync(ImportJob.open, mirror, paths, len(transactions))
+    try:
+        stage_started_at = time.perf_counter()
+        accounts = get_asset_accounts_by_iban(mirror)
+        if has_missing_accounts(statement_rows, accounts):
+            accounts = get_asset_accounts_by_iban(await _async.refresh_accounts())
+        if transactions:
+            # transactions created in Firefly since the last sync may be dated before it
+            await _async.refresh_transactions(*get_statement_window(transactions))
+        existing_external_ids = build_external_ids_index(transactions, mirror)
+        duplicates = build_duplicate_index(transactions, mirror)
+        lanes = defaultdict(list)
+        for transaction in transactions:
+            if transaction.external_id in existing_external_ids and not job.is_confirmed(transaction.external_id):
+                job.confirm(transaction.external_id, 'existing')
+                report.skipped_existing += 1
+                rows.add('existing', "Transaction with external id %s already exists", transaction.external_id)
+                continue
+
+            existing_external_ids.add(transaction.external_id)
+            statement_account = get_asset_account_key(transaction)
+            try:
+                resolve_asset_account(transaction, accounts)
+            except NoMatchingAccount as ex:
+                logger.error(ex)
+                rows.add('failed', "Transaction with external id %s has no asset account", transaction.external_id)
+                report.failed += 1
+                report.failed_external_ids.append(transaction.external_id)
+                continue
+
+            if job.is_confirmed(transaction.external_id):
+                job.resume(transaction, statement_account, duplicates)
+                report.resumed += 1
+                rows.add('resumed', "Transaction with external id %s was done before", transaction.external_id)
+            elif duplicate := duplicates.find(transaction, statement_account):
+                if needs_review(transaction, duplicate):
+                    rows.add('review', "Transaction with external id %s may duplicate %s, left for review",
+                             transaction.external_id, duplicate.describe())
+                    report.review_external_ids.append(transaction.external_id)
+                else:
+                    job.confirm(transaction.external_id, 'duplicate')
+                    rows.add('duplicate', "Transaction with external id %s duplicates %s", transaction.external_id,
+                             duplicate.describe())
+                    report.skipped_duplicates += 1
+            else:
+                duplicates.add(transaction, statement_account)
+                lanes[get_asset_account_key(transaction)].append(transaction)
+        report.timings['dedup'] = time.perf_counter() - stage_started_at
+
+        stage_started_at = time.perf_counter()
+        in_flight = asyncio.Semaphore(max_in_flight)
+        await asyncio.gather(*(insert_lane(lane, in_flight, report, rows, job) for lane in lanes.values()))
+        report.timings['insert'] = time.perf_counter() - stage_started_at
+    finally:
+        job.checkpoint()
+
+    # failed rows and the ones left for review aren't confirmed, importing the reports again picks them up
+    if not report.failed and not report.review_external_ids:
+        job.finish()
+    advance_watermarks(mirror, statement_rows, {*report.failed_external_ids, *report.review_external_ids})
+    report.timings['total'] = time.perf_counter() - started_at
+    rows.close()
+    logger.info(
+        "Imported %s: %d inserted, %d already existing, %d duplicates, %d done before, %d left for review, "
+        "%d failed in %.2fs", ', '.join(map(str, paths)), report.inserted, report.skipped_existing,
+        report.skipped_duplicates, report.resumed, len(report.review_external_ids), report.failed,
+        report.timings['total'], extra={'report': asdict(report)},
+    )
+    return report
+
+
+async def insert_lane(transactions: list[FireflyTransaction], in_flight: asyncio.Semaphore, report: ImportReport,
+                      rows: RowLog, job: ImportJob):
+    """
+    Insert the transactions of one account one at a time, in statement order, so its balance is built up the
+    way parse_bt_report does; only the lanes of different accounts run concurrently
+    """
     for transaction in transactions:
-        account = accounts.get(transaction.source_account)
-
-        if not account:
-            raise NoMatchingAccount(
-                f"No matching account '{transaction.source_account}' exists in Firefly for transaction "
-                f"external id {transaction.external_id}"
-            )
-        else:
-            transaction.source_account = account['attributes']['name']
-
-        logger.info(f'Checking if transaction with external id exists:\t{transaction.external_id}')
-        existing_transaction = find_transaction_by_external_id(transaction.external_id)
-
-        if existing_transaction:
-            logger.info(f"Transaction with external id {transaction.external_id} already exists!")
-        else:
-            logger.info(f"Transaction with external id {transaction.external_id} doesn't exist")
-            create_new_transaction(transaction)
-            logger.info(f"Transaction with external id {transaction.external_id} successfully inserted")
+        async with in_flight:
+            try:
+                stored = await _async.create_new_transaction(transaction)
+            except Exception as ex:
+                logger.exception(ex)
+                rows.add('failed', "Transaction with external id %s failed to insert", transaction.external_id)
+                report.failed += 1
+                report.failed_external_ids.append(transaction.external_id)
+            else:
+                job.confirm(transaction.external_id, 'inserted', stored['id'])
+                rows.add('inserted', "Transaction with external id %s successfully inserted", transaction.external_id)
+                report.inserted += 1
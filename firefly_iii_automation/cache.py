@@ -0,0 +1,99 @@
+import asyncio
+import functools
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+
+from . import metrics
+from .env import FIREFLY_III_CACHE_TTL, FIREFLY_III_CACHE_MAX_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+class ReferenceDataCache:
+    """
+    Process wide cache for reference data (accounts, categories, descriptions) shared by every session.
+    Entries older than ttl seconds are still served while they get reloaded in the background
+    (stale-while-revalidate); past max_size entries the least recently used one is evicted.
+    Cached values are shared, only ones meant for it (like AutocompleteIndex) may be updated in place.
+    """
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries: OrderedDict[str, tuple[Any, float]] = OrderedDict()
+        self.loading: dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.loads = 0
+
+    async def get(self, key: str, loader: Callable[[], Awaitable[Any]]):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            metrics.CACHE_LOOKUPS.inc(key=key, result='miss')
+            return await asyncio.shield(self.load(key, loader))
+
+        value, loaded_at = entry
+        self.entries.move_to_end(key)
+        if time.monotonic() - loaded_at > self.ttl:
+            self.stale_hits += 1
+            metrics.CACHE_LOOKUPS.inc(key=key, result='stale')
+            self.load(key, loader)
+        else:
+            self.hits += 1
+            metrics.CACHE_LOOKUPS.inc(key=key, result='hit')
+        return value
+
+    def load(self, key: str, loader: Callable[[], Awaitable[Any]]) -> asyncio.Task:
+        task = self.loading.get(key)
+        if task is None:
+            task = asyncio.create_task(self.fetch(key, loader))
+            self.loading[key] = task
+            task.add_done_callback(functools.partial(self.loaded, key))
+        return task
+
+    async def fetch(self, key: str, loader: Callable[[], Awaitable[Any]]):
+        with metrics.CACHE_LOAD_SECONDS.time(key=key):
+            value = await loader()
+        self.loads += 1
+
+        self.entries[key] = (value, time.monotonic())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return value
+
+    def loaded(self, key: str, task: asyncio.Task):
+        # a load of the key started since is left alone
+        if self.loading.get(key) is task:
+            del self.loading[key]
+        if not task.cancelled() and task.exception():
+            logger.error("Failed loading '%s' into the reference data cache", key, exc_info=task.exception())
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'loads': self.loads,
+            'size': len(self.entries),
+        }
+
+    def cached(self, key: str):
+        """
+        Decorator caching the result of an argument-less coroutine function under key
+        """
+        def decorator(loader):
+            @functools.wraps(loader)
+            async def wrapper():
+                return await self.get(key, loader)
+
+            return wrapper
+
+        return decorator
+
+
+reference_data_cache = ReferenceDataCache(FIREFLY_III_CACHE_TTL, FIREFLY_III_CACHE_MAX_SIZE)
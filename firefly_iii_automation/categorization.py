@@ -0,0 +1,184 @@
+import re
+from datetime import date
+from typing import NamedTuple, Optional
+
+from .ledger_mirror import LedgerMirror, get_counterparty, get_ledger_mirror, get_split_date
+from .models import FireflyTransaction, FireflyTransactionTypes
+
+# the merchant of a card payment and the sender of an incoming transfer in a BT description, which Firefly keeps
+# as the transaction's notes
+DESTINATION_REGEX = re.compile(r'TID:?[\d\w]+ (.+)\s{2}')
+TRANSFER_SENDER_REGEX = re.compile(r'Transfer din card \d+ (.+) catre')
+MERCHANT_WORD_REGEX = re.compile(r'[^\W\d_]+')
+
+# categorizations learned from the Firefly history, see get_categorization_index
+_categorization_index: Optional['CategorizationIndex'] = None
+
+
+class Categorization(NamedTuple):
+    description: str
+    category: str
+    # destination of withdrawals, source of deposits
+    counterparty: str
+
+
+class CategorizationIndex:
+    """
+    Merchant token -> the description, category and counterparty its past transactions got most often (the
+    most recently used one on ties), learned from the Firefly history for the merchants the rules don't know.
+    The best choice of every token is kept up to date as choices get added, so a lookup is a single dict hit.
+    """
+
+    def __init__(self):
+        # token -> categorization -> [uses, last used on]
+        self.choices: dict[str, dict[Categorization, list]] = {}
+        self.best: dict[str, Categorization] = {}
+
+    def __len__(self):
+        return len(self.best)
+
+    def add(self, token: Optional[str], categorization: Categorization, used_on: str):
+        """
+        :param used_on: 'YYYY-MM-DD'
+        """
+        if not token:
+            return
+
+        choices = self.choices.setdefault(token, {})
+        uses = choices.setdefault(categorization, [0, ''])
+        uses[0] += 1
+        uses[1] = max(uses[1], used_on)
+
+        best = self.best.get(token)
+        if best is None or tuple(uses) > tuple(choices[best]):
+            self.best[token] = categorization
+
+    def remove(self, token: Optional[str], categorization: Categorization):
+        """
+        Take back a use added before, the last used date stays as it was
+        """
+        choices = self.choices.get(token) if token else None
+        uses = choices.get(categorization) if choices else None
+        if uses is None:
+            return
+
+        uses[0] -= 1
+        if not uses[0]:
+            del choices[categorization]
+        if not choices:
+            del self.choices[token]
+            del self.best[token]
+        elif self.best[token] == categorization:
+            self.best[token] = max(choices, key=lambda choice: tuple(choices[choice]))
+
+    def suggest(self, token: Optional[str]) -> Optional[Categorization]:
+        return self.best.get(token) if token else None
+
+
+def normalize_merchant(name: str) -> str:
+    """
+    Letters only and case-insensitive, so store numbers and terminal ids don't tell shops of a chain apart
+    """
+    return ' '.join(MERCHANT_WORD_REGEX.findall(name.casefold()))
+
+
+def get_merchant_token(bt_description: Optional[str]) -> Optional[str]:
+    """
+    The merchant (or the sender of an incoming transfer) of a transaction, by which the learned
+    categorizations are looked up
+    """
+    if not bt_description:
+        return None
+
+    sender_match = TRANSFER_SENDER_REGEX.search(bt_description)
+    if sender_match:
+        return f'transfer {normalize_merchant(sender_match.group(1))}'
+
+    destination_match = DESTINATION_REGEX.search(bt_description)
+    if destination_match:
+        return normalize_merchant(destination_match.group(1)) or None
+    return None
+
+
+def load_categorization_index(mirror: LedgerMirror) -> CategorizationIndex:
+    index = CategorizationIndex()
+    for notes, description, category, counterparty, used_on in mirror.get_categorizations():
+        index.add(get_merchant_token(notes), Categorization(description, category, counterparty), used_on)
+    return index
+
+
+def get_categorization_index() -> CategorizationIndex:
+    """
+    The one of the importing process, built from the ledger mirror on first use, then kept up to date by
+    learn_categorization; the importers hand it to the parser
+    """
+    global _categorization_index
+    if _categorization_index is None:
+        _categorization_index = load_categorization_index(get_ledger_mirror())
+    return _categorization_index
+
+
+def set_categorization_index(index: Optional[CategorizationIndex]):
+    """
+    :param index: None to have it rebuilt from the ledger mirror on next use
+    """
+    global _categorization_index
+    _categorization_index = index
+
+
+def update_categorization_index(mirror: LedgerMirror, start: Optional[date], replaced: list[tuple]):
+    """
+    Bring the learned categorizations in line with a sync of the mirror's transactions dated since start,
+    as they may have been recategorized or deleted in Firefly; a full sync has them rebuilt on next use
+    :param replaced: the mirror's categorizations since start from before the sync
+    """
+    index = _categorization_index
+    if index is None:
+        return
+    if start is None:
+        set_categorization_index(None)
+        return
+
+    for notes, description, category, counterparty, _ in replaced:
+        index.remove(get_merchant_token(notes), Categorization(description, category, counterparty))
+    for notes, description, category, counterparty, used_on in mirror.get_categorizations(start):
+        index.add(get_merchant_token(notes), Categorization(description, category, counterparty), used_on)
+
+
+def learn_categorization(transaction: dict):
+    """
+    Add the categorized splits of a transaction just stored in Firefly to the learned categorizations,
+    the ledger mirror keeps them for the next process already
+    """
+    if _categorization_index is None:
+        return
+
+    for split in transaction['attributes']['transactions']:
+        if split.get('category_name'):
+            _categorization_index.add(
+                get_merchant_token(split.get('notes')),
+                Categorization(split['description'], split['category_name'], get_counterparty(split)),
+                get_split_date(split['date'])
+            )
+
+
+def apply_learned_categorization(transaction: FireflyTransaction) -> bool:
+    """
+    Resolve a transaction that came out of the parser uncategorized, from what got learned since
+    :return: whether a categorization got found
+    """
+    # the other side of a transfer is an asset account, resolved by the review already
+    if transaction.category_name or transaction.type is FireflyTransactionTypes.TRANSFER:
+        return False
+
+    learned = get_categorization_index().suggest(get_merchant_token(transaction.notes))
+    if not learned:
+        return False
+
+    transaction.description = learned.description
+    transaction.category_name = learned.category
+    if transaction.type is FireflyTransactionTypes.DEPOSIT:
+        transaction.source_account = learned.counterparty
+    else:
+        transaction.destination_account = learned.counterparty
+    return True
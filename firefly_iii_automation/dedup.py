@@ -0,0 +1,265 @@
+import bisect
+import logging
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import date, timedelta
+from typing import Iterable, Optional
+
+from . import metrics
+from .env import FIREFLY_III_WATERMARK_OVERLAP_DAYS, FIREFLY_III_DUPLICATE_WINDOW_DAYS
+from .ledger_mirror import LedgerMirror
+from .models import FireflyTransaction, FireflyTransactionTypes
+
+logger = logging.getLogger(__name__)
+
+# Transactions edited by hand in Firefly may have drifted a few days from the statement date
+WINDOW_PADDING = timedelta(days=3)
+
+# IBAN -> first and last date of the account's statement rows the parser can skip
+SkipRanges = dict[str, tuple[date, date]]
+
+
+def get_asset_account_key(transaction: FireflyTransaction):
+    """
+    The IBAN (or name) of the statement's own account, before it gets resolved to a Firefly account name
+    """
+    if transaction.type is FireflyTransactionTypes.DEPOSIT:
+        return transaction.destination_account
+    return transaction.source_account
+
+
+def get_statement_window(transactions: Iterable[FireflyTransaction]) -> tuple[date, date]:
+    dates = [transaction.date.date() for transaction in transactions]
+    return min(dates) - WINDOW_PADDING, max(dates) + WINDOW_PADDING
+
+
+def build_external_ids_index(transactions: list[FireflyTransaction], mirror: LedgerMirror) -> set[str]:
+    """
+    External ids of the transactions already in Firefly within the statement's date window,
+    read from the (synced) ledger mirror
+    """
+    if not transactions:
+        return set()
+
+    started_at = time.perf_counter()
+    start, end = get_statement_window(transactions)
+    external_ids = mirror.get_external_ids(start, end)
+    metrics.observe_stage('dedup', time.perf_counter() - started_at, len(transactions))
+    logger.info("Found %d existing transactions between %s and %s", len(external_ids), start, end)
+    return external_ids
+
+
+def get_watermark_skip_ranges(mirror: LedgerMirror) -> SkipRanges:
+    """
+    The statement rows certainly in Firefly already, to be skipped without checking: every account's
+    watermark except its last FIREFLY_III_WATERMARK_OVERLAP_DAYS days, which get checked again
+    """
+    skip_ranges = {}
+    for iban, (first_date, last_date, _) in mirror.get_watermarks().items():
+        last_skipped = last_date - timedelta(days=FIREFLY_III_WATERMARK_OVERLAP_DAYS)
+        if last_skipped >= first_date:
+            skip_ranges[iban] = (first_date, last_skipped)
+    return skip_ranges
+
+
+def get_statement_rows(transactions: Iterable[FireflyTransaction]) -> dict[str, list[tuple[date, str]]]:
+    """
+    IBAN -> processing date and external id of the rows of every statement account, taken before the asset
+    accounts get resolved to their Firefly names. Processing dates only ever grow through a statement, unlike
+    the POS dates of card payments, which may be days older than the rows around them.
+    """
+    statement_rows = defaultdict(list)
+    for transaction in transactions:
+        row_date = (transaction.process_date or transaction.date).date()
+        statement_rows[get_asset_account_key(transaction)].append((row_date, transaction.external_id))
+    return statement_rows
+
+
+def advance_watermarks(mirror: LedgerMirror, statement_rows: dict[str, list[tuple[date, str]]],
+                       failed_external_ids: Optional[set[str]] = None):
+    """
+    Extend the accounts' watermarks over the statement rows now known to be in Firefly (inserted or found
+    existing), up to the first day with a failed row. A watermark only ever covers one unbroken run of
+    dates: rows of a statement that neither overlaps nor follows it right away don't touch it.
+    """
+    failed_external_ids = failed_external_ids or set()
+    watermarks = mirror.get_watermarks()
+
+    for iban, rows in statement_rows.items():
+        first_failed = min((row_date for row_date, external_id in rows if external_id in failed_external_ids),
+                           default=None)
+        confirmed = [row for row in rows if first_failed is None or row[0] < first_failed]
+        if not confirmed:
+            continue
+
+        first_date = min(confirmed)[0]
+        last_date, last_external_id = max(confirmed)
+        watermark = watermarks.get(iban)
+        if watermark:
+            watermark_first, watermark_last, watermark_external_id = watermark
+            one_day = timedelta(days=1)
+            if first_date <= watermark_last + one_day and last_date >= watermark_first - one_day:
+                first_date = min(first_date, watermark_first)
+                if watermark_last >= last_date:
+                    last_date, last_external_id = watermark_last, watermark_external_id
+            elif last_date < watermark_first:
+                # an older statement, with a gap before the watermark
+                continue
+
+        mirror.set_watermark(iban, first_date, last_date, last_external_id)
+        logger.info("Watermark of %s at %s (%s), covering from %s", iban, last_date, last_external_id, first_date)
+
+
+def to_cents(amount) -> int:
+    return round(float(amount) * 100)
+
+
+def get_known_accounts(*names: Optional[str]) -> set[str]:
+    """
+    The names that are actual accounts, not the placeholders of accounts the parser couldn't tell
+    """
+    return {name for name in names if name and 'unknown' not in name.lower()}
+
+
+def is_same_or_unknown(name: Optional[str], other: str) -> bool:
+    return not get_known_accounts(name) or name == other
+
+
+@dataclass(slots=True)
+class IndexedTransaction:
+    external_id: str
+    date: date
+    type: str
+    source: str
+    destination: str
+    # IBAN of the statement the transaction is being imported from, None for the ones already in Firefly
+    statement_account: Optional[str] = None
+
+    def describe(self) -> str:
+        where = f'the {self.statement_account} statement' if self.statement_account else 'Firefly'
+        return f"{self.external_id} ({self.date}, {self.source} -> {self.destination}, in {where})"
+
+
+def is_other_side(transaction: FireflyTransaction, entry: IndexedTransaction) -> bool:
+    """
+    Whether entry can be the other side of the transfer. A statement's transfer goes from its own account to
+    the other one (often unknown), so the other side goes the opposite way: it never starts from the same
+    account, and its accounts are the transfer's swapped, unknown ones matching any.
+    """
+    own, other = transaction.source_account, transaction.destination_account
+    if entry.source == own:
+        return False
+    return is_same_or_unknown(entry.destination, own) and is_same_or_unknown(other, entry.source)
+
+
+def needs_review(transaction: FireflyTransaction, duplicate: IndexedTransaction) -> bool:
+    """
+    Whether a transfer matched a transaction in Firefly on amount and date only, none of its accounts telling
+    it's the other side: it may as well be a transfer of its own, so a person has to tell instead of it being
+    skipped. Matches to the other statements of the import are from accounts of their own, they don't.
+    """
+    if transaction.type is not FireflyTransactionTypes.TRANSFER or duplicate.statement_account is not None:
+        return False
+
+    other = transaction.destination_account
+    return duplicate.destination != transaction.source_account and not (
+        get_known_accounts(other) and other == duplicate.source
+    )
+
+
+class DuplicateIndex:
+    """
+    Transactions bucketed by amount in cents, every bucket sorted by date, so the possible duplicates of a
+    row are found with a dict lookup and a bisect instead of a scan of every transaction.
+    Duplicates are the ones external ids can't catch: the two sides of an internal transfer, found in the
+    statements of both accounts under different references, and transactions the bank re-issued under a
+    new reference. Transfers match within FIREFLY_III_DUPLICATE_WINDOW_DAYS days of each other when
+    the entry can be their other side (see is_other_side); anything else only on the same day and between
+    the same accounts, as the same amount paid to the same merchant on different days is most likely a
+    purchase of its own.
+    A transaction is the duplicate of at most one other row.
+    """
+
+    def __init__(self, window_days: int = FIREFLY_III_DUPLICATE_WINDOW_DAYS):
+        self.window_days = window_days
+        # amount in cents -> (date ordinal, entry index), sorted
+        self.buckets: dict[int, list[tuple[int, int]]] = defaultdict(list)
+        self.entries: list[IndexedTransaction] = []
+        # indexes of the entries a duplicate got found of already
+        self.matched: set[int] = set()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add_entry(self, entry: IndexedTransaction, amounts: Iterable):
+        """
+        :param amounts: the amounts to find the entry by, the foreign amount as well for transfers between
+            accounts of different currencies
+        """
+        index = len(self.entries)
+        self.entries.append(entry)
+        for cents in {to_cents(amount) for amount in amounts if amount}:
+            bisect.insort(self.buckets[cents], (entry.date.toordinal(), index))
+
+    def add(self, transaction: FireflyTransaction, statement_account: Optional[str] = None):
+        self.add_entry(
+            IndexedTransaction(
+                transaction.external_id, transaction.date.date(), transaction.type.value,
+                transaction.source_account, transaction.destination_account, statement_account,
+            ),
+            (transaction.amount, transaction.foreign_amount),
+        )
+
+    def find(self, transaction: FireflyTransaction, statement_account: Optional[str] = None
+             ) -> Optional[IndexedTransaction]:
+        """
+        :param statement_account: IBAN of the statement the transaction comes from, rows of the same
+            statement are never duplicates of each other
+        :return: the first indexed transaction the transaction is likely a duplicate of
+        """
+        is_transfer = transaction.type is FireflyTransactionTypes.TRANSFER
+        window_days = self.window_days if is_transfer else 0
+        day = transaction.date.date().toordinal()
+
+        bucket = self.buckets.get(to_cents(transaction.amount), [])
+        for _, index in bucket[bisect.bisect_left(bucket, (day - window_days,)):
+                               bisect.bisect_right(bucket, (day + window_days, len(self.entries)))]:
+            entry = self.entries[index]
+            if index in self.matched or entry.type != transaction.type.value \
+                    or entry.external_id == transaction.external_id:
+                continue
+            if statement_account is not None and entry.statement_account == statement_account:
+                continue
+
+            if is_transfer:
+                matches = is_other_side(transaction, entry)
+            else:
+                matches = (entry.source, entry.destination) == (transaction.source_account,
+                                                                transaction.destination_account)
+            if matches:
+                self.matched.add(index)
+                return entry
+        return None
+
+
+def build_duplicate_index(transactions: list[FireflyTransaction], mirror: LedgerMirror) -> DuplicateIndex:
+    """
+    Index of the transactions already in Firefly around the statement's dates, the ones matching a row of
+    the statement by external id left out: they're that row, not a duplicate of another one
+    """
+    index = DuplicateIndex()
+    if not transactions:
+        return index
+
+    start, end = get_statement_window(transactions)
+    padding = timedelta(days=index.window_days)
+    external_ids = {transaction.external_id for transaction in transactions}
+    for external_id, split_date, amount, foreign_amount, type, source, destination in mirror.get_transactions(
+            start - padding, end + padding):
+        if external_id not in external_ids:
+            index.add_entry(
+                IndexedTransaction(external_id, date.fromisoformat(split_date), type, source, destination),
+                (amount, foreign_amount),
+            )
+    return index
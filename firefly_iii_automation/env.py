@@ -6,3 +6,73 @@ load_dotenv()
 
 FIREFLY_III_HOST = os.environ['FIREFLY_III_HOST']
 FIREFLY_III_ACCESS_TOKEN = os.environ['FIREFLY_III_ACCESS_TOKEN']
+
+FIREFLY_III_MIRROR_PATH = os.environ.get('FIREFLY_III_MIRROR_PATH', '~/.cache/firefly_iii_automation/ledger.sqlite3')
+# Accounts and categories can't be listed by modification date, so they're fully re-read once this old (seconds)
+FIREFLY_III_MIRROR_MAX_AGE = float(os.environ.get('FIREFLY_III_MIRROR_MAX_AGE', 24 * 60 * 60))
+# Transactions are re-read starting this many days before the last sync, to pick up late edits and deletions
+FIREFLY_III_MIRROR_SYNC_OVERLAP_DAYS = int(os.environ.get('FIREFLY_III_MIRROR_SYNC_OVERLAP_DAYS', 31))
+# Days before an account's import watermark whose statement rows are checked again, card payments get listed late
+FIREFLY_III_WATERMARK_OVERLAP_DAYS = int(os.environ.get('FIREFLY_III_WATERMARK_OVERLAP_DAYS', 7))
+# Days apart the two sides of an internal transfer may be dated and still be taken for the same transfer
+FIREFLY_III_DUPLICATE_WINDOW_DAYS = int(os.environ.get('FIREFLY_III_DUPLICATE_WINDOW_DAYS', 3))
+
+# Size of the keep-alive connection pool shared by all Firefly calls of the process
+FIREFLY_III_POOL_SIZE = int(os.environ.get('FIREFLY_III_POOL_SIZE', 10))
+FIREFLY_III_CONNECT_TIMEOUT = float(os.environ.get('FIREFLY_III_CONNECT_TIMEOUT', 10))
+FIREFLY_III_READ_TIMEOUT = float(os.environ.get('FIREFLY_III_READ_TIMEOUT', 60))
+# How many pages of a list endpoint are fetched at the same time
+FIREFLY_III_PAGE_CONCURRENCY = int(os.environ.get('FIREFLY_III_PAGE_CONCURRENCY', 4))
+# How many inserts a headless batch import keeps in flight, at most one per account
+FIREFLY_III_MAX_IN_FLIGHT = int(os.environ.get('FIREFLY_III_MAX_IN_FLIGHT', 8))
+# JSON (or YAML) file with the merchant categorization rules, the bundled transactions_parsers/bt_rules.json if unset
+FIREFLY_III_CATEGORY_RULES_PATH = os.environ.get('FIREFLY_III_CATEGORY_RULES_PATH')
+# Processes parsing reports in parallel when several are imported at once, one per CPU if unset
+FIREFLY_III_PARSE_PROCESSES = int(os.environ.get('FIREFLY_III_PARSE_PROCESSES', 0))
+# Rows of an import whose outcomes are written to disk at once, what an interrupted import does again when resumed
+FIREFLY_III_JOB_CHECKPOINT_ROWS = int(os.environ.get('FIREFLY_III_JOB_CHECKPOINT_ROWS', 100))
+# Directory whose BT reports watch.py imports as they're dropped in (e.g. one synced with the bank's exports),
+# unless one is given on its command line
+FIREFLY_III_WATCH_DIRECTORY = os.environ.get('FIREFLY_III_WATCH_DIRECTORY')
+# Names of the watched directory's files taken for reports, as a glob pattern
+FIREFLY_III_WATCH_PATTERN = os.environ.get('FIREFLY_III_WATCH_PATTERN', '*.csv')
+# Seconds between rescans of the watched directory, its only way to notice new files where inotify isn't available
+FIREFLY_III_WATCH_POLL_INTERVAL = float(os.environ.get('FIREFLY_III_WATCH_POLL_INTERVAL', 5))
+# Seconds a file's size and modification time must stay the same before it's taken for fully written
+FIREFLY_III_WATCH_SETTLE_SECONDS = float(os.environ.get('FIREFLY_III_WATCH_SETTLE_SECONDS', 5))
+# How many new files of the watched directory are fingerprinted and queued for import at the same time
+FIREFLY_III_WATCH_WORKERS = int(os.environ.get('FIREFLY_III_WATCH_WORKERS', 2))
+# Times the import of a watched file is tried before it's left alone until its content changes
+FIREFLY_III_WATCH_MAX_ATTEMPTS = int(os.environ.get('FIREFLY_III_WATCH_MAX_ATTEMPTS', 3))
+# Seconds before a failed import of a watched file is tried again, doubled after every further failure
+FIREFLY_III_WATCH_RETRY_DELAY = float(os.environ.get('FIREFLY_III_WATCH_RETRY_DELAY', 60))
+# How many transactions the Wave review queue prepares ahead of the one on screen
+FIREFLY_III_REVIEW_PREFETCH = int(os.environ.get('FIREFLY_III_REVIEW_PREFETCH', 10))
+# Seconds a review queue waits for its user before it stops
+FIREFLY_III_REVIEW_IDLE_TIMEOUT = float(os.environ.get('FIREFLY_III_REVIEW_IDLE_TIMEOUT', 60 * 60))
+# Seconds the shared reference data (accounts, categories, descriptions) is served before a background reload
+FIREFLY_III_CACHE_TTL = float(os.environ.get('FIREFLY_III_CACHE_TTL', 5 * 60))
+# How many entries the shared reference data cache holds before evicting the least recently used one
+FIREFLY_III_CACHE_MAX_SIZE = int(os.environ.get('FIREFLY_III_CACHE_MAX_SIZE', 32))
+# How many choices the review form's autocomplete fields get, the best ranked ones for the transaction on screen
+FIREFLY_III_AUTOCOMPLETE_LIMIT = int(os.environ.get('FIREFLY_III_AUTOCOMPLETE_LIMIT', 50))
+# Log level of the app and the imports, DEBUG logs every row of an import
+FIREFLY_III_LOG_LEVEL = os.environ.get('FIREFLY_III_LOG_LEVEL', 'INFO').upper()
+# Write the logs as one JSON object per line instead of text; off unless set to 1/true/yes
+FIREFLY_III_LOG_JSON = os.environ.get('FIREFLY_III_LOG_JSON', '').lower() in ('1', 'true', 'yes')
+# Rows of an import summed up per log line at INFO level, 0 for a single summary at the end
+FIREFLY_III_LOG_ROWS_EVERY = int(os.environ.get('FIREFLY_III_LOG_ROWS_EVERY', 1000))
+# Collect timings and counters of the imports, served in the Prometheus format; off unless set to 1/true/yes
+FIREFLY_III_METRICS = os.environ.get('FIREFLY_III_METRICS', '').lower() in ('1', 'true', 'yes')
+# Port serving /metrics while metrics are on, 0 to not serve them
+FIREFLY_III_METRICS_PORT = int(os.environ.get('FIREFLY_III_METRICS_PORT', 9108))
+# Address the /metrics server listens on, only this host unless set (e.g. 0.0.0.0 for a scraper elsewhere)
+FIREFLY_III_METRICS_ADDRESS = os.environ.get('FIREFLY_III_METRICS_ADDRESS', '127.0.0.1')
+# Requests per second sent to Firefly by the whole process, 0 for no limit
+FIREFLY_III_RATE_LIMIT = float(os.environ.get('FIREFLY_III_RATE_LIMIT', 0))
+# How many requests may go out at once after a quiet period when FIREFLY_III_RATE_LIMIT is set
+FIREFLY_III_RATE_BURST = int(os.environ.get('FIREFLY_III_RATE_BURST', 10))
+# Times a Firefly call failing with 429, 5xx or a timeout is retried
+FIREFLY_III_MAX_RETRIES = int(os.environ.get('FIREFLY_III_MAX_RETRIES', 5))
+# Seconds the first retry waits at most, doubled for every further one
+FIREFLY_III_RETRY_BASE_DELAY = float(os.environ.get('FIREFLY_III_RETRY_BASE_DELAY', 0.5))
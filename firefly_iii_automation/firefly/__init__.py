@@ -0,0 +1,3 @@
+# Transactions per page of the transactions listing of both client layers, Firefly's default of 50 takes ten times
+# the requests
+TRANSACTIONS_PAGE_SIZE = 500
@@ -1,53 +1,273 @@
+import asyncio
 import logging
+from datetime import date, timedelta
+from typing import Optional
 
+import httpx
 from asyncer import asyncify
 
-from .sync import (
-    create_configuration as sync_create_configuration,
-    create_new_transaction as sync_create_new_transaction,
-    create_api_client as sync_create_api_client,
-    get_all_accounts as sync_get_all_accounts,
-    get_all_categories as sync_get_all_categories,
-    get_all_descriptions as sync_get_all_descriptions,
-    get_all_asset_accounts as sync_get_all_asset_accounts,
-    find_transaction_by_external_id as sync_find_transaction_by_external_id
-)
+from . import TRANSACTIONS_PAGE_SIZE
+from .governor import RETRY_STATUSES, RetryableFailure, get_backoff_delay, get_request_governor, \
+    parse_retry_after
+from .. import metrics
+from ..categorization import learn_categorization, update_categorization_index
+from ..env import FIREFLY_III_ACCESS_TOKEN, FIREFLY_III_HOST, FIREFLY_III_MIRROR_MAX_AGE, \
+    FIREFLY_III_MIRROR_SYNC_OVERLAP_DAYS, FIREFLY_III_POOL_SIZE, FIREFLY_III_CONNECT_TIMEOUT, \
+    FIREFLY_III_READ_TIMEOUT, FIREFLY_III_PAGE_CONCURRENCY, FIREFLY_III_MAX_RETRIES
+from ..ledger_mirror import get_ledger_mirror
 from ..models import FireflyTransaction
+from ..utils.json import LazyDumps, loads
 
 logger = logging.getLogger(__name__)
 
+_api_client: Optional[httpx.AsyncClient] = None
+
 
 async def create_configuration():
-    return await asyncify(sync_create_configuration)()
+    # the generated client is only loaded by the calls needing it, it's most of the cold start cost
+    from .sync import create_configuration as sync_create_configuration
+    return sync_create_configuration()
 
 
 async def create_api_client():
-    return await asyncify(sync_create_api_client)()
+    """
+    The process wide keep-alive connection pool used by every call in this module
+    """
+    global _api_client
+    if _api_client is None or _api_client.is_closed:
+        _api_client = httpx.AsyncClient(
+            base_url=FIREFLY_III_HOST,
+            headers={
+                'Authorization': f'Bearer {FIREFLY_III_ACCESS_TOKEN}',
+                'Accept': 'application/json',
+            },
+            limits=httpx.Limits(
+                max_connections=FIREFLY_III_POOL_SIZE, max_keepalive_connections=FIREFLY_III_POOL_SIZE
+            ),
+            timeout=httpx.Timeout(FIREFLY_III_READ_TIMEOUT, connect=FIREFLY_III_CONNECT_TIMEOUT),
+        )
+    return _api_client
+
+
+async def close_api_client():
+    global _api_client
+    if _api_client is not None:
+        await _api_client.aclose()
+        _api_client = None
+
+
+def get_retryable_failure(ex: Exception):
+    if isinstance(ex, httpx.TransportError):
+        # timeouts and broken connections
+        return RetryableFailure(ambiguous=True)
+
+    if ex.status not in RETRY_STATUSES:
+        return None
+    retry_after = parse_retry_after((ex.headers or {}).get('Retry-After'))
+    # a 429 is turned down before Firefly does anything
+    return RetryableFailure(ambiguous=ex.status != 429, retry_after=retry_after)
+
+
+async def request(method: str, path: str, recover=None, **kwargs):
+    """
+    Send a request under the request governor. Requests failing with 429, 5xx or a timeout are retried
+    with jittered exponential backoff.
+    :param recover: for requests that aren't idempotent, coroutine function looking up whether a failed
+        attempt went through anyway; what it finds is returned instead of retrying
+    """
+    from firefly_iii_client.exceptions import ApiException
+
+    api_client = await create_api_client()
+    endpoint = f'{method} {path}'
+    governor = get_request_governor()
+
+    attempt = 0
+    while True:
+        await governor.acquire_async()
+        try:
+            with metrics.track_request(endpoint):
+                response = await api_client.request(method, path, **kwargs)
+
+                if response.is_error:
+                    # Same error type as the generated client raises, so callers handle both layers alike
+                    ex = ApiException(
+                        status=response.status_code, reason=response.reason_phrase
+                    )
+                    ex.body = response.text
+                    ex.headers = response.headers
+                    raise ex
+        except (ApiException, httpx.TransportError) as ex:
+            failure = get_retryable_failure(ex)
+            governor.release(overloaded=failure is not None)
+            if failure is None or attempt >= FIREFLY_III_MAX_RETRIES:
+                raise
+
+            delay = get_backoff_delay(attempt, failure.retry_after)
+            logger.warning("%s failed (%r), retry %d in %.2fs", endpoint, ex, attempt + 1, delay)
+            metrics.FIREFLY_RETRIES.inc(endpoint=endpoint)
+            if failure.retry_after:
+                governor.pause(failure.retry_after)
+            await asyncio.sleep(delay)
+
+            if recover and failure.ambiguous:
+                recovered = await recover()
+                if recovered is not None:
+                    logger.info("%s went through before failing, not retrying it", endpoint)
+                    return recovered
+            attempt += 1
+        except BaseException:
+            governor.cancel()
+            raise
+        else:
+            governor.release()
+            return loads(response.content)
+
+
+async def paginate(path: str, description: str, params: Optional[dict] = None):
+    """
+    Yield the entries of every page of a list endpoint, in order. Page 1 tells how many pages there are,
+    pages 2..N are then fetched concurrently, at most FIREFLY_III_PAGE_CONCURRENCY at a time
+    """
+    params = params or {}
+    logger.info("Fetching %s page 1", description)
+    response = await request('GET', path, params=params)
+
+    for entry in response['data']:
+        yield entry
+
+    semaphore = asyncio.Semaphore(FIREFLY_III_PAGE_CONCURRENCY)
+
+    async def fetch_page(page):
+        async with semaphore:
+            logger.info("Fetching %s page %d", description, page)
+            return await request('GET', path, params={**params, 'page': page})
 
+    total_pages = response['meta']['pagination']['total_pages']
+    pages = [asyncio.ensure_future(fetch_page(page)) for page in range(2, total_pages + 1)]
+    try:
+        for page in pages:
+            for entry in (await page)['data']:
+                yield entry
+    finally:
+        # the consumer may stop early
+        for page in pages:
+            page.cancel()
 
-async def get_all_accounts():
-    for item in await asyncify(sync_get_all_accounts)():
-        yield item
 
+def get_all_accounts():
+    return paginate('/api/v1/accounts', "all accounts")
 
-async def get_all_categories():
-    for item in await asyncify(sync_get_all_categories)():
-        yield item
 
+def get_all_categories():
+    return paginate('/api/v1/categories', "all categories")
 
-async def get_all_asset_accounts():
-    for item in await asyncify(sync_get_all_asset_accounts)():
-        yield item
+
+def get_all_asset_accounts():
+    return paginate('/api/v1/accounts', "all asset accounts", {'type': 'asset'})
+
+
+def get_all_transactions(start=None, end=None):
+    filters = {'start': start.isoformat()} if start else {}
+    if end:
+        filters['end'] = end.isoformat()
+    return paginate(
+        '/api/v1/transactions', f"all transactions since {start or 'the beginning'}" + (f" until {end}" if end else ''),
+        {'limit': TRANSACTIONS_PAGE_SIZE, **filters}
+    )
 
 
 async def get_all_descriptions():
-    for item in await asyncify(sync_get_all_descriptions)():
-        yield item
+    logger.info("Fetching all descriptions")
+    for entry in await request('GET', '/api/v1/autocomplete/transactions', params={'limit': 99999}):
+        yield entry
 
 
 async def create_new_transaction(transaction: FireflyTransaction):
-    return await asyncify(sync_create_new_transaction)(transaction)
+    from firefly_iii_client import ApiClient
+    from firefly_iii_client.exceptions import ApiException
+
+    logger.debug("Inserting transaction with external id %s", transaction.external_id)
+    body = ApiClient.sanitize_for_serialization(transaction.to_transaction_store())
+    try:
+        with metrics.STAGE_SECONDS.time(stage='insert'):
+            response = await request(
+                'POST', '/api/v1/transactions', json=body,
+                # the external id tells whether a failed attempt got stored, so the insert can be retried
+                recover=lambda: find_stored_transaction(transaction.external_id),
+            )
+        metrics.STAGE_ROWS.inc(stage='insert')
+        logger.debug(
+            "Insertion response for external id %s: %s", transaction.external_id, LazyDumps(response['data'])
+        )
+        get_ledger_mirror().record_transaction(response['data'])
+        learn_categorization(response['data'])
+    except ApiException as ex:
+        logger.error(
+            "Failed insertion of transaction with external id '%s':\t%s\t%s",
+            transaction.external_id, ex.body, LazyDumps(transaction.to_dict())
+        )
+        raise ex
+
+    return response['data']
+
+
+async def find_stored_transaction(external_id):
+    """
+    The transaction with external_id, shaped like the response of storing it
+    """
+    stored = await find_transaction_by_external_id(external_id)
+    return {'data': stored} if stored else None
 
 
 async def find_transaction_by_external_id(external_id):
-    return await asyncify(sync_find_transaction_by_external_id)(external_id)
+    response = await request('GET', '/api/v1/search/transactions', params={'query': f"external_id_is:{external_id}"})
+
+    if response['data']:
+        return response['data'][0]
+
+
+async def refresh_accounts():
+    """
+    Re-read the accounts whatever their age, e.g. for a statement account missing from the mirror, which may have
+    been created in Firefly since they were last read
+    """
+    mirror = get_ledger_mirror()
+    accounts = [account async for account in get_all_accounts()]
+    await asyncify(mirror.replace_accounts)(accounts)
+    return mirror
+
+
+async def refresh_transactions(start: date, end: date):
+    """
+    Re-read the transactions dated between start and end whatever the last sync, see sync.refresh_transactions
+    """
+    mirror = get_ledger_mirror()
+    transactions = [transaction async for transaction in get_all_transactions(start, end)]
+    replaced = await asyncify(mirror.get_categorizations)(start)
+    await asyncify(mirror.replace_transactions)(start, transactions, None, end)
+    await asyncify(update_categorization_index)(mirror, start, replaced)
+    return mirror
+
+
+async def sync_ledger_mirror():
+    mirror = get_ledger_mirror()
+
+    with metrics.STAGE_SECONDS.time(stage='sync'):
+        if mirror.is_stale('accounts', FIREFLY_III_MIRROR_MAX_AGE):
+            await refresh_accounts()
+
+        if mirror.is_stale('categories', FIREFLY_III_MIRROR_MAX_AGE):
+            categories = [category async for category in get_all_categories()]
+            await asyncify(mirror.replace_categories)(categories)
+
+        today = date.today()
+        last_sync = mirror.get_sync_point('transactions')
+        start = None
+        if last_sync:
+            start = date.fromisoformat(last_sync) - timedelta(days=FIREFLY_III_MIRROR_SYNC_OVERLAP_DAYS)
+        transactions = [transaction async for transaction in get_all_transactions(start)]
+        replaced = await asyncify(mirror.get_categorizations)(start) if start else []
+        await asyncify(mirror.replace_transactions)(start, transactions, today)
+        await asyncify(update_categorization_index)(mirror, start, replaced)
+
+    return mirror
@@ -0,0 +1,178 @@
+"""
+Client side flow control shared by every Firefly call of both client layers: a token bucket caps the
+request rate and an AIMD limit on concurrent requests halves when Firefly shows it's overloaded (429, 5xx,
+timeouts) and grows back by one request per round of successes.
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+
+from ..env import FIREFLY_III_RATE_LIMIT, FIREFLY_III_RATE_BURST, FIREFLY_III_POOL_SIZE, \
+    FIREFLY_III_RETRY_BASE_DELAY
+
+logger = logging.getLogger(__name__)
+
+# responses worth retrying, Firefly (or the web server in front of it) is overloaded or restarting
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+RETRY_MAX_DELAY = 30.0
+# the limit isn't cut again for failures of requests already in flight when it was cut
+DECREASE_COOLDOWN = 1.0
+DECREASE_FACTOR = 0.5
+
+
+@dataclass(frozen=True)
+class RetryableFailure:
+    # the request may have been carried out even though it failed (e.g. a timeout after sending it)
+    ambiguous: bool
+    # seconds the server asked to wait, from the Retry-After header
+    retry_after: Optional[float] = None
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    try:
+        return max(0.0, float(value)) if value else None
+    except ValueError:
+        # the HTTP date form isn't used by Firefly
+        return None
+
+
+def get_backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """
+    Exponential backoff with full jitter, so clients failing together don't retry together
+    :param attempt: 0 for the first retry
+    """
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, FIREFLY_III_RETRY_BASE_DELAY * 2 ** attempt))
+    return max(delay, retry_after or 0)
+
+
+class RequestGovernor:
+    """
+    Thread safe, usable from worker threads (acquire) and event loops (acquire_async) at the same time
+    """
+
+    def __init__(self, rate: float, burst: int, max_concurrency: int, min_concurrency: int = 1):
+        """
+        :param rate: requests per second, 0 for no limit
+        """
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.refilled_at = time.monotonic()
+        self.paused_until = 0.0
+
+        self.max_concurrency = max(max_concurrency, min_concurrency)
+        self.min_concurrency = min_concurrency
+        self.limit = max(self.max_concurrency / 2, min_concurrency)
+        self.in_flight = 0
+        self.decreased_at = 0.0
+
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.async_waiters: deque[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = deque()
+
+    def has_slot(self) -> bool:
+        return self.in_flight < int(self.limit)
+
+    def try_acquire(self) -> bool:
+        with self.lock:
+            if self.has_slot():
+                self.in_flight += 1
+                return True
+            return False
+
+    def reserve_token(self) -> float:
+        """
+        Take a token from the bucket, possibly ahead of time
+        :return: seconds to wait before sending the request
+        """
+        with self.lock:
+            now = time.monotonic()
+            pause = max(0.0, self.paused_until - now)
+            if not self.rate:
+                return pause
+
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+            self.refilled_at = now
+            self.tokens -= 1
+            return max(pause, -self.tokens / self.rate)
+
+    def acquire(self):
+        with self.condition:
+            while not self.has_slot():
+                self.condition.wait()
+            self.in_flight += 1
+
+        delay = self.reserve_token()
+        if delay:
+            time.sleep(delay)
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while not self.try_acquire():
+            future = loop.create_future()
+            with self.lock:
+                self.async_waiters.append((loop, future))
+            # a slot may have been released before the waiter got registered
+            if self.try_acquire():
+                break
+            await future
+
+        delay = self.reserve_token()
+        if delay:
+            try:
+                await asyncio.sleep(delay)
+            except BaseException:
+                self.cancel()
+                raise
+
+    def release(self, overloaded: bool = False):
+        """
+        :param overloaded: the request failed in a way showing Firefly is overloaded
+        """
+        with self.lock:
+            now = time.monotonic()
+            if overloaded:
+                if now - self.decreased_at >= DECREASE_COOLDOWN:
+                    self.limit = max(self.min_concurrency, self.limit * DECREASE_FACTOR)
+                    self.decreased_at = now
+                    logger.info("Firefly is overloaded, down to %d concurrent requests", int(self.limit))
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+        self.cancel()
+
+    def cancel(self):
+        """
+        Give the slot back without the request telling anything about Firefly's load
+        """
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+            waiters, self.async_waiters = self.async_waiters, deque()
+
+        for loop, future in waiters:
+            # the waiter's event loop may be gone, e.g. after asyncio.run returned
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(wake, future)
+
+    def pause(self, seconds: float):
+        """
+        Hold back every request for the next seconds, when Firefly asked for it
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def wake(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+@lru_cache()
+def get_request_governor() -> RequestGovernor:
+    return RequestGovernor(FIREFLY_III_RATE_LIMIT, FIREFLY_III_RATE_BURST, FIREFLY_III_POOL_SIZE)
@@ -1,119 +1,294 @@
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
 from functools import lru_cache
 
 import firefly_iii_client
+import urllib3
 from firefly_iii_client.api.accounts_api import AccountsApi
 from firefly_iii_client.api.autocomplete_api import AutocompleteApi
 from firefly_iii_client.api.categories_api import CategoriesApi
 from firefly_iii_client.api.search_api import SearchApi
 from firefly_iii_client.api.transactions_api import TransactionsApi
 
-from ..env import FIREFLY_III_ACCESS_TOKEN, FIREFLY_III_HOST
+from . import TRANSACTIONS_PAGE_SIZE
+from .governor import RETRY_STATUSES, RetryableFailure, get_backoff_delay, get_request_governor, \
+    parse_retry_after
+from .. import metrics
+from ..categorization import learn_categorization, update_categorization_index
+from ..env import FIREFLY_III_ACCESS_TOKEN, FIREFLY_III_HOST, FIREFLY_III_MIRROR_MAX_AGE, \
+    FIREFLY_III_MIRROR_SYNC_OVERLAP_DAYS, FIREFLY_III_POOL_SIZE, FIREFLY_III_PAGE_CONCURRENCY, \
+    FIREFLY_III_CONNECT_TIMEOUT, FIREFLY_III_READ_TIMEOUT, FIREFLY_III_MAX_RETRIES
+from ..ledger_mirror import get_ledger_mirror
 from ..models import FireflyTransaction
-from ..utils.json import dumps
+from ..utils.json import LazyDumps, loads
 
 logger = logging.getLogger(__name__)
 
 
 @lru_cache()
 def create_configuration():
-    return firefly_iii_client.Configuration(
+    configuration = firefly_iii_client.Configuration(
         host=FIREFLY_III_HOST,
         access_token=FIREFLY_III_ACCESS_TOKEN
     )
+    configuration.connection_pool_maxsize = FIREFLY_III_POOL_SIZE
+    return configuration
 
 
 @lru_cache()
 def create_api_client():
+    """
+    Cached for the whole process so every call reuses the same urllib3 connection pool; don't close it
+    """
     configuration = create_configuration()
     return firefly_iii_client.ApiClient(configuration)
 
 
-def get_all_accounts():
-    logger.info("Fetching all accounts page 1")
-    with create_api_client() as api_client:
-        accounts_api = AccountsApi(api_client)
-        response = accounts_api.list_account()
-
-        for entry in response['data']:
-            yield entry
-
-        current_page = 1
-        total_pages = response['meta']['pagination']['total_pages']
-        while current_page < total_pages:
-            current_page += 1
-            logger.info(f"Fetching all accounts page {current_page}")
-            response = accounts_api.list_account(page=current_page)
+def get_endpoint(api_method) -> str:
+    """
+    'METHOD /path' of a generated client API method
+    """
+    settings = getattr(api_method.__self__, f'{api_method.__name__}_endpoint').settings
+    return f"{settings['http_method']} {settings['endpoint_path']}"
+
+
+def get_retryable_failure(ex: Exception):
+    if isinstance(ex, firefly_iii_client.exceptions.ApiException):
+        if ex.status not in RETRY_STATUSES:
+            return None
+        retry_after = parse_retry_after((ex.headers or {}).get('Retry-After'))
+        # a 429 is turned down before Firefly does anything
+        return RetryableFailure(ambiguous=ex.status != 429, retry_after=retry_after)
+
+    # timeouts and broken connections
+    return RetryableFailure(ambiguous=True)
+
+
+def call(api_method, *args, recover=None, raw=False, **kwargs):
+    """
+    Call a generated client API method under the request governor, tracked in the request metrics.
+    Calls failing with 429, 5xx or a timeout are retried with jittered exponential backoff.
+    :param recover: for calls that aren't idempotent, looks up whether a failed attempt went through
+        anyway; what it finds is returned instead of retrying
+    :param raw: return the response body decoded into plain dicts and lists, like the async layer does,
+        instead of validating it and building the generated models out of it, which costs several times
+        more CPU than the request itself on large listings
+    """
+    endpoint = get_endpoint(api_method)
+    governor = get_request_governor()
+    kwargs.setdefault('_request_timeout', (FIREFLY_III_CONNECT_TIMEOUT, FIREFLY_III_READ_TIMEOUT))
+    if raw:
+        kwargs['_preload_content'] = False
+
+    attempt = 0
+    while True:
+        governor.acquire()
+        try:
+            with metrics.track_request(endpoint):
+                result = api_method(*args, **kwargs)
+                if raw:
+                    result = read_json(result)
+        except (firefly_iii_client.exceptions.ApiException, urllib3.exceptions.HTTPError) as ex:
+            failure = get_retryable_failure(ex)
+            governor.release(overloaded=failure is not None)
+            if failure is None or attempt >= FIREFLY_III_MAX_RETRIES:
+                raise
+
+            delay = get_backoff_delay(attempt, failure.retry_after)
+            logger.warning("%s failed (%s), retry %d in %.2fs", endpoint, ex, attempt + 1, delay)
+            metrics.FIREFLY_RETRIES.inc(endpoint=endpoint)
+            if failure.retry_after:
+                governor.pause(failure.retry_after)
+            time.sleep(delay)
+
+            if recover and failure.ambiguous:
+                recovered = recover()
+                if recovered is not None:
+                    logger.info("%s went through before failing, not retrying it", endpoint)
+                    return recovered
+            attempt += 1
+        except BaseException:
+            governor.cancel()
+            raise
+        else:
+            governor.release()
+            return result
+
+
+def read_json(response: urllib3.BaseHTTPResponse):
+    try:
+        return loads(response.data)
+    finally:
+        response.release_conn()
+
+
+def paginate(list_page, description, **kwargs):
+    """
+    Yield the entries of every page of a list endpoint, in order. Page 1 tells how many pages there are,
+    pages 2..N are then fetched concurrently, at most FIREFLY_III_PAGE_CONCURRENCY at a time
+    :param list_page: generated client list method, called with page=N and kwargs
+    :param description: what's being fetched, for logging
+    """
+    logger.info("Fetching %s page 1", description)
+    response = call(list_page, raw=True, **kwargs)
+
+    for entry in response['data']:
+        yield entry
+
+    total_pages = response['meta']['pagination']['total_pages']
+    if total_pages < 2:
+        return
+
+    def fetch_page(page):
+        logger.info("Fetching %s page %d", description, page)
+        return call(list_page, page=page, raw=True, **kwargs)
+
+    with ThreadPoolExecutor(max_workers=min(FIREFLY_III_PAGE_CONCURRENCY, total_pages - 1)) as executor:
+        for response in executor.map(fetch_page, range(2, total_pages + 1)):
             for entry in response['data']:
                 yield entry
 
 
+def get_all_accounts():
+    accounts_api = AccountsApi(create_api_client())
+    return paginate(accounts_api.list_account, "all accounts")
+
+
 def get_all_categories():
-    logger.info("Fetching all categories page 1")
-    with create_api_client() as api_client:
-        categories_api = CategoriesApi(api_client)
-        response = categories_api.list_category()
-
-        for entry in response['data']:
-            yield entry
-
-        current_page = 1
-        total_pages = response['meta']['pagination']['total_pages']
-        while current_page < total_pages:
-            current_page += 1
-            logger.info(f"Fetching all categories page {current_page}")
-            response = categories_api.list_category(page=current_page)
-            for entry in response['data']:
-                yield entry
+    categories_api = CategoriesApi(create_api_client())
+    return paginate(categories_api.list_category, "all categories")
 
 
 def get_all_asset_accounts():
-    logger.info("Fetching all asset accounts page 1")
-    with create_api_client() as api_client:
-        accounts_api = AccountsApi(api_client)
-        response = accounts_api.list_account(type='asset')
-
-        for entry in response['data']:
-            yield entry
-
-        current_page = 1
-        total_pages = response['meta']['pagination']['total_pages']
-        while current_page < total_pages:
-            current_page += 1
-            logger.info(f"Fetching all asset accounts page {current_page}")
-            response = accounts_api.list_account(page=current_page, type='asset')
-            for entry in response['data']:
-                yield entry
+    accounts_api = AccountsApi(create_api_client())
+    return paginate(accounts_api.list_account, "all asset accounts", type='asset')
+
+
+def add_limit_parameter(endpoint):
+    """
+    Let a generated list endpoint take the page size: Firefly reads limit on every listing, the client's spec
+    only declares it on some of them
+    """
+    if 'limit' not in endpoint.params_map['all']:
+        endpoint.params_map['all'].append('limit')
+        endpoint.openapi_types['limit'] = (int,)
+        endpoint.attribute_map['limit'] = 'limit'
+        endpoint.location_map['limit'] = 'query'
+
+
+def get_all_transactions(start=None, end=None):
+    transactions_api = TransactionsApi(create_api_client())
+    add_limit_parameter(transactions_api.list_transaction_endpoint)
+    filters = {'start': start} if start else {}
+    if end:
+        filters['end'] = end
+    return paginate(
+        transactions_api.list_transaction,
+        f"all transactions since {start or 'the beginning'}" + (f" until {end}" if end else ''),
+        limit=TRANSACTIONS_PAGE_SIZE, **filters
+    )
 
 
 def get_all_descriptions():
     logger.info("Fetching all descriptions")
-    with create_api_client() as api_client:
-        autocomplete_api = AutocompleteApi(api_client)
-        response = autocomplete_api.get_transactions_ac(limit=99999)
-        for entry in response.value:
-            yield entry
+    api_client = create_api_client()
+    autocomplete_api = AutocompleteApi(api_client)
+    response = call(autocomplete_api.get_transactions_ac, limit=99999, raw=True)
+    for entry in response:
+        yield entry
 
 
 def create_new_transaction(transaction: FireflyTransaction):
-    logger.info(f"Inserting transaction with external id:\t{transaction.external_id}")
-    with create_api_client() as api_client:
-        transactions_api = TransactionsApi(api_client)
-        try:
-            response = transactions_api.store_transaction(transaction.to_transaction_store())
-            logger.info(f"Insertion response for external id {dumps(response['data'].to_dict())}")
-        except firefly_iii_client.exceptions.ApiException as ex:
-            logger.error(
-                f"Failed insertion of transaction with external id "
-                f"'{transaction.external_id}':\t{ex.body}\t{dumps(transaction.to_dict())}"
+    logger.debug("Inserting transaction with external id %s", transaction.external_id)
+    api_client = create_api_client()
+    transactions_api = TransactionsApi(api_client)
+    try:
+        with metrics.STAGE_SECONDS.time(stage='insert'):
+            response = call(
+                transactions_api.store_transaction,
+                transaction.to_transaction_store(),
+                # the external id tells whether a failed attempt got stored, so the insert can be retried
+                recover=lambda: find_stored_transaction(transaction.external_id),
+                raw=True,
             )
-            raise ex
+        metrics.STAGE_ROWS.inc(stage='insert')
+        logger.debug(
+            "Insertion response for external id %s: %s", transaction.external_id, LazyDumps(response['data'])
+        )
+        get_ledger_mirror().record_transaction(response['data'])
+        learn_categorization(response['data'])
+    except firefly_iii_client.exceptions.ApiException as ex:
+        logger.error(
+            "Failed insertion of transaction with external id '%s':\t%s\t%s",
+            transaction.external_id, ex.body, LazyDumps(transaction.to_dict())
+        )
+        raise ex
+
+    return response['data']
+
+
+def find_stored_transaction(external_id):
+    """
+    The transaction with external_id, shaped like the response of storing it
+    """
+    stored = find_transaction_by_external_id(external_id)
+    return {'data': stored} if stored else None
 
 
 def find_transaction_by_external_id(external_id):
-    with create_api_client() as api_client:
-        search_api = SearchApi(api_client)
-        response = search_api.search_transactions(f"external_id_is:{external_id}")
+    api_client = create_api_client()
+    search_api = SearchApi(api_client)
+    response = call(search_api.search_transactions, f"external_id_is:{external_id}", raw=True)
+
+    if response['data']:
+        return response['data'][0]
+
+
+def refresh_accounts():
+    """
+    Re-read the accounts whatever their age, e.g. for a statement account missing from the mirror, which may have
+    been created in Firefly since they were last read
+    """
+    mirror = get_ledger_mirror()
+    mirror.replace_accounts(list(get_all_accounts()))
+    return mirror
+
+
+def refresh_transactions(start: date, end: date):
+    """
+    Re-read the transactions dated between start and end whatever the last sync, e.g. a statement's window: the
+    incremental sync misses transactions created in Firefly since (by hand, by another import) with older dates
+    """
+    mirror = get_ledger_mirror()
+    replaced = mirror.get_categorizations(start)
+    mirror.replace_transactions(start, list(get_all_transactions(start, end)), None, end)
+    update_categorization_index(mirror, start, replaced)
+    return mirror
+
+
+def sync_ledger_mirror():
+    """
+    Bring the local ledger mirror up to date: accounts and categories are re-read once they are older than
+    FIREFLY_III_MIRROR_MAX_AGE, transactions only from a window before the previous sync onwards
+    """
+    mirror = get_ledger_mirror()
+
+    with metrics.STAGE_SECONDS.time(stage='sync'):
+        if mirror.is_stale('accounts', FIREFLY_III_MIRROR_MAX_AGE):
+            refresh_accounts()
+
+        if mirror.is_stale('categories', FIREFLY_III_MIRROR_MAX_AGE):
+            mirror.replace_categories(list(get_all_categories()))
+
+        today = date.today()
+        last_sync = mirror.get_sync_point('transactions')
+        start = None
+        if last_sync:
+            start = date.fromisoformat(last_sync) - timedelta(days=FIREFLY_III_MIRROR_SYNC_OVERLAP_DAYS)
+        replaced = mirror.get_categorizations(start) if start else []
+        mirror.replace_transactions(start, list(get_all_transactions(start)), today)
+        update_categorization_index(mirror, start, replaced)
 
-        if response['data']:
-            return response['data'][0]
+    return mirror
@@ -0,0 +1,94 @@
+"""
+Import jobs: what an import of a set of reports did so far, so one that dies (a crash, a Wave session that
+went away) is resumed by the next import of the same files, recognized by their content. Rows the job
+confirmed are skipped before any other work; the ones after them go through the import as usual.
+"""
+import hashlib
+import logging
+from pathlib import Path
+from typing import Optional
+
+from .dedup import DuplicateIndex
+from .env import FIREFLY_III_JOB_CHECKPOINT_ROWS
+from .ledger_mirror import LedgerMirror
+from .models import FireflyTransaction
+from .utils.files import fingerprint
+
+logger = logging.getLogger(__name__)
+
+
+def fingerprint_reports(paths: list[Path]) -> str:
+    """
+    One fingerprint for a set of reports, whatever their names and order
+    """
+    return hashlib.sha256(''.join(sorted(fingerprint(path) for path in paths)).encode()).hexdigest()
+
+
+class ImportJob:
+    """
+    Outcome of every row processed so far ('inserted', 'existing', 'duplicate', 'skipped' by the user) by
+    external id, with the Firefly id of the inserted ones. Outcomes are kept in memory and written to the ledger
+    mirror every checkpoint_rows rows, and whenever checkpoint is called. Rows processed since the last
+    checkpoint are done again when the job gets resumed. Inserted ones are in the ledger mirror already by then,
+    which tells they exist without asking Firefly. Failed rows and the ones left for review aren't confirmed, an
+    import with any of them leaves its job open, so importing the reports again retries them and only them.
+    """
+
+    def __init__(self, mirror: LedgerMirror, fingerprint: str, paths: list[Path], rows: int,
+                 checkpoint_rows: int = FIREFLY_III_JOB_CHECKPOINT_ROWS):
+        """
+        :param rows: of the reports, for the progress logged
+        """
+        self.mirror = mirror
+        self.fingerprint = fingerprint
+        self.paths = paths
+        self.rows = rows
+        self.checkpoint_rows = checkpoint_rows
+        # external id -> outcome and Firefly id, as checkpointed
+        self.confirmed = mirror.start_import_job(fingerprint, paths, rows)
+        self.pending: list[tuple[str, str, Optional[str]]] = []
+        if self.confirmed:
+            logger.info(
+                "Resuming the import of %s, %d of %d rows done", ', '.join(map(str, paths)), len(self.confirmed), rows
+            )
+
+    @classmethod
+    def open(cls, mirror: LedgerMirror, paths: list, rows: int) -> 'ImportJob':
+        """
+        The unfinished job of the reports if there's one, a new one otherwise. Reads the files.
+        """
+        paths = [Path(path) for path in paths]
+        return cls(mirror, fingerprint_reports(paths), paths, rows)
+
+    def is_confirmed(self, external_id: str) -> bool:
+        return external_id in self.confirmed
+
+    def confirm(self, external_id: str, outcome: str, transaction_id: Optional[str] = None):
+        self.pending.append((external_id, outcome, transaction_id))
+        if len(self.pending) >= self.checkpoint_rows:
+            self.checkpoint()
+
+    def resume(self, transaction: FireflyTransaction, statement_account: Optional[str], duplicates: DuplicateIndex):
+        """
+        Leave out a confirmed row without any request. One the job inserted goes in the duplicates index as it
+        did back then, so the other side of a transfer in another of the reports is still matched to it.
+        """
+        outcome, _ = self.confirmed[transaction.external_id]
+        if outcome == 'inserted':
+            duplicates.add(transaction, statement_account)
+
+    def checkpoint(self):
+        if not self.pending:
+            return
+
+        pending, self.pending = self.pending, []
+        self.mirror.checkpoint_import_job(self.fingerprint, pending)
+        for external_id, outcome, transaction_id in pending:
+            self.confirmed[external_id] = (outcome, transaction_id)
+
+    def finish(self):
+        """
+        Checkpoint and close the job, the next import of the files starts a new one
+        """
+        self.checkpoint()
+        self.mirror.finish_import_job(self.fingerprint)
@@ -0,0 +1,437 @@
+import logging
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import date, datetime
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterable, Optional
+
+from .env import FIREFLY_III_MIRROR_PATH
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    type TEXT,
+    iban TEXT
+);
+CREATE TABLE IF NOT EXISTS categories (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS descriptions (
+    name TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS transactions (
+    external_id TEXT PRIMARY KEY,
+    transaction_id TEXT NOT NULL,
+    date TEXT NOT NULL,
+    amount REAL NOT NULL,
+    foreign_amount REAL,
+    type TEXT NOT NULL,
+    source TEXT NOT NULL,
+    destination TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transactions_date ON transactions (date);
+CREATE TABLE IF NOT EXISTS usages (
+    transaction_id TEXT NOT NULL,
+    split INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    date TEXT NOT NULL,
+    PRIMARY KEY (transaction_id, split, kind)
+);
+CREATE INDEX IF NOT EXISTS usages_date ON usages (date);
+CREATE TABLE IF NOT EXISTS categorizations (
+    transaction_id TEXT NOT NULL,
+    split INTEGER NOT NULL,
+    notes TEXT NOT NULL,
+    description TEXT NOT NULL,
+    category TEXT NOT NULL,
+    counterparty TEXT NOT NULL,
+    date TEXT NOT NULL,
+    PRIMARY KEY (transaction_id, split)
+);
+CREATE INDEX IF NOT EXISTS categorizations_date ON categorizations (date);
+CREATE TABLE IF NOT EXISTS sync_points (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS watermarks (
+    iban TEXT PRIMARY KEY,
+    first_date TEXT NOT NULL,
+    last_date TEXT NOT NULL,
+    last_external_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS watched_files (
+    sha256 TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    status TEXT NOT NULL,
+    failures INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS import_jobs (
+    fingerprint TEXT PRIMARY KEY,
+    paths TEXT NOT NULL,
+    status TEXT NOT NULL,
+    rows INTEGER NOT NULL,
+    started_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS import_job_rows (
+    fingerprint TEXT NOT NULL,
+    external_id TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    transaction_id TEXT,
+    PRIMARY KEY (fingerprint, external_id)
+);
+"""
+
+# kind of usage kept for autocomplete ranking -> field of the transaction split holding the name
+USAGE_FIELDS = {
+    'description': 'description',
+    'source': 'source_name',
+    'destination': 'destination_name',
+    'category': 'category_name',
+}
+
+
+def get_account_type(account_type) -> str:
+    """
+    Normalize both the short account types of the accounts endpoint ('asset') and the long ones
+    found on transaction splits ('Asset account') to the short form
+    """
+    if account_type is None:
+        return ''
+    return str(getattr(account_type, 'value', account_type)).split(' ')[0].lower()
+
+
+def get_split_date(split_date) -> str:
+    """
+    'YYYY-MM-DD' out of either a datetime (generated client) or an ISO 8601 string (raw JSON)
+    """
+    return split_date[:10] if isinstance(split_date, str) else split_date.date().isoformat()
+
+
+def get_counterparty(split) -> str:
+    """
+    The account on the other side of the statement's one: the source of deposits, the destination otherwise
+    """
+    split_type = str(getattr(split['type'], 'value', split['type']))
+    return split['source_name'] if split_type == 'deposit' else split['destination_name']
+
+
+class LedgerMirror:
+    """
+    On-disk SQLite copy of the Firefly accounts, categories, descriptions and imported transactions,
+    how the categorized ones got resolved, along with the import watermarks of the statement accounts
+    the state of the files of the watched directory and the progress of the import jobs.
+    A new connection is opened for every operation, so the mirror can be used from worker threads.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.connect() as connection:
+            tables = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            if 'transactions' in tables:
+                columns = {row[1] for row in connection.execute("PRAGMA table_info(transactions)")}
+                if 'amount' not in columns:
+                    # mirror from before duplicates got matched on amounts and accounts, re-read the whole history
+                    connection.execute("DROP TABLE transactions")
+                    connection.execute("DELETE FROM sync_points WHERE name = 'transactions'")
+            connection.executescript(SCHEMA)
+            if 'transactions' in tables and not {'usages', 'categorizations'} <= tables:
+                # mirror from before usages or categorizations were kept, the next sync reads the whole history
+                connection.execute("DELETE FROM sync_points WHERE name = 'transactions'")
+
+    @contextmanager
+    def connect(self):
+        connection = sqlite3.connect(self.path)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def get_sync_point(self, name: str) -> Optional[str]:
+        with self.connect() as connection:
+            row = connection.execute("SELECT value FROM sync_points WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def is_stale(self, name: str, max_age: float) -> bool:
+        synced_at = self.get_sync_point(name)
+        return synced_at is None or time.time() - float(synced_at) > max_age
+
+    def replace_accounts(self, accounts: Iterable):
+        rows = [
+            (account['id'], account['attributes']['name'], get_account_type(account['attributes'].get('type')),
+             account['attributes'].get('iban'))
+            for account in accounts
+        ]
+        with self.connect() as connection:
+            connection.execute("DELETE FROM accounts")
+            connection.executemany("INSERT OR REPLACE INTO accounts (id, name, type, iban) VALUES (?, ?, ?, ?)", rows)
+            connection.execute(
+                "INSERT OR REPLACE INTO sync_points (name, value) VALUES ('accounts', ?)", (str(time.time()),)
+            )
+        logger.info("Mirrored %d accounts", len(rows))
+
+    def replace_categories(self, categories: Iterable):
+        rows = [(category['id'], category['attributes']['name']) for category in categories]
+        with self.connect() as connection:
+            connection.execute("DELETE FROM categories")
+            connection.executemany("INSERT OR REPLACE INTO categories (id, name) VALUES (?, ?)", rows)
+            connection.execute(
+                "INSERT OR REPLACE INTO sync_points (name, value) VALUES ('categories', ?)", (str(time.time()),)
+            )
+        logger.info("Mirrored %d categories", len(rows))
+
+    def replace_transactions(self, start: Optional[date], transactions: Iterable, synced_on: Optional[date],
+                             end: Optional[date] = None):
+        """
+        Replace every mirrored transaction dated on or after start (and on or before end) with the ones freshly
+        read from Firefly, so transactions deleted in Firefly within the window disappear from the mirror as well
+        :param synced_on: None for a window that doesn't bring the whole mirror up to date, its sync point stays
+        """
+        with self.connect() as connection:
+            if start is None:
+                connection.execute("DELETE FROM transactions")
+                connection.execute("DELETE FROM usages")
+                connection.execute("DELETE FROM categorizations")
+            else:
+                window = (start.isoformat(), end.isoformat() if end else '9999-12-31')
+                connection.execute("DELETE FROM transactions WHERE date BETWEEN ? AND ?", window)
+                connection.execute("DELETE FROM usages WHERE date BETWEEN ? AND ?", window)
+                connection.execute("DELETE FROM categorizations WHERE date BETWEEN ? AND ?", window)
+
+            count = 0
+            for transaction in transactions:
+                self._insert_transaction(connection, transaction)
+                count += 1
+
+            if synced_on:
+                connection.execute(
+                    "INSERT OR REPLACE INTO sync_points (name, value) VALUES ('transactions', ?)",
+                    (synced_on.isoformat(),)
+                )
+        logger.info("Mirrored %d transactions since %s%s", count, start or 'the beginning',
+                    f" until {end}" if end else '')
+
+    def record_transaction(self, transaction):
+        """
+        Write-through of a transaction just stored in Firefly, together with the accounts, category and
+        description it may have created
+        """
+        with self.connect() as connection:
+            self._insert_transaction(connection, transaction)
+
+    @staticmethod
+    def _insert_transaction(connection: sqlite3.Connection, transaction):
+        for index, split in enumerate(transaction['attributes']['transactions']):
+            split_date = get_split_date(split['date'])
+            if split.get('external_id'):
+                connection.execute(
+                    "INSERT OR REPLACE INTO transactions (external_id, transaction_id, date, amount, foreign_amount, "
+                    "type, source, destination) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (split['external_id'], transaction['id'], split_date, float(split['amount']),
+                     float(split['foreign_amount']) if split.get('foreign_amount') else None,
+                     str(getattr(split['type'], 'value', split['type'])), split['source_name'],
+                     split['destination_name'])
+                )
+
+            connection.executemany(
+                "INSERT OR REPLACE INTO usages (transaction_id, split, kind, name, date) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (transaction['id'], index, kind, split[field], split_date)
+                    for kind, field in USAGE_FIELDS.items() if split.get(field)
+                ]
+            )
+
+            if split.get('notes') and split.get('category_name'):
+                # what the bank's description got resolved to, for learning the categorization of merchants
+                connection.execute(
+                    "INSERT OR REPLACE INTO categorizations (transaction_id, split, notes, description, category, "
+                    "counterparty, date) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (transaction['id'], index, split['notes'], split['description'], split['category_name'],
+                     get_counterparty(split), split_date)
+                )
+
+            connection.execute("INSERT OR IGNORE INTO descriptions (name) VALUES (?)", (split['description'],))
+
+            for prefix in ('source', 'destination'):
+                if split.get(f'{prefix}_id'):
+                    account_type = get_account_type(split.get(f'{prefix}_type'))
+                    connection.execute(
+                        "INSERT OR IGNORE INTO accounts (id, name, type, iban) VALUES (?, ?, ?, ?)",
+                        (split[f'{prefix}_id'], split[f'{prefix}_name'], account_type, split.get(f'{prefix}_iban'))
+                    )
+
+            if split.get('category_id'):
+                connection.execute(
+                    "INSERT OR IGNORE INTO categories (id, name) VALUES (?, ?)",
+                    (split['category_id'], split['category_name'])
+                )
+
+    def get_account_names(self) -> list[str]:
+        with self.connect() as connection:
+            return [row[0] for row in connection.execute("SELECT DISTINCT name FROM accounts ORDER BY name")]
+
+    def get_asset_accounts(self) -> list[dict]:
+        with self.connect() as connection:
+            rows = connection.execute("SELECT id, name, type, iban FROM accounts WHERE type = 'asset'").fetchall()
+        return [
+            {'id': id, 'attributes': {'name': name, 'type': type, 'iban': iban}}
+            for id, name, type, iban in rows
+        ]
+
+    def get_category_names(self) -> list[str]:
+        with self.connect() as connection:
+            return [row[0] for row in connection.execute("SELECT DISTINCT name FROM categories ORDER BY name")]
+
+    def get_descriptions(self) -> list[str]:
+        with self.connect() as connection:
+            return [row[0] for row in connection.execute("SELECT name FROM descriptions ORDER BY name")]
+
+    def get_usages(self, *kinds: str) -> dict[str, tuple[int, str]]:
+        """
+        How many times and the last date each name got used as one of kinds ('description', 'source',
+        'destination', 'category') by the mirrored transactions
+        """
+        with self.connect() as connection:
+            rows = connection.execute(
+                f"SELECT name, COUNT(*), MAX(date) FROM usages WHERE kind IN ({', '.join('?' * len(kinds))}) "
+                f"GROUP BY name",
+                kinds
+            )
+            return {name: (uses, last_used) for name, uses, last_used in rows}
+
+    def get_categorizations(self, start: Optional[date] = None) -> list[tuple[str, str, str, str, str]]:
+        """
+        Notes (the bank's description), description, category, counterparty and date of the mirrored
+        categorized transaction splits, all of them or the ones dated on or after start
+        """
+        with self.connect() as connection:
+            return connection.execute(
+                "SELECT notes, description, category, counterparty, date FROM categorizations WHERE date >= ?",
+                (start.isoformat() if start else '',)
+            ).fetchall()
+
+    def get_external_ids(self, start: date, end: date) -> set[str]:
+        with self.connect() as connection:
+            rows = connection.execute(
+                "SELECT external_id FROM transactions WHERE date BETWEEN ? AND ?",
+                (start.isoformat(), end.isoformat())
+            )
+            return {row[0] for row in rows}
+
+    def get_transactions(self, start: date, end: date) -> list[tuple[str, str, float, Optional[float], str, str, str]]:
+        """
+        External id, date, amount, foreign amount, type, source and destination name of the mirrored
+        transactions between start and end, by date
+        """
+        with self.connect() as connection:
+            return connection.execute(
+                "SELECT external_id, date, amount, foreign_amount, type, source, destination FROM transactions "
+                "WHERE date BETWEEN ? AND ? ORDER BY date",
+                (start.isoformat(), end.isoformat())
+            ).fetchall()
+
+    def get_watermarks(self) -> dict[str, tuple[date, date, str]]:
+        """
+        IBAN -> first and last date of the account's statement rows known to be in Firefly (every row in
+        between as well), and the external id of the last one
+        """
+        with self.connect() as connection:
+            rows = connection.execute("SELECT iban, first_date, last_date, last_external_id FROM watermarks")
+            return {
+                iban: (date.fromisoformat(first_date), date.fromisoformat(last_date), last_external_id)
+                for iban, first_date, last_date, last_external_id in rows
+            }
+
+    def set_watermark(self, iban: str, first_date: date, last_date: date, last_external_id: str):
+        with self.connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO watermarks (iban, first_date, last_date, last_external_id) VALUES (?, ?, ?, ?)",
+                (iban, first_date.isoformat(), last_date.isoformat(), last_external_id)
+            )
+
+    def get_watched_file(self, sha256: str) -> Optional[tuple[str, int]]:
+        """
+        Status ('queued', 'importing', 'imported' or 'failed') and failed imports of the watched file
+        with this content, None if it was never seen
+        """
+        with self.connect() as connection:
+            return connection.execute(
+                "SELECT status, failures FROM watched_files WHERE sha256 = ?", (sha256,)
+            ).fetchone()
+
+    def set_watched_file(self, sha256: str, path: Path, status: str, error: Optional[str] = None):
+        """
+        Record the status of the watched file with this content, a 'failed' one counts a failure more
+        """
+        with self.connect() as connection:
+            connection.execute(
+                "INSERT INTO watched_files (sha256, path, status, failures, error, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (sha256) DO UPDATE SET path = excluded.path, "
+                "status = excluded.status, failures = failures + excluded.failures, error = excluded.error, "
+                "updated_at = excluded.updated_at",
+                (sha256, str(path), status, int(status == 'failed'), error, datetime.now().isoformat())
+            )
+
+    def start_import_job(self, fingerprint: str, paths: list[Path], rows: int) -> dict[str, tuple[str, Optional[str]]]:
+        """
+        Resume the running import job of the reports with this fingerprint, or start a new one
+        :return: external id -> outcome and Firefly id of the rows the job got done
+        """
+        now = datetime.now().isoformat()
+        with self.connect() as connection:
+            row = connection.execute("SELECT status FROM import_jobs WHERE fingerprint = ?", (fingerprint,)).fetchone()
+            if row and row[0] == 'running':
+                connection.execute(
+                    "UPDATE import_jobs SET paths = ?, updated_at = ? WHERE fingerprint = ?",
+                    (', '.join(map(str, paths)), now, fingerprint)
+                )
+                rows = connection.execute(
+                    "SELECT external_id, outcome, transaction_id FROM import_job_rows WHERE fingerprint = ?",
+                    (fingerprint,)
+                )
+                return {external_id: (outcome, transaction_id) for external_id, outcome, transaction_id in rows}
+
+            connection.execute("DELETE FROM import_job_rows WHERE fingerprint = ?", (fingerprint,))
+            connection.execute(
+                "INSERT OR REPLACE INTO import_jobs (fingerprint, paths, status, rows, started_at, updated_at) "
+                "VALUES (?, ?, 'running', ?, ?, ?)",
+                (fingerprint, ', '.join(map(str, paths)), rows, now, now)
+            )
+            return {}
+
+    def checkpoint_import_job(self, fingerprint: str, rows: list[tuple[str, str, Optional[str]]]):
+        """
+        :param rows: external id, outcome and Firefly id of rows the job got done
+        """
+        with self.connect() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO import_job_rows (fingerprint, external_id, outcome, transaction_id) "
+                "VALUES (?, ?, ?, ?)",
+                [(fingerprint, *row) for row in rows]
+            )
+            connection.execute(
+                "UPDATE import_jobs SET updated_at = ? WHERE fingerprint = ?", (datetime.now().isoformat(), fingerprint)
+            )
+
+    def finish_import_job(self, fingerprint: str):
+        with self.connect() as connection:
+            connection.execute(
+                "UPDATE import_jobs SET status = 'finished', updated_at = ? WHERE fingerprint = ?",
+                (datetime.now().isoformat(), fingerprint)
+            )
+
+
+@lru_cache()
+def get_ledger_mirror():
+    return LedgerMirror(Path(FIREFLY_III_MIRROR_PATH).expanduser())
@@ -0,0 +1,111 @@
+"""
+Logging of the Wave app and the headless imports: records are queued by the calling thread (the event loop
+included) and merged with their arguments, formatted and written by a background thread, as text or as one
+JSON object per line. Per-row messages of an import go through RowLog, which sums them up.
+"""
+import atexit
+import json
+import logging
+import queue
+from collections import Counter
+from datetime import datetime
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
+
+from .env import FIREFLY_III_LOG_JSON, FIREFLY_III_LOG_LEVEL, FIREFLY_III_LOG_ROWS_EVERY
+
+TEXT_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+# attributes of every record, any other one got passed as extra and is written out with the JSON logs
+RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created).astimezone().isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update((name, value) for name, value in vars(record).items() if name not in RECORD_ATTRIBUTES)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class LocalQueueHandler(QueueHandler):
+    """
+    Queues records as they are: the listener runs in the same process, so merging the message with its
+    arguments is left to the listener's thread instead of being done by the caller's
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+@lru_cache()
+def configure_logging(level: str = FIREFLY_III_LOG_LEVEL, json_output: bool = FIREFLY_III_LOG_JSON) -> QueueListener:
+    """
+    Send the records of every logger to a background thread writing them to stderr, once per process.
+    Queued records are written out before the process exits.
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if json_output else logging.Formatter(TEXT_FORMAT))
+    records = queue.SimpleQueue()
+    listener = QueueListener(records, handler, respect_handler_level=True)
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(LocalQueueHandler(records))
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+class RowLog:
+    """
+    Outcomes of the rows of an import ('inserted', 'existing', ...). Every row is logged at debug level,
+    while at info level a summary of the counts so far and the latest row is logged once every `every` rows
+    and when the import is done, so a large import doesn't log a line per row.
+    """
+
+    def __init__(self, logger: logging.Logger, name: str, every: int = FIREFLY_III_LOG_ROWS_EVERY):
+        """
+        :param name: what is imported, leads every summary
+        :param every: rows per summary, 0 for a single one at the end
+        """
+        self.logger = logger
+        self.name = name
+        self.every = every
+        self.counts = Counter()
+        self.rows = 0
+        self.last: tuple = ()
+
+    def add(self, outcome: str, msg: str, *args):
+        """
+        :param msg: %-style message describing the row, only merged with args when it's logged
+        """
+        self.rows += 1
+        self.counts[outcome] += 1
+        self.last = (msg, args)
+        self.logger.debug(msg, *args, extra={'outcome': outcome})
+        if self.every and not self.rows % self.every:
+            self.log_summary()
+
+    def log_summary(self):
+        if not self.rows:
+            return
+
+        msg, args = self.last
+        self.logger.info(
+            f"%s: %d rows, %s (latest: {msg})", self.name, self.rows,
+            ', '.join(f'{count} {outcome}' for outcome, count in self.counts.most_common()), *args,
+            extra={'rows': self.rows, 'outcomes': dict(self.counts)},
+        )
+
+    def close(self):
+        """
+        Log the summary of the rows added since the last one
+        """
+        if self.every == 0 or self.rows % self.every:
+            self.log_summary()
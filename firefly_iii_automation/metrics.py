@@ -0,0 +1,273 @@
+"""
+Timing spans, histograms and counters of the import stages, Firefly requests, cache lookups and Wave
+handler calls, served in the Prometheus text format. Off unless FIREFLY_III_METRICS is set, spans and
+counters then only check a flag.
+"""
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import lru_cache, wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+from .env import FIREFLY_III_METRICS, FIREFLY_III_METRICS_ADDRESS, FIREFLY_III_METRICS_PORT
+
+logger = logging.getLogger(__name__)
+
+ENABLED = FIREFLY_III_METRICS
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+REGISTRY: list['Metric'] = []
+
+
+class ImportSummary:
+    """
+    What got observed while handling one import, for showing it to the user once it's done
+    """
+
+    def __init__(self):
+        # (metric name, labels) -> [observations, total]
+        self.totals: dict[tuple[str, tuple], list[float]] = {}
+
+    def add(self, name: str, labels: tuple, value: float):
+        totals = self.totals.setdefault((name, labels), [0, 0.0])
+        totals[0] += 1
+        totals[1] += value
+
+    def rows(self) -> list[tuple[str, str, int, float]]:
+        """
+        :return: metric name, labels, observations and total of every series, sorted
+        """
+        return [
+            (name, ', '.join(f'{label}={value}' for label, value in labels), int(count), total)
+            for (name, labels), (count, total) in sorted(self.totals.items())
+        ]
+
+
+# the import being handled by the current task, if any
+CURRENT_IMPORT: ContextVar[Optional[ImportSummary]] = ContextVar('current_import', default=None)
+
+
+class Metric:
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def get_key(self, labels: dict) -> tuple:
+        return tuple((name, str(labels.get(name, ''))) for name in self.labelnames)
+
+    def record_for_import(self, key: tuple, value: float):
+        summary = CURRENT_IMPORT.get()
+        if summary is not None:
+            summary.add(self.name, key, value)
+
+    def render(self) -> list[str]:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+
+
+def format_labels(key: tuple) -> str:
+    if not key:
+        return ''
+    escaped = (
+        (name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in key
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        if not ENABLED:
+            return
+
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+        self.record_for_import(key, amount)
+
+    def render(self) -> list[str]:
+        with self.lock:
+            values = dict(self.values)
+        return super().render() + [f'{self.name}{format_labels(key)} {value}' for key, value in values.items()]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+        # key -> observations per bucket (the last one is +Inf), sum
+        self.series: dict[tuple, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        if not ENABLED:
+            return
+
+        key = self.get_key(labels)
+        with self.lock:
+            counts, total = self.series.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[bisect_left(self.buckets, value)] += 1
+            total[0] += value
+        self.record_for_import(key, value)
+
+    def time(self, **labels):
+        """
+        Span observing how long its block took
+        """
+        return Span(self, labels) if ENABLED else NULL_SPAN
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        with self.lock:
+            series = {key: (list(counts), total[0]) for key, (counts, total) in self.series.items()}
+
+        for key, (counts, total) in series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                lines.append(f'{self.name}_bucket{format_labels(key + (("le", le),))} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(key)} {total}')
+            lines.append(f'{self.name}_count{format_labels(key)} {cumulative}')
+        return lines
+
+
+class Span:
+    __slots__ = ('histogram', 'labels', 'started_at')
+
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started_at, **self.labels)
+
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class RequestSpan:
+    """
+    Times a Firefly API call and counts it by endpoint and outcome
+    """
+    __slots__ = ('endpoint', 'started_at')
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        FIREFLY_REQUEST_SECONDS.observe(time.perf_counter() - self.started_at, endpoint=self.endpoint)
+        status = getattr(exc, 'status', None) or ('error' if exc else 'ok')
+        FIREFLY_REQUESTS.inc(endpoint=self.endpoint, status=status)
+
+
+STAGE_SECONDS = Histogram('firefly_iii_stage_seconds', 'Time spent per import stage', ('stage',))
+STAGE_ROWS = Counter('firefly_iii_stage_rows_total', 'Rows handled per import stage', ('stage',))
+FIREFLY_REQUEST_SECONDS = Histogram('firefly_iii_request_seconds', 'Firefly API call latency', ('endpoint',))
+FIREFLY_REQUESTS = Counter('firefly_iii_requests_total', 'Firefly API calls by outcome', ('endpoint', 'status'))
+FIREFLY_RETRIES = Counter('firefly_iii_request_retries_total', 'Retried Firefly API calls', ('endpoint',))
+CACHE_LOOKUPS = Counter(
+    'firefly_iii_cache_lookups_total', 'Reference data cache lookups by result', ('key', 'result')
+)
+CACHE_LOAD_SECONDS = Histogram('firefly_iii_cache_load_seconds', 'Reference data cache loads', ('key',))
+WAVE_SERVE_SECONDS = Histogram('firefly_iii_wave_serve_seconds', 'Wave handler calls, rendering included')
+
+
+def track_request(endpoint: str):
+    """
+    :param endpoint: 'METHOD /path' of the API call
+    """
+    return RequestSpan(endpoint) if ENABLED else NULL_SPAN
+
+
+def observe_stage(stage: str, seconds: float, rows: int):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    STAGE_ROWS.inc(rows, stage=stage)
+
+
+def timed(histogram: Histogram, **labels):
+    """
+    Decorator observing the duration of every call of a coroutine function, a no-op when metrics are off
+    """
+    def decorator(function):
+        if not ENABLED:
+            return function
+
+        @wraps(function)
+        async def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return await function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def render() -> str:
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        content = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@lru_cache()
+def start_metrics_server(port: int = FIREFLY_III_METRICS_PORT,
+                         address: str = FIREFLY_III_METRICS_ADDRESS) -> Optional[ThreadingHTTPServer]:
+    """
+    Serve /metrics from a background thread, once per process; nothing is served while metrics are off
+    """
+    if not ENABLED or not port:
+        return None
+
+    server = ThreadingHTTPServer((address, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info("Serving metrics on %s:%d", address, port)
+    return server
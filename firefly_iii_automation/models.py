@@ -1,14 +1,8 @@
 import enum
-from copy import deepcopy
-from dataclasses import dataclass, field, asdict
+from dataclasses import dataclass, fields
 from datetime import datetime
 from typing import Optional
 
-import maya
-from firefly_iii_client.model.transaction_split_store import TransactionSplitStore
-from firefly_iii_client.model.transaction_store import TransactionStore
-from firefly_iii_client.model.transaction_type_property import TransactionTypeProperty
-
 
 class FireflyTransactionTypes(enum.Enum):
     WITHDRAWAL = 'withdrawal'
@@ -16,7 +10,7 @@ class FireflyTransactionTypes(enum.Enum):
     TRANSFER = 'transfer'
 
 
-@dataclass()
+@dataclass(slots=True)
 class FireflyTransaction:
     external_id: str
     description: str
@@ -25,14 +19,23 @@ class FireflyTransaction:
     destination_account: str
     amount: float
     type: FireflyTransactionTypes
-    tags: list[str] = field(default_factory=lambda: ['python-script'])
+    # shared by every instance, hence immutable
+    tags: tuple[str, ...] = ('python-script',)
     category_name: Optional[str] = None
     currency_code: Optional[str] = None
     foreign_amount: Optional[str] = None
     foreign_currency_code: Optional[str] = None
     notes: Optional[str] = None
+    # when the bank processed the row, which orders the statement and its import watermarks; date is when the
+    # transaction got initiated (the POS date of card payments), the one stored in Firefly
+    process_date: Optional[datetime] = None
 
     def to_transaction_store(self):
+        # the generated client and its models are loaded on first use, the parser workers never need them
+        from firefly_iii_client.model.transaction_split_store import TransactionSplitStore
+        from firefly_iii_client.model.transaction_store import TransactionStore
+        from firefly_iii_client.model.transaction_type_property import TransactionTypeProperty
+
         spit_store_kwargs = dict(
             description=self.description,
             amount=str(self.amount),
@@ -43,7 +46,7 @@ class FireflyTransaction:
             external_id=self.external_id,
             notes=self.notes,
             source_name=self.source_account,
-            tags=self.tags,
+            tags=list(self.tags),
             type=TransactionTypeProperty(self.type.value),
         )
 
@@ -61,16 +64,34 @@ class FireflyTransaction:
         )
 
     def to_dict(self):
-        clone = deepcopy(self)
-        clone.type = clone.type.value
-        return asdict(clone)
+        result = {name: getattr(self, name) for name in FIELD_NAMES}
+        result['type'] = self.type.value
+        result['tags'] = list(self.tags)
+        return result
 
     @classmethod
     def from_dict(cls, dict):
-        dict_clone = deepcopy(dict)
-        dict_clone['type'] = FireflyTransactionTypes[dict_clone['type'].upper()]
+        kwargs = {name: value for name, value in dict.items() if name != 'tags' or value is not None}
+        kwargs['type'] = FireflyTransactionTypes[dict['type'].upper()]
+        if kwargs.get('tags') is not None:
+            kwargs['tags'] = tuple(kwargs['tags'])
+        for name in ('date', 'process_date'):
+            if isinstance(kwargs.get(name), str):
+                kwargs[name] = parse_datetime(kwargs[name])
+
+        return cls(**kwargs)
+
+
+FIELD_NAMES = tuple(field.name for field in fields(FireflyTransaction))
+
 
-        instance = cls(**dict_clone)
-        if isinstance(instance.date, str):
-            instance.date = maya.parse(instance.date).datetime()
-        return instance
+def parse_datetime(value: str) -> datetime:
+    """
+    ISO 8601 dates (what the Wave date picker and to_dict produce) are parsed directly,
+    maya is only loaded for anything else
+    """
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        import maya
+        return maya.parse(value).datetime()
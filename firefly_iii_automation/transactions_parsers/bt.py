@@ -1,90 +1,156 @@
+import csv
 import re
+import time
 import typing
-from datetime import datetime
+from datetime import date, datetime
+from itertools import islice
+from typing import Iterator, Optional
 
-import aiocsv
-from anyio import AsyncFile
+from anyio import AsyncFile, to_thread
 
+from .. import metrics
+from .rules import CategoryMatcher, DEFAULT_RULES_PATH, get_categories_strings_maps, load_rules
+from ..categorization import DESTINATION_REGEX, TRANSFER_SENDER_REGEX, CategorizationIndex, get_merchant_token
+from ..env import FIREFLY_III_CATEGORY_RULES_PATH
 from ..exceptions import NoIBANException
 from ..models import FireflyTransaction, FireflyTransactionTypes
 
-CATEGORIES_STRINGS_MAPS = {
-    "Food": ["PayUtazz.ro", "GLOVO", "Glovo", "KFC KIOSC"],
-    "Transport": ["BOLT.EU", "UBER TRIP", "OMV", "EPinterregional.ro", "LIMRIDE", "ROMPETROL"],
-    "Groceries": ["MEGAIMAGE", "GUSTINO", "LIDL", "SELGROS", "KAUFLAND"],
-    "Going out": ["COPACUL DE CAFEA", "BUSINESS BISTRO CAFE", "ADA GIKU CAFE SRL", "PANEMAR", "KFC KIOSK"],
-    "Cheltuieli": [
-        "NETFLIX.COM", "SPLITWISE", "RCS AND RDS",
-        "Amazon Video", "WWW.ORANGE.RO", "ALLIANZ-TIRIAC ASIG.",
-        "WWW.EON.RO/MYLINE"
-    ]
-}
+CATEGORY_RULES = load_rules(FIREFLY_III_CATEGORY_RULES_PATH or DEFAULT_RULES_PATH)
+CATEGORY_MATCHER = CategoryMatcher(CATEGORY_RULES)
 
+CATEGORIES_STRINGS_MAPS = get_categories_strings_maps(CATEGORY_RULES)
 
-async def parse_bt_transaction_report(file_obj: AsyncFile):
+POS_DATE_REGEX = re.compile(r';POS (\d{2}/\d{2}/\d{4}) ')
+TRANSFER_MARKER = 'Transfer intern - canal electronic'
+
+HEADER_LINES = 16
+PARSE_BATCH_SIZE = 500
+
+
+async def parse_bt_transaction_report(file_obj: AsyncFile, skip_ranges: Optional[dict[str, tuple[date, date]]] = None,
+                                      categorization_index: Optional[CategorizationIndex] = None):
     """
+    The report is read with a single call and parsed in a worker thread, PARSE_BATCH_SIZE transactions
+    at a time, so the event loop isn't hopped through for every line
     :param typing.TextIO file_obj: Opened File object
+    :param skip_ranges: see iter_bt_transaction_report
+    :param categorization_index: see iter_bt_transaction_report
     :return:
     """
-    currency_code = 'RON'
-    # Skip first 16 lines
-    iban = None
-    for _ in range(16):
-        line = await file_obj.readline()
+    started_at = time.perf_counter()
+    transactions = iter_bt_transaction_report(await file_obj.read(), skip_ranges, categorization_index)
+    # only the time spent reading and parsing counts, not the consumer's between the yields
+    parse_seconds = time.perf_counter() - started_at
+    rows = 0
 
-        if 'numar cont' in line.lower():
-            iban, currency_code = line.split(",")[1].split(" ")
+    while True:
+        started_at = time.perf_counter()
+        batch = await to_thread.run_sync(take_batch, transactions)
+        parse_seconds += time.perf_counter() - started_at
+        if not batch:
+            break
+
+        rows += len(batch)
+        for transaction in batch:
+            yield transaction
+
+    metrics.observe_stage('parse', parse_seconds, rows)
 
-    if not iban:
-        raise NoIBANException()
 
-    csv_reader = aiocsv.AsyncDictReader(file_obj)
+def take_batch(transactions: Iterator[FireflyTransaction]) -> list[FireflyTransaction]:
+    return list(islice(transactions, PARSE_BATCH_SIZE))
 
-    async for row in csv_reader:
-        transaction_reference = row['Referinta tranzactiei']
+
+def iter_bt_transaction_report(content: str, skip_ranges: Optional[dict[str, tuple[date, date]]] = None,
+                               categorization_index: Optional[CategorizationIndex] = None
+                               ) -> Iterator[FireflyTransaction]:
+    """
+    :param content: the whole text of the report
+    :param skip_ranges: IBAN -> first and last date of the rows to leave out (already imported)
+    :param categorization_index: what got learned from the Firefly history, for the merchants the rules don't
+        know; the importer resolves it, the parser never reads the ledger mirror
+    """
+    lines = content.splitlines(keepends=True)
+    iban, currency_code = parse_bt_header(lines[:HEADER_LINES])
+    first_skipped, last_skipped = (skip_ranges or {}).get(iban, (None, None))
+
+    for row in csv.DictReader(lines[HEADER_LINES:]):
         original_description = row['Descriere']
-        debit = abs(float(row['Debit'])) if row['Debit'] else 0
-        credit = abs(float(row['Credit'])) if row['Credit'] else 0
 
-        date_match = re.search(r';POS (\d{2}/\d{2}/\d{4}) ', original_description)
-        if date_match:
-            # date when transaction got initiated
-            date = datetime.strptime(date_match.group(1), '%d/%m/%Y')
+        # rows are listed by the date they got processed, the watermarks follow it
+        process_date = datetime.strptime(row['Data tranzactie'], '%Y-%m-%d')
+        if first_skipped and first_skipped <= process_date.date() <= last_skipped:
+            continue
 
-        else:
-            # this is actually the date when it got processed
-            date = datetime.strptime(row['Data tranzactie'], '%Y-%m-%d')
+        date_match = POS_DATE_REGEX.search(original_description)
+        # date when transaction got initiated, card payments get processed days later
+        date = datetime.strptime(date_match.group(1), '%d/%m/%Y') if date_match else process_date
 
-        description, category, destination = get_description_category_destination(
+        debit = abs(float(row['Debit'])) if row['Debit'] else 0
+        credit = abs(float(row['Credit'])) if row['Credit'] else 0
+        yield build_transaction(
+            iban,
+            currency_code,
+            row['Referinta tranzactiei'],
             original_description,
             debit,
-            credit
+            credit,
+            date,
+            get_transaction_type(original_description, debit, credit),
+            process_date,
+            categorization_index,
         )
 
-        transaction_type = get_transaction_type(original_description, debit, credit)
-
-        source_account = iban
-        destination_account = destination
-        if transaction_type is FireflyTransactionTypes.DEPOSIT:
-            source_account = destination
-            destination_account = iban
-
-        yield FireflyTransaction(
-            external_id=transaction_reference,
-            description=description,
-            date=date,
-            source_account=source_account,
-            destination_account=destination_account,
-            amount=debit or credit,
-            currency_code=currency_code,
-            category_name=category,
-            type=transaction_type,
-            notes=original_description
-        )
+
+def parse_bt_header(lines: list[str]) -> tuple[str, str]:
+    """
+    :param lines: the lines before the CSV header of the report
+    :return: IBAN and currency code of the account the report belongs to
+    """
+    currency_code = 'RON'
+    iban = None
+    for line in lines:
+        if 'numar cont' in line.lower():
+            iban, currency_code = line.strip().split(",")[1].split(" ")
+
+    if not iban:
+        raise NoIBANException()
+
+    return iban, currency_code
+
+
+def build_transaction(iban, currency_code, transaction_reference, original_description, debit, credit, date,
+                      transaction_type, process_date=None, categorization_index=None):
+    description, category, destination = get_description_category_destination(
+        original_description,
+        debit,
+        credit,
+        categorization_index
+    )
+
+    source_account = iban
+    destination_account = destination
+    if transaction_type is FireflyTransactionTypes.DEPOSIT:
+        source_account = destination
+        destination_account = iban
+
+    return FireflyTransaction(
+        external_id=transaction_reference,
+        description=description,
+        date=date,
+        source_account=source_account,
+        destination_account=destination_account,
+        amount=debit or credit,
+        currency_code=currency_code,
+        category_name=category,
+        type=transaction_type,
+        notes=original_description,
+        process_date=process_date,
+    )
 
 
 def get_transaction_type(bt_description, debit, credit):
-    if 'Transfer intern - canal electronic' in bt_description:
+    if TRANSFER_MARKER in bt_description:
         return FireflyTransactionTypes.TRANSFER
 
     if credit and not debit:
@@ -93,97 +159,30 @@ def get_transaction_type(bt_description, debit, credit):
     return FireflyTransactionTypes.WITHDRAWAL
 
 
-def get_description_category_destination(bt_description, debit, credit):
-    category = None
-    found_string = None
+def get_description_category_destination(bt_description, debit, credit, categorization_index=None):
+    rule = CATEGORY_MATCHER.match(bt_description, debit)
+    if rule:
+        return rule.get_description(), rule.category, rule.get_destination()
+
+    learned = categorization_index.suggest(get_merchant_token(bt_description)) if categorization_index else None
+    if learned:
+        return learned.description, learned.category, learned.counterparty
+
     description = ''
     destination = "Unknown"
 
-    destination_match = re.search(r'TID:?[\d\w]+ (.+)\s{2}', bt_description)
+    destination_match = DESTINATION_REGEX.search(bt_description)
     if destination_match:
         destination = destination_match.group(1)
 
-    for key, strings in CATEGORIES_STRINGS_MAPS.items():
-        for string in strings:
-            if string in bt_description:
-                category = key
-                found_string = string
-                destination = found_string.lower().capitalize()
-                break
-
-    if category == 'Food':
-        if debit > 150 and 'tazz' in found_string.lower() or 'glovo' in found_string.lower():
-            category = 'Groceries'
-        else:
-            description = 'Mancare comandata'
-
-        if 'tazz' in found_string.lower():
-            destination = 'Tazz'
-
-    if category == 'Groceries':
-        description = f'{destination} cumparaturi'
-
-    if category == "Transport":
-        description = destination
-
-        if "bolt" in found_string.lower():
-            destination = 'Bolt'
-
-            if debit < 13:
-                description = 'Bolt scooter'
-
-        if "uber" in found_string.lower():
-            destination = 'Uber'
-
-        if description.lower() == 'Epinterregional.ro'.lower():
-            description = 'Bilet tren'
-
-        if 'LIMRIDE' == found_string:
-            description = destination = 'Lime'
-
-        if 'ROMPETROL' == found_string:
-            description = 'Carburant'
-            destination = 'Rompetrol'
-
-    if category == "Going out":
-        description = "Iesire"
-
-        if 'ADA GIKU CAFE SRL'.lower() in destination.lower():
-            description = 'Cafea Meron'
-            destination = 'Meron'
-
-        if 'PANEMAR' == found_string:
-            description = destination = 'Panemar'
-
-        if 'KFC KIOSK' == found_string:
-            description = destination = 'KFC'
-
-    if category == "Cheltuieli":
-        if 'ALLIANZ-TIRIAC ASIG.' == found_string:
-            currency = 'EUR' if re.search(r'\d+EUR RRN', bt_description) else 'RON'
-            description = f'Allianz-Tiriac Asigurare Investitie {currency}'
-            destination = 'Allianz-Tiriac'
-
-        if 'RCS AND RDS' == found_string:
-            description = destination = 'Digi'
-
-        if 'WWW.ORANGE.RO' == found_string:
-            description = 'Factura Orange'
-            destination = 'Orange'
-
-        if "WWW.EON.RO/MYLINE" == found_string:
-            description = 'Factura EON'
-            destination = 'EON'
-
-    if not category:
-        if 'Transfer din card' in bt_description:
-            sender = re.search(r'Transfer din card \d+ (.+) catre', bt_description).group(1)
+    if 'Transfer din card' in bt_description:
+        sender = TRANSFER_SENDER_REGEX.search(bt_description).group(1)
 
-            sender = sender.lower().title()
-            description = f'Transfer {sender}'
-            destination = sender
+        sender = sender.lower().title()
+        description = f'Transfer {sender}'
+        destination = sender
 
     if not description and destination != 'Unknown':
         description = f'Plata {destination}'
 
-    return description, category, destination
+    return description, None, destination
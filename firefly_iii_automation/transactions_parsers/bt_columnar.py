@@ -0,0 +1,102 @@
+"""
+Columnar parsing of BT reports, for statements with tens of thousands of rows.
+The whole body is read in one go and amounts, dates and transaction types are computed on
+NumPy arrays instead of row by row. numpy is only imported once the columnar parser gets asked for.
+"""
+import csv
+import io
+import re
+from datetime import date
+from typing import Iterator, Optional
+
+import numpy as np
+
+from .bt import HEADER_LINES, TRANSFER_MARKER, build_transaction, parse_bt_header
+from ..categorization import CategorizationIndex
+from ..models import FireflyTransaction, FireflyTransactionTypes
+
+POS_DATES_REGEX = re.compile(r';POS (\d{2})/(\d{2})/(\d{4}) ')
+
+
+def parse_amounts(column: np.ndarray) -> np.ndarray:
+    return np.abs(np.where(column == '', '0', column).astype(np.float64))
+
+
+def parse_dates(descriptions: list[str], processing_dates: np.ndarray) -> np.ndarray:
+    """
+    The POS date found in the description (when the transaction got initiated) or else the processing date
+    """
+    dates = processing_dates.astype('datetime64[D]')
+
+    # One regex scan over all descriptions joined together, matches are mapped back to their rows by offset
+    separator = '\n'
+    offsets = np.cumsum([len(description) + len(separator) for description in descriptions])
+    matches = POS_DATES_REGEX.finditer(separator.join(descriptions))
+    starts, pos_dates = [], []
+    for match in matches:
+        starts.append(match.start())
+        day, month, year = match.groups()
+        pos_dates.append(f'{year}-{month}-{day}')
+
+    if starts:
+        rows = np.searchsorted(offsets, starts, side='right')
+        # like re.search, only the first POS date of a row counts
+        rows, first_matches = np.unique(rows, return_index=True)
+        dates[rows] = np.array(pos_dates, dtype='datetime64[D]')[first_matches]
+
+    return dates
+
+
+def get_transaction_types(descriptions: np.ndarray, debits: np.ndarray, credits: np.ndarray) -> np.ndarray:
+    types = np.full(len(descriptions), FireflyTransactionTypes.WITHDRAWAL, dtype=object)
+    types[(credits != 0) & (debits == 0)] = FireflyTransactionTypes.DEPOSIT
+    types[np.char.find(descriptions, TRANSFER_MARKER) >= 0] = FireflyTransactionTypes.TRANSFER
+    return types
+
+
+def parse_bt_transaction_report_columnar(content: str, skip_ranges: Optional[dict[str, tuple[date, date]]] = None,
+                                         categorization_index: Optional[CategorizationIndex] = None
+                                         ) -> Iterator[FireflyTransaction]:
+    """
+    Same transactions as parse_bt_transaction_report, out of the whole report's text
+    :param skip_ranges: IBAN -> first and last date of the rows to leave out (already imported)
+    :param categorization_index: see iter_bt_transaction_report
+    """
+    lines = content.splitlines(keepends=True)
+    iban, currency_code = parse_bt_header(lines[:HEADER_LINES])
+
+    rows = list(csv.reader(io.StringIO(''.join(lines[HEADER_LINES:]))))
+    if len(rows) < 2:
+        return
+
+    header, rows = rows[0], rows[1:]
+    columns = {name: [row[index] if index < len(row) else '' for row in rows] for index, name in enumerate(header)}
+
+    descriptions = np.array(columns['Descriere'], dtype=str)
+    debits = parse_amounts(np.array(columns['Debit'], dtype=str))
+    credits = parse_amounts(np.array(columns['Credit'], dtype=str))
+    process_dates = np.array(columns['Data tranzactie'], dtype='datetime64[D]')
+    dates = parse_dates(columns['Descriere'], process_dates)
+    types = get_transaction_types(descriptions, debits, credits)
+
+    skip_range = (skip_ranges or {}).get(iban)
+    kept = np.ones(len(rows), dtype=bool)
+    if skip_range:
+        first_skipped, last_skipped = np.array(skip_range, dtype='datetime64[D]')
+        # on the processing dates, which the watermarks follow
+        kept = (process_dates < first_skipped) | (process_dates > last_skipped)
+
+    for reference, description, debit, credit, transaction_date, transaction_type, process_date in zip(
+            np.array(columns['Referinta tranzactiei'], dtype=object)[kept],
+            np.array(columns['Descriere'], dtype=object)[kept],
+            debits[kept].tolist(),
+            credits[kept].tolist(),
+            dates[kept].astype('datetime64[us]').tolist(),
+            types[kept],
+            process_dates[kept].astype('datetime64[us]').tolist(),
+    ):
+        yield build_transaction(
+            iban, currency_code, reference, description, debit, credit, transaction_date, transaction_type,
+            process_date, categorization_index
+        )
+
@@ -0,0 +1,88 @@
+import asyncio
+import atexit
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterable, Optional
+
+from .. import metrics
+from .bt import iter_bt_transaction_report
+from ..categorization import CategorizationIndex
+from ..env import FIREFLY_III_PARSE_PROCESSES
+from ..models import FireflyTransaction
+
+
+@lru_cache()
+def get_process_pool() -> ProcessPoolExecutor:
+    """
+    Spawned workers rather than forked ones: this process' logging, metrics and anyio threads may hold locks a
+    forked child would never see released. A fork server would preload __main__, starting such threads itself.
+    """
+    pool = ProcessPoolExecutor(
+        max_workers=FIREFLY_III_PARSE_PROCESSES or os.cpu_count(), mp_context=multiprocessing.get_context('spawn')
+    )
+    atexit.register(pool.shutdown)
+    return pool
+
+
+def parse_bt_report_file(path: Path, columnar: bool = False,
+                         skip_ranges: Optional[dict[str, tuple[date, date]]] = None,
+                         categorization_index: Optional[CategorizationIndex] = None) -> list[FireflyTransaction]:
+    """
+    Parse a whole report synchronously, meant to run in a worker process
+    :param skip_ranges: IBAN -> first and last date of the rows to leave out (already imported)
+    :param categorization_index: the learned categorizations of the importing process, see iter_bt_transaction_report
+    """
+    content = Path(path).read_text()
+    if columnar:
+        # numpy is optional, only needed for this mode
+        from .bt_columnar import parse_bt_transaction_report_columnar
+        return list(parse_bt_transaction_report_columnar(content, skip_ranges, categorization_index))
+
+    return list(iter_bt_transaction_report(content, skip_ranges, categorization_index))
+
+
+def merge_transactions(reports: Iterable[list[FireflyTransaction]]) -> list[FireflyTransaction]:
+    """
+    Concatenate the transactions of several reports, keeping only the first one of each external id:
+    internal transfers show up in the reports of both accounts
+    """
+    external_ids = set()
+    merged = []
+    for transactions in reports:
+        for transaction in transactions:
+            if transaction.external_id not in external_ids:
+                external_ids.add(transaction.external_id)
+                merged.append(transaction)
+    return merged
+
+
+async def parse_bt_reports_async(paths: list[Path], columnar: bool = False,
+                                 skip_ranges: Optional[dict[str, tuple[date, date]]] = None,
+                                 categorization_index: Optional[CategorizationIndex] = None
+                                 ) -> list[FireflyTransaction]:
+    """
+    Parse every report in a separate process and merge them
+    :param categorization_index: resolved by the importer, the worker processes get a copy of it
+    """
+    loop = asyncio.get_running_loop()
+    started_at = time.perf_counter()
+
+    if len(paths) == 1:
+        # not worth starting a process for a single report
+        transactions = await loop.run_in_executor(
+            None, parse_bt_report_file, paths[0], columnar, skip_ranges, categorization_index
+        )
+    else:
+        pool = get_process_pool()
+        transactions = merge_transactions(await asyncio.gather(*(
+            loop.run_in_executor(pool, parse_bt_report_file, path, columnar, skip_ranges, categorization_index)
+            for path in paths
+        )))
+
+    metrics.observe_stage('parse', time.perf_counter() - started_at, len(transactions))
+    return transactions
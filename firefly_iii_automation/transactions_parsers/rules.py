@@ -0,0 +1,144 @@
+import json
+import re
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+
+DEFAULT_RULES_PATH = Path(__file__).parent / 'bt_rules.json'
+
+
+@dataclass(frozen=True)
+class CategoryRule:
+    """
+    A merchant string to look for in the bank's transaction description and what it resolves to.
+    Rules sharing the same match string are tried in order, the first one whose conditions hold wins:
+    debit_gt / debit_lt compare the debited amount, pattern is a regex searched in the description.
+    """
+    match: str
+    category: str
+    description: Optional[str] = None
+    destination: Optional[str] = None
+    debit_gt: Optional[float] = None
+    debit_lt: Optional[float] = None
+    pattern: Optional[str] = None
+    compiled_pattern: Optional[re.Pattern] = field(default=None, compare=False, repr=False)
+
+    def __post_init__(self):
+        if self.pattern:
+            object.__setattr__(self, 'compiled_pattern', re.compile(self.pattern))
+
+    def applies(self, bt_description: str, debit: float) -> bool:
+        if self.debit_gt is not None and not debit > self.debit_gt:
+            return False
+        if self.debit_lt is not None and not debit < self.debit_lt:
+            return False
+        if self.compiled_pattern and not self.compiled_pattern.search(bt_description):
+            return False
+        return True
+
+    def get_destination(self) -> str:
+        return self.destination or self.match.lower().capitalize()
+
+    def get_description(self) -> str:
+        return self.description or f'Plata {self.get_destination()}'
+
+
+def build_trie_regex(strings: list[str]) -> str:
+    """
+    Merge the strings into a prefix tree shaped regex, so the engine walks a tree of character
+    branches at every position instead of trying each string one after the other
+    """
+    trie = {}
+    for string in strings:
+        node = trie
+        for char in string:
+            node = node.setdefault(char, {})
+        node[''] = True
+
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        regex = branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+        return f'(?:{regex})?' if '' in node else regex
+
+    return build(trie)
+
+
+class CategoryMatcher:
+    """
+    All the rules compiled into a single regex. Rules have first-match priority:
+    when several match strings occur in a description, the one listed first wins.
+    """
+
+    def __init__(self, rules: list[CategoryRule]):
+        self.rules = rules
+        self.priorities = {}
+        self.rules_by_match = {}
+        for rule in rules:
+            self.priorities.setdefault(rule.match, len(self.priorities))
+            self.rules_by_match.setdefault(rule.match, []).append(rule)
+
+        # The regex only reports the longest string starting at each position,
+        # the shorter ones it contains (itself included) are looked up here, highest priority first
+        self.contained_matches = {
+            string: sorted((other for other in self.priorities if other in string), key=self.priorities.__getitem__)
+            for string in self.priorities
+        }
+        self.regex = re.compile(build_trie_regex(list(self.priorities))) if rules else None
+
+    def find_matches(self, bt_description: str) -> list[str]:
+        """
+        Every match string occurring in the description, highest priority first
+        """
+        if not self.regex:
+            return []
+
+        match = self.regex.search(bt_description)
+        if not match:
+            return []
+
+        next_match = self.regex.search(bt_description, match.start() + 1)
+        if not next_match:
+            # by far the most common case
+            return self.contained_matches[match.group()]
+
+        found = set(self.contained_matches[match.group()])
+        while next_match:
+            found.update(self.contained_matches[next_match.group()])
+            next_match = self.regex.search(bt_description, next_match.start() + 1)
+        return sorted(found, key=self.priorities.__getitem__)
+
+    def match(self, bt_description: str, debit: float) -> Optional[CategoryRule]:
+        for string in self.find_matches(bt_description):
+            for rule in self.rules_by_match[string]:
+                if rule.applies(bt_description, debit):
+                    return rule
+        return None
+
+
+def load_rules(path: Path) -> list[CategoryRule]:
+    """
+    :param path: JSON (or, with PyYAML installed, YAML) file holding a list of rules under "rules"
+    """
+    path = Path(path)
+    with path.open() as f:
+        if path.suffix in ('.yaml', '.yml'):
+            import yaml
+            content = yaml.safe_load(f)
+        else:
+            content = json.load(f)
+
+    return [CategoryRule(**rule) for rule in content['rules']]
+
+
+def get_categories_strings_maps(rules: list[CategoryRule]) -> dict[str, list[str]]:
+    """
+    Category name to the match strings resolving to it
+    """
+    categories_strings_maps = {}
+    for rule in rules:
+        strings = categories_strings_maps.setdefault(rule.category, [])
+        if rule.match not in strings:
+            strings.append(rule.match)
+    return categories_strings_maps
@@ -0,0 +1,14 @@
+import hashlib
+from pathlib import Path
+
+# bytes read at a time while hashing a file
+CHUNK_SIZE = 1024 * 1024
+
+
+def fingerprint(path: Path) -> str:
+    """SHA-256 of the file's content, the same for every copy of an export whatever its name"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -1,6 +1,12 @@
 import json
 from datetime import date, datetime
 
+try:
+    # optional, several times faster at decoding the large Firefly listings
+    import orjson
+except ImportError:
+    orjson = None
+
 
 def serializer(obj):
     """JSON serializer for objects not serializable by default json code"""
@@ -13,3 +19,21 @@ def serializer(obj):
 
 def dumps(obj):
     return json.dumps(obj, default=serializer)
+
+
+def loads(data: bytes):
+    """Decode a JSON document into plain dicts and lists, with orjson when it's installed"""
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+class LazyDumps:
+    """
+    JSON of obj, only dumped once turned into a string, e.g. when a log record holding it gets formatted
+    """
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return dumps(self.obj)
@@ -0,0 +1,309 @@
+"""
+Daemon importing the BT reports dropped into a directory, see watch.py. New files are noticed through inotify
+where it's available, and by rescanning the directory every FIREFLY_III_WATCH_POLL_INTERVAL seconds anyway
+(network and FUSE file systems don't send events). A file is only picked up once its size and modification
+time stayed the same for FIREFLY_III_WATCH_SETTLE_SECONDS, so half-written files are left alone, and it's
+recognized by the SHA-256 of its content: an export is imported once whatever it's named, and the state of
+every file is kept in the ledger mirror, so a restarted daemon goes on with the ones it didn't finish.
+"""
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import signal
+import struct
+import time
+from contextlib import suppress
+from fnmatch import fnmatch
+from pathlib import Path
+from typing import Optional
+
+import anyio
+
+from firefly_iii_automation.automated_scripts import import_bt_reports
+from firefly_iii_automation.env import (
+    FIREFLY_III_MAX_IN_FLIGHT, FIREFLY_III_WATCH_MAX_ATTEMPTS, FIREFLY_III_WATCH_PATTERN,
+    FIREFLY_III_WATCH_POLL_INTERVAL, FIREFLY_III_WATCH_RETRY_DELAY, FIREFLY_III_WATCH_SETTLE_SECONDS,
+    FIREFLY_III_WATCH_WORKERS
+)
+from firefly_iii_automation.firefly import _async
+from firefly_iii_automation.ledger_mirror import get_ledger_mirror
+from firefly_iii_automation.utils.files import fingerprint
+
+logger = logging.getLogger(__name__)
+
+# inotify events telling a file got created, closed after writing or moved into the watched directory; writes
+# themselves aren't listened to, files being written get checked on until they settle anyway
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+# wd, mask, cookie and name length leading every event read from an inotify descriptor
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify:
+    """
+    Linux inotify watch of a directory, through the C library since the standard library has no binding for it.
+    Events only wake the watcher up, which then rescans the directory.
+    """
+
+    def __init__(self, directory: Path):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        mask = IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch of {directory} failed")
+
+    def read_names(self) -> list[str]:
+        """
+        Names of the files the pending events are about, without waiting for any
+        """
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        names = []
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            names.append(os.fsdecode(data[offset:offset + length].rstrip(b'\0')))
+            offset += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+def open_inotify(directory: Path) -> Optional[Inotify]:
+    """
+    :return: None where inotify isn't available (not Linux, out of watches), the directory then only gets polled
+    """
+    try:
+        return Inotify(directory)
+    except (AttributeError, OSError) as ex:
+        logger.warning("Can't watch %s with inotify, polling it instead: %s", directory, ex)
+        return None
+
+
+def is_report_name(name: str, pattern: str = FIREFLY_III_WATCH_PATTERN) -> bool:
+    """
+    Hidden files and editor backups are the temporary files of sync clients and editors, not reports
+    """
+    return not name.startswith('.') and not name.endswith('~') and fnmatch(name, pattern)
+
+
+class FolderWatcher:
+    """
+    Imports the reports of a directory as they settle. Settled files are handed to a pool of workers through a
+    bounded queue, the scanning waits while the workers are all busy. The workers fingerprint and claim the files
+    concurrently, while the imports themselves run one at a time, each taking every file claimed by then:
+    statements arriving together (e.g. of the RON and EUR accounts) are imported as one batch, so the two sides
+    of a transfer between them are matched, as batch_import_bt_reports does.
+    """
+
+    def __init__(self, directory: Path, workers: int = FIREFLY_III_WATCH_WORKERS,
+                 pattern: str = FIREFLY_III_WATCH_PATTERN, poll_interval: float = FIREFLY_III_WATCH_POLL_INTERVAL,
+                 settle_seconds: float = FIREFLY_III_WATCH_SETTLE_SECONDS,
+                 max_attempts: int = FIREFLY_III_WATCH_MAX_ATTEMPTS,
+                 retry_delay: float = FIREFLY_III_WATCH_RETRY_DELAY, max_in_flight: int = FIREFLY_III_MAX_IN_FLIGHT):
+        self.directory = Path(directory)
+        self.workers = workers
+        self.pattern = pattern
+        self.poll_interval = poll_interval
+        self.settle_seconds = settle_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_in_flight = max_in_flight
+        self.mirror = get_ledger_mirror()
+
+        # path -> size and modification time, and when it was first seen with them, for files not settled yet
+        self.changing: dict[Path, tuple[tuple[int, int], float]] = {}
+        # path -> size and modification time it got queued with, not looked at again until they change
+        self.handled: dict[Path, tuple[int, int]] = {}
+        self.queue: asyncio.Queue[Path] = asyncio.Queue(maxsize=workers)
+        # fingerprints claimed by this run, and the files claimed but not imported yet
+        self.claimed: set[str] = set()
+        self.ready: list[tuple[Path, str]] = []
+        self.import_lock = asyncio.Lock()
+        self.wake = asyncio.Event()
+
+    async def run(self):
+        """
+        Watch until cancelled. An import cut short is left 'importing' and done again by the next run.
+        """
+        loop = asyncio.get_running_loop()
+        inotify = open_inotify(self.directory)
+        if inotify:
+            loop.add_reader(inotify.fd, self.on_events, inotify)
+        workers = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+        logger.info("Watching %s for %s files", self.directory, self.pattern)
+
+        try:
+            while True:
+                self.wake.clear()
+                self.scan()
+                await self.queue_settled()
+                # while files are being written, check on them more often than the directory gets polled
+                timeout = min(self.poll_interval, self.settle_seconds / 2) if self.changing else self.poll_interval
+                with suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.wake.wait(), timeout)
+        finally:
+            if inotify:
+                loop.remove_reader(inotify.fd)
+                inotify.close()
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    def on_events(self, inotify: Inotify):
+        if any(is_report_name(name, self.pattern) for name in inotify.read_names()):
+            self.wake.set()
+
+    def scan(self):
+        """
+        Note the reports whose size or modification time changed since they were last seen
+        """
+        now = time.monotonic()
+        seen = set()
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError as ex:
+            logger.error("Can't list %s: %s", self.directory, ex)
+            return
+
+        for entry in entries:
+            if not is_report_name(entry.name, self.pattern):
+                continue
+            try:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+            except OSError:
+                # deleted since it was listed
+                continue
+
+            path = Path(entry.path)
+            seen.add(path)
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if self.handled.get(path) == signature:
+                continue
+            changing = self.changing.get(path)
+            if changing is None or changing[0] != signature:
+                self.changing[path] = (signature, now)
+
+        for files in (self.changing, self.handled):
+            for path in files.keys() - seen:
+                del files[path]
+
+    async def queue_settled(self):
+        now = time.monotonic()
+        for path, (signature, since) in list(self.changing.items()):
+            # an empty file is one about to be written
+            if signature[0] and now - since >= self.settle_seconds:
+                del self.changing[path]
+                self.handled[path] = signature
+                await self.queue.put(path)
+
+    def forget(self, path: Path):
+        """
+        Have the next scan pick the file up again, even though it didn't change
+        """
+        self.handled.pop(path, None)
+        self.wake.set()
+
+    async def work(self):
+        while True:
+            path = await self.queue.get()
+            try:
+                await self.handle(path)
+            except Exception:
+                logger.exception("Failed to handle %s", path)
+            finally:
+                self.queue.task_done()
+
+    async def handle(self, path: Path):
+        try:
+            sha256 = await anyio.to_thread.run_sync(fingerprint, path)
+        except FileNotFoundError:
+            return
+
+        state = self.mirror.get_watched_file(sha256)
+        if sha256 in self.claimed or state and state[0] == 'imported':
+            logger.info("Skipping %s, its content was imported already", path)
+            return
+        if state and state[0] == 'failed' and state[1] >= self.max_attempts:
+            logger.info("Skipping %s, its import failed %d times", path, state[1])
+            return
+
+        self.claimed.add(sha256)
+        self.mirror.set_watched_file(sha256, path, 'queued')
+        self.ready.append((path, sha256))
+        async with self.import_lock:
+            batch, self.ready = self.ready, []
+            if batch:
+                await self.import_batch(batch)
+
+    async def import_batch(self, batch: list[tuple[Path, str]]):
+        for path, sha256 in batch:
+            self.mirror.set_watched_file(sha256, path, 'importing')
+
+        paths = [path for path, _ in batch]
+        try:
+            report = await import_bt_reports(paths, self.max_in_flight)
+        except Exception as ex:
+            if len(batch) > 1:
+                logger.exception("Import of %d files failed, importing them one at a time", len(batch))
+                for item in batch:
+                    await self.import_batch([item])
+                return
+            logger.exception("Import of %s failed", paths[0])
+            error = repr(ex)
+        else:
+            error = f"{report.failed} rows failed" if report.failed else None
+            if report.review_external_ids:
+                logger.warning("Import of %s left %d transfers for review in the Wave app: %s",
+                               ', '.join(map(str, paths)), len(report.review_external_ids),
+                               ', '.join(report.review_external_ids))
+
+        for path, sha256 in batch:
+            if error is None:
+                note = f"{len(report.review_external_ids)} rows left for review" if report.review_external_ids else None
+                self.mirror.set_watched_file(sha256, path, 'imported', note)
+                continue
+
+            self.mirror.set_watched_file(sha256, path, 'failed', error)
+            self.claimed.discard(sha256)
+            failures = self.mirror.get_watched_file(sha256)[1]
+            if failures < self.max_attempts:
+                delay = self.retry_delay * 2 ** (failures - 1)
+                logger.warning("Import of %s failed (%s), trying again in %.0fs", path, error, delay)
+                asyncio.get_running_loop().call_later(delay, self.forget, path)
+            else:
+                logger.error("Import of %s failed %d times (%s), leaving it until its content changes", path,
+                             failures, error)
+
+
+async def watch_directory(directory: Path, **kwargs):
+    """
+    Run a FolderWatcher until SIGTERM or SIGINT, then close the Firefly client
+    """
+    task = asyncio.current_task()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(signum, task.cancel)
+
+    try:
+        await FolderWatcher(directory, **kwargs).run()
+    except asyncio.CancelledError:
+        logger.info("Stopped watching %s", directory)
+    finally:
+        await _async.close_api_client()
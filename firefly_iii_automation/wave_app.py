@@ -1,90 +1,116 @@
 import asyncio
 import dataclasses
+import functools
+import importlib
 import logging
-from typing import AsyncIterator
+import time
+from collections import Counter
+from typing import Optional
 
-import firefly_iii_client
-from aiocache import cached
+import anyio
 from aiofiles.tempfile import _temporary_directory
-from aiopath import AsyncPath
 from anyio import create_memory_object_stream
-from anyio.streams.memory import MemoryObjectSendStream
 # noinspection PyUnresolvedReferences
 from h2o_wave import Q, main, app, ui
 
-from firefly_iii_automation.firefly._async import get_all_accounts, get_all_categories, \
-    get_all_descriptions as _get_all_descriptions, get_all_asset_accounts, find_transaction_by_external_id, \
-    create_new_transaction
+from firefly_iii_automation import metrics
+from firefly_iii_automation.autocomplete import AutocompleteIndex
+from firefly_iii_automation.cache import reference_data_cache
+from firefly_iii_automation.categorization import apply_learned_categorization, get_categorization_index
+from firefly_iii_automation.dedup import (
+    IndexedTransaction, build_duplicate_index, build_external_ids_index, get_asset_account_key,
+    get_statement_window, get_watermark_skip_ranges
+)
+from firefly_iii_automation.env import (
+    FIREFLY_III_REVIEW_PREFETCH, FIREFLY_III_REVIEW_IDLE_TIMEOUT, FIREFLY_III_AUTOCOMPLETE_LIMIT
+)
+from firefly_iii_automation.firefly._async import create_new_transaction, refresh_transactions, sync_ledger_mirror
+from firefly_iii_automation.jobs import ImportJob
+from firefly_iii_automation.ledger_mirror import get_ledger_mirror
+from firefly_iii_automation.log import RowLog, configure_logging
 from firefly_iii_automation.models import FireflyTransactionTypes, FireflyTransaction
-from firefly_iii_automation.transactions_parsers import parse_bt_transaction_report
+from firefly_iii_automation.transactions_parsers.parallel import parse_bt_reports_async
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+configure_logging()
 logger = logging.getLogger(__name__)
 
 CURRENCIES = ['RON', 'EUR']
 
+# review pipelines and batch reviews of all client sessions, stopped when the app shuts down
+RUNNING_PIPELINES: set = set()
 
-@app('/')
+# loads the reference data while the app starts, see warm_up_reference_data
+_warm_up: Optional[asyncio.Task] = None
+
+
+async def start_warm_up():
+    global _warm_up
+    metrics.start_metrics_server()
+    _warm_up = asyncio.create_task(warm_up_reference_data())
+
+
+async def shutdown():
+    if _warm_up is not None:
+        _warm_up.cancel()
+    await close_running_pipelines()
+
+
+async def close_running_pipelines():
+    await asyncio.gather(*(pipeline.aclose() for pipeline in list(RUNNING_PIPELINES)))
+
+
+@app('/', on_startup=start_warm_up, on_shutdown=shutdown)
+@metrics.timed(metrics.WAVE_SERVE_SECONDS)
 async def serve(q: Q):
+    # whatever this call and the tasks it starts observe counts towards the session's import
+    token = metrics.CURRENT_IMPORT.set(q.client.import_summary)
+    try:
+        await handle(q)
+    finally:
+        metrics.CURRENT_IMPORT.reset(token)
+
+
+async def handle(q: Q):
     form_items = []
 
-    if q.args.file_upload or q.client.transactions:
+    if q.client.batch or (q.args.file_upload and q.args.batch_review):
+        form_items = await serve_batch_review(q)
+        if q.client.batch:
+            q.page['form'] = ui.form_card(box='1 1 12 10', items=form_items)
+            await q.page.save()
+            return
+
+    elif q.args.file_upload or q.client.transactions:
         get_next_transaction = False
 
-        if q.client.current_file is None:
-            # File was uploaded just now
-            q.client.temp_dir = await _temporary_directory()
-            q.client.current_file = await q.site.download(q.args.file_upload[0], q.client.temp_dir.name)
-            await q.site.unload(q.args.file_upload[0])
-
-            q.client.transactions = parse_transactions(q.client.current_file)
-
-            accounts, categories, descriptions = await asyncio.gather(
-                get_all_accounts_names(),
-                get_all_categories_names(),
-                get_all_descriptions(),
-            )
-            q.client.accounts = accounts
-            q.client.categories = categories
-            q.client.descriptions = descriptions
+        if q.client.current_files is None:
+            # Files were uploaded just now
+            await download_uploaded_files(q)
+            # the pipeline reads the accounts and existing transactions from the mirror right away
+            await sync_reference_data()
+            q.client.transactions = ReviewPipeline(q.client.current_files)
             get_next_transaction = True
         elif not q.args.skip_button:
             # Insert currently displayed transaction
-            transaction_dict = {}
-            for field in dataclasses.fields(FireflyTransaction):
-                transaction_dict[field.name] = q.args[field.name]
-
-            transaction_dict['external_id'] = q.client.current_transaction.external_id
-            transaction = FireflyTransaction.from_dict(transaction_dict)
+            transaction = read_form_transaction(q, q.client.current_transaction.external_id)
 
             try:
-                await create_new_transaction(transaction)
-                logger.info(f"Transaction with external id {transaction.external_id} successfully inserted")
+                stored = await create_new_transaction(transaction)
+                logger.info("Transaction with external id %s successfully inserted", transaction.external_id)
+                q.client.transactions.job.confirm(transaction.external_id, 'inserted', stored['id'])
                 get_next_transaction = True
 
-                # add account to autocomplete list if it's a new entry
-                if transaction.source_account not in q.client.accounts:
-                    q.client.accounts = sorted(q.client.accounts + [transaction.source_account])
-
-                if transaction.destination_account not in q.client.accounts:
-                    q.client.accounts = sorted(q.client.accounts + [transaction.destination_account])
-
-                # add categories to autocomplete list if it's a new entry
-                if transaction.category_name and transaction.category_name not in q.client.categories:
-                    q.client.categories = sorted(q.client.categories + [transaction.category_name])
-
-                # add descriptions to autocomplete list if it's a new entry
-                if transaction.description not in q.client.descriptions:
-                    q.client.descriptions = sorted(q.client.descriptions + [transaction.description])
+                await record_reference_data_usage(transaction)
 
                 form_items.append(ui.message_bar(type='success', text='Successfully inserted transaction!'))
 
-            except (Exception, firefly_iii_client.exceptions.ApiException) as ex:
+            except Exception as ex:
                 logger.exception(ex)
                 logger.error('Failed to insert transaction!')
                 form_items.append(ui.message_bar(type='blocked', text='Failed to insert transaction!'))
 
         if q.args.skip_button:
+            q.client.transactions.job.confirm(q.client.current_transaction.external_id, 'skipped')
             form_items.append(ui.message_bar(
                 type='info',
                 text=f'Skipped transaction with id {q.client.current_transaction.external_id}'
@@ -100,19 +126,43 @@ async def serve(q: Q):
                 # Processed all transactions.
                 # Reset the UI
                 logger.info("Finished transactions")
+                expired, failed = q.client.transactions.expired, q.client.transactions.failed
+                if q.client.transactions.completed:
+                    q.client.transactions.job.finish()
+                await q.client.transactions.aclose()
                 q.client.transactions = None
                 q.client.current_transaction = None
-                q.client.current_file = None
+                q.client.current_files = None
                 await q.client.temp_dir.close()
-                form_items.append(ui.message_bar(type='info', text='Finished processing transactions'))
+                if failed:
+                    form_items.append(ui.message_bar(
+                        type='error', text='Failed to process the uploaded files, see the logs for why'
+                    ))
+                elif expired:
+                    form_items.append(ui.message_bar(
+                        type='warning', text='Review timed out, upload the files again to go on'
+                    ))
+                else:
+                    form_items.append(ui.message_bar(type='info', text='Finished processing transactions'))
+                form_items += pop_import_summary_items(q)
 
         if q.client.current_transaction:
+            duplicate = q.client.transactions.duplicates.get(q.client.current_transaction.external_id)
+            if duplicate:
+                form_items.append(build_duplicate_message_bar(duplicate))
             # Hide the file upload input and show the transaction fields
             form_items += await build_form_transaction_fields(q.client.current_transaction, q)
+            form_items.append(ui.buttons(
+                justify='center',
+                items=[ui.button(name='skip_button', label='Skip', width='100%', primary=False)]
+            ))
 
     if not q.client.transactions:
         # Only show the file upload input
-        form_items += [ui.file_upload(name='file_upload', label='File Upload', multiple=False, compact=True)]
+        form_items += [
+            ui.file_upload(name='file_upload', label='File Upload', multiple=True, compact=True),
+            ui.toggle(name='batch_review', label='Review all transactions at once in a table'),
+        ]
 
     form_items += [
         ui.buttons(
@@ -127,26 +177,35 @@ async def serve(q: Q):
 
 async def build_form_transaction_fields(transaction: FireflyTransaction, q):
     errors = await get_form_errors(transaction)
+    accounts, categories, descriptions = await asyncio.gather(
+        get_accounts_index(),
+        get_categories_index(),
+        get_descriptions_index(),
+    )
+    limit = FIREFLY_III_AUTOCOMPLETE_LIMIT
     return [
         ui.inline(items=[
             ui.combobox(name='type', label='Type', choices=['Withdrawal', 'Deposit', 'Transfer'], width='25%',
                         required=True, value=transaction.type.value.capitalize()),
             ui.combobox(name='description', label='Description', value=transaction.description,
-                        choices=q.client.descriptions, width='75%',
+                        choices=descriptions.suggest(transaction.description, limit), width='75%',
                         required=True, error=errors.get('description')),
         ]),
         ui.inline(items=[
             ui.combobox(name='source_account', label='Source Account',
-                        choices=q.client.accounts, value=transaction.source_account,
+                        choices=accounts.suggest(transaction.source_account, limit),
+                        value=transaction.source_account,
                         width='50%', required=True, error=errors.get('source_account')),
             ui.combobox(name='destination_account', label='Destination Account',
-                        choices=q.client.accounts, value=transaction.destination_account,
+                        choices=accounts.suggest(transaction.destination_account, limit),
+                        value=transaction.destination_account,
                         width='50%', required=True, error=errors.get('destination_account')),
         ]),
         ui.inline(items=[
             ui.date_picker(name='date', label='Date', value=transaction.date.isoformat(), width="50%"),
             ui.combobox(name='category_name', label='Category Name',
-                        choices=q.client.categories, value=transaction.category_name,
+                        choices=categories.suggest(transaction.category_name, limit),
+                        value=transaction.category_name,
                         width="50%")
         ]),
         ui.inline(items=[
@@ -162,83 +221,571 @@ async def build_form_transaction_fields(transaction: FireflyTransaction, q):
                         choices=CURRENCIES, value=transaction.foreign_currency_code, width="50%")
         ]),
         ui.textbox(name='notes', label='notes', width="100%", multiline=True, value=transaction.notes),
-        ui.buttons(
-            justify='center',
-            items=[ui.button(name='skip_button', label='Skip', width='100%', primary=False)]
-        ),
     ]
 
 
-@cached()
-async def get_all_accounts_names():
-    return sorted({account['attributes']['name'] async for account in get_all_accounts()})
+async def download_uploaded_files(q: Q):
+    if metrics.ENABLED:
+        q.client.import_summary = metrics.ImportSummary()
+        metrics.CURRENT_IMPORT.set(q.client.import_summary)
+
+    q.client.temp_dir = await _temporary_directory()
+    q.client.current_files = []
+    for file_upload in q.args.file_upload:
+        q.client.current_files.append(await q.site.download(file_upload, q.client.temp_dir.name))
+        await q.site.unload(file_upload)
 
 
-@cached()
+def pop_import_summary_items(q: Q) -> list:
+    """
+    Timings and counts of the import just finished, when metrics are on
+    """
+    summary: metrics.ImportSummary = q.client.import_summary
+    q.client.import_summary = None
+    if not summary:
+        return []
+
+    lines = ['| Metric | Labels | Count | Total |', '| --- | --- | ---: | ---: |']
+    lines += [f'| {name} | {labels} | {count} | {total:.3f} |' for name, labels, count, total in summary.rows()]
+    return [ui.expander(name='import_summary', label='Import timings', items=[ui.text('\n'.join(lines))])]
+
+
+def read_form_transaction(q: Q, external_id: str) -> FireflyTransaction:
+    transaction_dict = {}
+    for field in dataclasses.fields(FireflyTransaction):
+        transaction_dict[field.name] = q.args[field.name]
+
+    transaction_dict['external_id'] = external_id
+    return FireflyTransaction.from_dict(transaction_dict)
+
+
+@reference_data_cache.cached('accounts')
+async def get_accounts_index():
+    mirror = get_ledger_mirror()
+    return AutocompleteIndex(mirror.get_account_names(), mirror.get_usages('source', 'destination'))
+
+
+@reference_data_cache.cached('asset_accounts')
 async def get_assets_accounts():
     return {
         account['attributes'].get('iban') or account['attributes'].get('name'): account
-        async for account in get_all_asset_accounts()
+        for account in get_ledger_mirror().get_asset_accounts()
     }
 
 
-@cached()
-async def get_all_categories_names():
-    return sorted({category['attributes']['name'] async for category in get_all_categories()})
+@reference_data_cache.cached('categories')
+async def get_categories_index():
+    mirror = get_ledger_mirror()
+    return AutocompleteIndex(mirror.get_category_names(), mirror.get_usages('category'))
+
+
+@reference_data_cache.cached('descriptions')
+async def get_descriptions_index():
+    mirror = get_ledger_mirror()
+    return AutocompleteIndex(mirror.get_descriptions(), mirror.get_usages('description'))
 
 
-@cached()
-async def get_all_descriptions():
-    return sorted({description['name'] async for description in _get_all_descriptions()})
+def import_firefly_client():
+    # the generated client modules every insert needs
+    for module in ('firefly_iii_client.model.transaction_split_store', 'firefly_iii_client.model.transaction_store'):
+        importlib.import_module(module)
 
 
-async def parse_transactions(file_location: str) -> AsyncIterator[FireflyTransaction]:
+async def warm_up_reference_data() -> bool:
     """
-    Asynchronously read the file and start yielding parsed transactions in a separate thread
-    The parsed transactions will be buffered in send_stream. receive_stream will start reading
-    only when the next value is needed out of this generator. This means that the send_stream
-    will continuously receive transactions in the background but this generator will only start
-    return one when needed. This means that this generator will wait for the first transaction
-    to be parsed and put into the send_stream and then return it.
-    :param file_location:
-    :return:
+    Load the generated client, sync the ledger mirror and fill the shared reference data cache in the
+    background, so the first upload finds them ready instead of waiting on cold Firefly calls
+    :return: whether it all got loaded; a failure is only logged, the first upload then loads it instead
     """
-    send_stream, receive_stream = create_memory_object_stream(max_buffer_size=1000, item_type=FireflyTransaction)
+    started_at = time.perf_counter()
+    try:
+        await anyio.to_thread.run_sync(import_firefly_client)
+        await sync_ledger_mirror()
+        await asyncio.gather(
+            get_accounts_index(),
+            get_assets_accounts(),
+            get_categories_index(),
+            get_descriptions_index(),
+        )
+    except Exception as ex:
+        logger.warning("Failed to warm up the reference data, it gets loaded on first use: %r", ex)
+        return False
 
-    # Run parsing task in the background without blocking the current thread
-    asyncio.create_task(filter_existing_transactions(file_location, send_stream))
+    logger.info("Reference data warmed up in %.2fs", time.perf_counter() - started_at)
+    return True
 
-    async with receive_stream:
-        async for transaction in receive_stream:
-            yield transaction
 
+async def sync_reference_data():
+    """
+    Sync the ledger mirror for an upload; while the warm-up is still at it, its sync is waited for
+    instead of starting another one
+    """
+    if _warm_up is not None and not _warm_up.done() and await asyncio.shield(_warm_up):
+        return
+    await sync_ledger_mirror()
 
-async def filter_existing_transactions(file_location: str, send_stream: MemoryObjectSendStream):
-    file_location = AsyncPath(file_location)
-    async with file_location.open() as f:
-        async for transaction in parse_bt_transaction_report(f):
-            assets_accounts = await get_assets_accounts()
-            if transaction.type in (FireflyTransactionTypes.WITHDRAWAL, FireflyTransactionTypes.TRANSFER):
-                account = assets_accounts.get(transaction.source_account)
-                if account:
-                    transaction.source_account = account['attributes']['name']
-                else:
-                    transaction.source_account = '!!UNKNOWN!!'
 
-            elif transaction.type is FireflyTransactionTypes.DEPOSIT:
-                account = assets_accounts.get(transaction.destination_account)
-                if account:
-                    transaction.destination_account = account['attributes']['name']
-                else:
-                    transaction.destination_account = '!!UNKNOWN!!'
-            logger.info(f'Checking if transaction with external id exists:\t{transaction.external_id}')
-            existing_transaction = await find_transaction_by_external_id(transaction.external_id)
-            if existing_transaction:
-                logger.info(f"Transaction with external id {transaction.external_id} already exists!")
+async def record_reference_data_usage(transaction: FireflyTransaction):
+    """
+    Add the accounts, category and description of an inserted transaction to the shared autocomplete
+    indexes, new entries included, so every session ranks them right away
+    """
+    accounts, categories, descriptions = await asyncio.gather(
+        get_accounts_index(),
+        get_categories_index(),
+        get_descriptions_index(),
+    )
+    used_on = transaction.date.date()
+    accounts.add(transaction.source_account, used_on)
+    accounts.add(transaction.destination_account, used_on)
+    categories.add(transaction.category_name, used_on)
+    descriptions.add(transaction.description, used_on)
+
+
+class ReviewPipeline:
+    """
+    Transactions of the uploaded reports on their way to the review form: parse, resolve the asset
+    accounts, drop the ones already in Firefly, flag likely duplicates (see DuplicateIndex), then queue
+    for review. The queue holds at most
+    FIREFLY_III_REVIEW_PREFETCH transactions, the stages wait for the user to catch up beyond that.
+    The outcomes of the rows go to the import job of the reports, whose consumer confirms the ones the user
+    inserts or skips: uploading the reports again after the session died skips straight to the rows left.
+    The pipeline belongs to a client session and must be closed with it; one nobody reads from for
+    FIREFLY_III_REVIEW_IDLE_TIMEOUT seconds (the user left) stops by itself.
+    """
+
+    def __init__(self, file_locations: list[str], prefetch: int = FIREFLY_III_REVIEW_PREFETCH,
+                 idle_timeout: float = FIREFLY_III_REVIEW_IDLE_TIMEOUT):
+        self.file_locations = file_locations
+        self.idle_timeout = idle_timeout
+        self.expired = False
+        # set when the reports couldn't be processed, the transactions handed over so far are all there is
+        self.failed = False
+        # set once every transaction of the reports got handed over
+        self.completed = False
+        # opened once the reports are parsed, before the first transaction is handed over
+        self.job: Optional[ImportJob] = None
+        # external id -> the transaction it's likely a duplicate of
+        self.duplicates: dict[str, IndexedTransaction] = {}
+        self.send_stream, self.receive_stream = create_memory_object_stream(
+            max_buffer_size=prefetch, item_type=FireflyTransaction
+        )
+        self.task = asyncio.create_task(self.run())
+        RUNNING_PIPELINES.add(self)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> FireflyTransaction:
+        try:
+            transaction = await self.receive_stream.receive()
+        except anyio.EndOfStream:
+            raise StopAsyncIteration
+
+        # the merchant may have been categorized by the user since the report got parsed
+        apply_learned_categorization(transaction)
+        return transaction
+
+    async def run(self):
+        async with self.send_stream:
+            try:
+                mirror = get_ledger_mirror()
+                # only the headless imports move the watermarks, a review may leave transactions out
+                transactions = await parse_bt_reports_async(
+                    self.file_locations, skip_ranges=get_watermark_skip_ranges(mirror),
+                    categorization_index=await anyio.to_thread.run_sync(get_categorization_index)
+                )
+                self.job = await anyio.to_thread.run_sync(
+                    ImportJob.open, mirror, self.file_locations, len(transactions)
+                )
+                assets_accounts = await get_assets_accounts()
+                if transactions:
+                    # transactions created in Firefly since the last sync may be dated before it
+                    await refresh_transactions(*get_statement_window(transactions))
+                existing_external_ids = build_external_ids_index(transactions, mirror)
+                duplicates = build_duplicate_index(transactions, mirror)
+                rows = RowLog(logger, f"Review of {', '.join(self.file_locations)}")
+
+                for transaction in transactions:
+                    statement_account = get_asset_account_key(transaction)
+                    resolve_review_asset_account(transaction, assets_accounts)
+
+                    if self.job.is_confirmed(transaction.external_id):
+                        self.job.resume(transaction, statement_account, duplicates)
+                        rows.add('resumed', "Transaction with external id %s was done before", transaction.external_id)
+                        continue
+                    if transaction.external_id in existing_external_ids:
+                        self.job.confirm(transaction.external_id, 'existing')
+                        rows.add('existing', "Transaction with external id %s already exists", transaction.external_id)
+                        continue
+
+                    duplicate = duplicates.find(transaction, statement_account)
+                    if duplicate:
+                        self.duplicates[transaction.external_id] = duplicate
+                        rows.add('duplicate', "Transaction with external id %s duplicates %s", transaction.external_id,
+                                 duplicate.describe())
+                    else:
+                        duplicates.add(transaction, statement_account)
+                        rows.add('queued', "Transaction with external id %s queued for review", transaction.external_id)
+                    with anyio.fail_after(self.idle_timeout):
+                        await self.send_stream.send(transaction)
+                rows.close()
+                self.completed = True
+
+            except TimeoutError:
+                self.expired = True
+                logger.info("Nobody reviewed the transactions of %s in time, stopping", self.file_locations)
+            except Exception as ex:
+                self.failed = True
+                logger.exception(ex)
+                logger.error("Failed to process %s", self.file_locations)
+
+    async def aclose(self):
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        await self.receive_stream.aclose()
+        if self.job:
+            self.job.checkpoint()
+        RUNNING_PIPELINES.discard(self)
+
+
+class BatchReview:
+    """
+    Every pending transaction of the uploaded reports at once, for the table review mode.
+    Uncontested rows (known accounts, a category found, nothing to fix and not a likely duplicate) start
+    out selected.
+    Accepted rows go to a background insert queue, inserted in date order while the user carries on.
+    Like ReviewPipeline, the batch belongs to a client session and must be closed with it; one the user didn't
+    touch and that inserted nothing for FIREFLY_III_REVIEW_IDLE_TIMEOUT seconds (the user left) stops inserting.
+    """
+
+    PENDING = 'pending'
+    QUEUED = 'queued'
+    INSERTED = 'inserted'
+    FAILED = 'failed'
+    SKIPPED = 'skipped'
+
+    def __init__(self, on_progress, idle_timeout: float = FIREFLY_III_REVIEW_IDLE_TIMEOUT):
+        """
+        :param on_progress: coroutine function called with the batch review after every insert
+        """
+        self.on_progress = on_progress
+        self.idle_timeout = idle_timeout
+        self.expired = False
+        # event loop time of the user's last action or the last insert
+        self.active_at = anyio.current_time()
+        self.transactions: dict[str, FireflyTransaction] = {}
+        self.statuses: dict[str, str] = {}
+        self.uncontested: set[str] = set()
+        # external id -> the transaction it's likely a duplicate of
+        self.duplicates: dict[str, IndexedTransaction] = {}
+        self.queue: asyncio.Queue[str] = asyncio.Queue()
+        # import job of the reports and whether the pipeline handed all their transactions over, see ReviewPipeline
+        self.job: Optional[ImportJob] = None
+        self.completed = False
+        self.failed = False
+        self.rows = RowLog(logger, "Batch review inserts")
+        self.worker = asyncio.create_task(self.insert_accepted())
+        RUNNING_PIPELINES.add(self)
+
+    @classmethod
+    async def load(cls, file_locations: list[str], on_progress) -> 'BatchReview':
+        batch = cls(on_progress)
+        pipeline = ReviewPipeline(file_locations)
+        # filled in by the pipeline before it hands a transaction over
+        batch.duplicates = pipeline.duplicates
+        try:
+            async for transaction in pipeline:
+                await batch.update(transaction)
+            batch.job, batch.completed, batch.failed = pipeline.job, pipeline.completed, pipeline.failed
+        except BaseException:
+            await batch.aclose()
+            raise
+        finally:
+            await pipeline.aclose()
+        return batch
+
+    async def update(self, transaction: FireflyTransaction):
+        """
+        Add a transaction, or replace a pending one with its edited version
+        """
+        if self.statuses.get(transaction.external_id, self.PENDING) not in (self.PENDING, self.FAILED):
+            return
+
+        self.transactions[transaction.external_id] = transaction
+        self.statuses[transaction.external_id] = self.PENDING
+        if (transaction.category_name and transaction.external_id not in self.duplicates
+                and not await get_form_errors(transaction)):
+            self.uncontested.add(transaction.external_id)
+        else:
+            self.uncontested.discard(transaction.external_id)
+
+    def touch(self):
+        self.active_at = anyio.current_time()
+
+    def get_pending(self) -> list[str]:
+        return [external_id for external_id, status in self.statuses.items() if status == self.PENDING]
+
+    def get_pending_uncontested(self) -> list[str]:
+        return [external_id for external_id in self.get_pending() if external_id in self.uncontested]
+
+    def accept(self, external_ids: list[str]) -> int:
+        accepted = [
+            external_id for external_id in external_ids
+            if self.statuses.get(external_id) in (self.PENDING, self.FAILED)
+        ]
+        for external_id in sorted(accepted, key=lambda external_id: self.transactions[external_id].date):
+            self.statuses[external_id] = self.QUEUED
+            self.queue.put_nowait(external_id)
+        return len(accepted)
+
+    def skip(self, external_ids: list[str]) -> int:
+        skipped = [
+            external_id for external_id in external_ids
+            if self.statuses.get(external_id) in (self.PENDING, self.FAILED)
+        ]
+        for external_id in skipped:
+            self.statuses[external_id] = self.SKIPPED
+            self.job.confirm(external_id, 'skipped')
+        return len(skipped)
+
+    def counts(self) -> Counter:
+        return Counter(self.statuses.values())
+
+    async def insert_accepted(self):
+        while True:
+            try:
+                with anyio.fail_after(self.active_at + self.idle_timeout - anyio.current_time()):
+                    external_id = await self.queue.get()
+            except TimeoutError:
+                if anyio.current_time() < self.active_at + self.idle_timeout:
+                    # touched while waiting
+                    continue
+                self.expired = True
+                logger.info("Nobody reviewed the batch in %.0fs, stopping", self.idle_timeout)
+                if self.job:
+                    self.job.checkpoint()
+                return
+
+            self.touch()
+            transaction = self.transactions[external_id]
+            try:
+                stored = await create_new_transaction(transaction)
+            except Exception as ex:
+                logger.exception(ex)
+                logger.error("Failed to insert transaction with external id %s", external_id)
+                self.rows.add('failed', "Transaction with external id %s failed to insert", external_id)
+                self.statuses[external_id] = self.FAILED
             else:
-                await send_stream.send_nowait(transaction)
-                logger.info(f"Transaction with external id {transaction.external_id} doesn't exist")
-        await send_stream.aclose()
+                self.job.confirm(external_id, 'inserted', stored['id'])
+                self.rows.add('inserted', "Transaction with external id %s successfully inserted", external_id)
+                self.statuses[external_id] = self.INSERTED
+                await record_reference_data_usage(transaction)
+
+            try:
+                await self.on_progress(self)
+            except Exception as ex:
+                logger.exception(ex)
+
+    async def aclose(self):
+        self.worker.cancel()
+        await asyncio.gather(self.worker, return_exceptions=True)
+        self.rows.close()
+        if self.job:
+            self.job.checkpoint()
+        RUNNING_PIPELINES.discard(self)
+
+
+async def serve_batch_review(q: Q) -> list:
+    """
+    Table review mode: handle the batch review's actions and build its form, or close it once finished
+    """
+    form_items = []
+
+    if q.client.batch is None:
+        await download_uploaded_files(q)
+        await sync_reference_data()
+        q.client.batch = await BatchReview.load(q.client.current_files, functools.partial(show_insert_progress, q))
+        q.client.editing_row = None
+
+    batch: BatchReview = q.client.batch
+    if batch.failed:
+        await batch.aclose()
+        q.client.batch = None
+        q.client.current_files = None
+        await q.client.temp_dir.close()
+        return [ui.message_bar(type='error', text='Failed to process the uploaded files, see the logs for why')]
+    if batch.expired:
+        await batch.aclose()
+        q.client.batch = None
+        q.client.current_files = None
+        await q.client.temp_dir.close()
+        del q.page['insert_progress']
+        return [ui.message_bar(type='warning', text='Review timed out, upload the files again to go on')]
+    batch.touch()
+
+    if q.args.edit_row:
+        q.client.editing_row = q.args.edit_row
+    elif q.args.save_row and q.client.editing_row:
+        await batch.update(read_form_transaction(q, q.client.editing_row))
+        q.client.editing_row = None
+    elif q.args.cancel_edit:
+        q.client.editing_row = None
+    elif q.args.skip_row:
+        batch.skip([q.args.skip_row])
+    elif q.args.accept_selected:
+        count = batch.accept(q.args.batch_table or [])
+        form_items.append(ui.message_bar(type='info', text=f'Queued {count} transactions for insertion'))
+    elif q.args.accept_uncontested:
+        count = batch.accept(batch.get_pending_uncontested())
+        form_items.append(ui.message_bar(type='info', text=f'Queued {count} transactions for insertion'))
+    elif q.args.skip_selected:
+        count = batch.skip(q.args.batch_table or [])
+        form_items.append(ui.message_bar(type='info', text=f'Skipped {count} transactions'))
+    elif q.args.finish_batch:
+        counts = batch.counts()
+        if counts[BatchReview.QUEUED]:
+            form_items.append(ui.message_bar(
+                type='warning', text=f'Still inserting {counts[BatchReview.QUEUED]} transactions, try again shortly'
+            ))
+        else:
+            # rows that failed or were left pending aren't confirmed, uploading the files again brings them back
+            if batch.completed and not counts[BatchReview.FAILED] and not counts[BatchReview.PENDING]:
+                batch.job.finish()
+            await batch.aclose()
+            q.client.batch = None
+            q.client.current_files = None
+            await q.client.temp_dir.close()
+            del q.page['insert_progress']
+            return [ui.message_bar(
+                type='info',
+                text=f'Finished: {counts[BatchReview.INSERTED]} inserted, {counts[BatchReview.FAILED]} failed, '
+                     f'{counts[BatchReview.SKIPPED] + counts[BatchReview.PENDING]} skipped'
+            )] + pop_import_summary_items(q)
+
+    q.page['insert_progress'] = build_insert_progress_card(batch)
+
+    if q.client.editing_row:
+        duplicate = batch.duplicates.get(q.client.editing_row)
+        if duplicate:
+            form_items.append(build_duplicate_message_bar(duplicate))
+        form_items += await build_form_transaction_fields(batch.transactions[q.client.editing_row], q)
+        form_items.append(ui.buttons(justify='center', items=[
+            ui.button(name='save_row', label='Save', primary=True),
+            ui.button(name='cancel_edit', label='Cancel'),
+        ]))
+    else:
+        form_items += build_batch_review_table(batch)
+
+    return form_items
+
+
+def build_batch_review_table(batch: BatchReview) -> list:
+    status_colors = {
+        'READY': '$green', 'REVIEW': '$orange', 'DUPLICATE': '$purple', 'QUEUED': '$blue', 'INSERTED': '$gray',
+        'FAILED': '$red', 'SKIPPED': '$gray',
+    }
+
+    def get_status_label(external_id: str) -> str:
+        status = batch.statuses[external_id]
+        if status == BatchReview.PENDING:
+            if external_id in batch.duplicates:
+                return 'DUPLICATE'
+            return 'READY' if external_id in batch.uncontested else 'REVIEW'
+        return status.upper()
+
+    rows = [
+        ui.table_row(name=external_id, cells=[
+            transaction.date.date().isoformat(),
+            transaction.description,
+            transaction.source_account,
+            transaction.destination_account,
+            f'{transaction.amount} {transaction.currency_code or ""}',
+            transaction.category_name or '',
+            get_status_label(external_id),
+            '',
+        ])
+        for external_id, transaction in batch.transactions.items()
+    ]
+
+    return [
+        ui.table(
+            name='batch_table',
+            columns=[
+                ui.table_column(name='date', label='Date', sortable=True, max_width='100'),
+                ui.table_column(name='description', label='Description', searchable=True, min_width='200'),
+                ui.table_column(name='source_account', label='Source Account', searchable=True, filterable=True),
+                ui.table_column(name='destination_account', label='Destination Account', searchable=True,
+                                filterable=True),
+                ui.table_column(name='amount', label='Amount', align='right', max_width='120'),
+                ui.table_column(name='category_name', label='Category', filterable=True),
+                ui.table_column(name='status', label='Status', filterable=True, cell_type=ui.tag_table_cell_type(
+                    name='status_tags',
+                    tags=[ui.tag(label=label, color=color) for label, color in status_colors.items()]
+                )),
+                ui.table_column(name='actions', label='Actions', cell_type=ui.menu_table_cell_type(
+                    name='row_commands',
+                    commands=[ui.command(name='edit_row', label='Edit'), ui.command(name='skip_row', label='Skip')]
+                )),
+            ],
+            rows=rows,
+            multiple=True,
+            # uncontested transactions are pre-accepted
+            values=batch.get_pending_uncontested(),
+            checkbox_visibility='always',
+            height='600px',
+        ),
+        ui.buttons(justify='center', items=[
+            ui.button(name='accept_selected', label='Accept selected', primary=True),
+            ui.button(name='accept_uncontested', label='Accept all uncontested'),
+            ui.button(name='skip_selected', label='Skip selected'),
+            ui.button(name='finish_batch', label='Finish'),
+        ]),
+    ]
+
+
+def build_duplicate_message_bar(duplicate: IndexedTransaction):
+    return ui.message_bar(
+        type='warning', text=f'Likely a duplicate of {duplicate.describe()}, skip it unless it is a separate one'
+    )
+
+
+def build_insert_progress_card(batch: BatchReview):
+    counts = batch.counts()
+    accepted = counts[BatchReview.QUEUED] + counts[BatchReview.INSERTED] + counts[BatchReview.FAILED]
+    done = counts[BatchReview.INSERTED] + counts[BatchReview.FAILED]
+    return ui.form_card(box='1 11 12 2', items=[
+        ui.progress(
+            label='Inserting accepted transactions',
+            caption=f'{counts[BatchReview.INSERTED]} inserted, {counts[BatchReview.FAILED]} failed, '
+                    f'{counts[BatchReview.QUEUED]} queued, {counts[BatchReview.PENDING]} left to review',
+            value=done / accepted if accepted else 0,
+        )
+    ])
+
+
+async def show_insert_progress(q: Q, batch: BatchReview):
+    q.page['insert_progress'] = build_insert_progress_card(batch)
+    await q.page.save()
+
+
+def resolve_review_asset_account(transaction: FireflyTransaction, assets_accounts: dict):
+    """
+    Like resolve_asset_account, but unknown accounts are left for the user to fill in
+    """
+    if transaction.type in (FireflyTransactionTypes.WITHDRAWAL, FireflyTransactionTypes.TRANSFER):
+        account = assets_accounts.get(transaction.source_account)
+        if account:
+            transaction.source_account = account['attributes']['name']
+        else:
+            transaction.source_account = '!!UNKNOWN!!'
+
+    elif transaction.type is FireflyTransactionTypes.DEPOSIT:
+        account = assets_accounts.get(transaction.destination_account)
+        if account:
+            transaction.destination_account = account['attributes']['name']
+        else:
+            transaction.destination_account = '!!UNKNOWN!!'
 
 
 async def get_form_errors(transaction: FireflyTransaction):
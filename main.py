@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 import logging
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+from firefly_iii_automation.log import configure_logging
+
+configure_logging()
 
 logger = logging.getLogger(__name__)
 
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+import argparse
+import asyncio
+import logging
+from pathlib import Path
+
+from firefly_iii_automation.log import configure_logging
+
+configure_logging()
+
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    from firefly_iii_automation import metrics
+    from firefly_iii_automation.env import FIREFLY_III_WATCH_DIRECTORY
+    from firefly_iii_automation.watcher import watch_directory
+
+    parser = argparse.ArgumentParser(description="Import the BT reports dropped into a directory as they arrive")
+    parser.add_argument('directory', nargs='?', default=FIREFLY_III_WATCH_DIRECTORY,
+                        help="the directory to watch, FIREFLY_III_WATCH_DIRECTORY if not given")
+    args = parser.parse_args()
+    if not args.directory:
+        parser.error("no directory given and FIREFLY_III_WATCH_DIRECTORY is unset")
+
+    metrics.start_metrics_server()
+    asyncio.run(watch_directory(Path(args.directory).expanduser()))